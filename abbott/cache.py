@@ -0,0 +1,116 @@
+from collections import OrderedDict
+
+from twisted.internet import reactor
+
+"""
+A small in-memory cache with per-entry expiry, used by the transport to cache
+request results and available to plugins that keep their own caches.
+
+"""
+
+class TTLCache(object):
+    """A mapping whose entries expire ttl seconds after they were set.
+
+    If maxsize is given, the least recently used entries are evicted to keep
+    at most that many. Lookups are counted in the hits and misses attributes.
+
+    clock is an object with a seconds() method, normally the reactor. Tests
+    may pass a twisted.internet.task.Clock.
+
+    generation is incremented every time the cache is cleared. Code that
+    fetches a value to store can compare it from before and after, to avoid
+    storing something that was invalidated in the meantime.
+
+    """
+    def __init__(self, ttl, maxsize=None, clock=None):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.clock = clock if clock is not None else reactor
+        self.hits = 0
+        self.misses = 0
+        self.generation = 0
+
+        # Maps keys to (expiry time, value) tuples, least recently used first
+        self._entries = OrderedDict()
+
+    def __getitem__(self, key):
+        try:
+            expires, value = self._entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            raise
+        if expires <= self.clock.seconds():
+            self.misses += 1
+            raise KeyError(key)
+        # Re-insert to mark it as the most recently used
+        self._entries[key] = (expires, value)
+        self.hits += 1
+        return value
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def set(self, key, value, ttl=None):
+        """Like cache[key] = value, but the entry expires after ttl seconds
+        instead of the cache's ttl if given
+
+        """
+        if ttl is None:
+            ttl = self.ttl
+        self._entries.pop(key, None)
+        self._entries[key] = (self.clock.seconds() + ttl, value)
+        if self.maxsize is not None:
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def __delitem__(self, key):
+        del self._entries[key]
+
+    def pop(self, key, default=None):
+        try:
+            return self._entries.pop(key)[1]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        """Doesn't count as a hit or a miss, or change the LRU order"""
+        try:
+            expires, _ = self._entries[key]
+        except KeyError:
+            return False
+        return expires > self.clock.seconds()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def keys(self):
+        return self._entries.keys()
+
+    def clear(self):
+        self._entries.clear()
+        self.generation += 1
+
+    def expire(self):
+        """Removes every expired entry. Expired entries are otherwise only
+        removed when they're looked up or pushed out by newer ones.
+
+        """
+        now = self.clock.seconds()
+        for key, (expires, _) in self._entries.items():
+            if expires <= now:
+                del self._entries[key]
+
+    def hit_rate(self):
+        """The fraction of lookups that were hits, or 0 if there were none"""
+        lookups = self.hits + self.misses
+        return float(self.hits) / lookups if lookups else 0
+
+    def format(self):
+        return "{0} entries, {1} hits, {2} misses ({3:.0%} hit rate)".format(
+                len(self), self.hits, self.misses, self.hit_rate())
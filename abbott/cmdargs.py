@@ -0,0 +1,210 @@
+import re
+
+"""
+Declarative argument specs for commands.
+
+Instead of an argmatch regular expression, a command may be installed with a
+list of Arg objects describing its arguments. The list is compiled once into
+an ArgParser, which splits the arguments into space separated tokens and
+converts them one at a time, left to right. No token is looked at more than
+twice, so parsing takes time linear in the length of the line no matter what
+the user types.
+
+The result is an ArgMatch, which has the same group() and groupdict() methods
+as a regular expression match object, so command callbacks don't need to
+know which way their arguments were parsed.
+
+For example, the arguments "<nick or hostmask> [for <duration>] [reason]"
+are declared with:
+
+    args=[
+        Arg("nick", "hostmask"),
+        Arg("duration", "duration", optional=True, keyword="for"),
+        Arg("reason", "rest", optional=True),
+    ]
+
+"""
+
+_nick_re = re.compile(r"[A-Za-z\[\]\\`_^{|}][A-Za-z0-9\[\]\\`_^{|}-]*$")
+# A nick or nick!user@host mask, any part of which may have wildcards, or an
+# extban such as $a:account
+_hostmask_re = re.compile(r"(?:[^ !@$]+(?:![^ !@]+@[^ !@]+)?|\$[^ ]+)$")
+_duration_re = re.compile(r"(?:\d+[smhdw])+$")
+_duration_part_re = re.compile(r"(\d+)([smhdw])")
+
+DURATION_UNITS = {
+        's': 1,
+        'm': 60,
+        'h': 60*60,
+        'd': 60*60*24,
+        'w': 60*60*24*7,
+        }
+
+def parse_duration(s):
+    """Parses a duration such as "1h30m" into a number of seconds. Raises
+    ValueError if s isn't a duration.
+
+    """
+    if not _duration_re.match(s):
+        raise ValueError("Not a duration: %r" % s)
+    return sum(int(n) * DURATION_UNITS[unit]
+            for n, unit in _duration_part_re.findall(s))
+
+def _matching(regex, what):
+    def convert(s):
+        if not regex.match(s):
+            raise ValueError("Not a %s: %r" % (what, s))
+        return s
+    return convert
+
+def _channel(s):
+    if not s or s[0] not in "#&!+":
+        raise ValueError("Not a channel: %r" % s)
+    return s
+
+# Maps type names to functions taking a token and returning its value, or
+# raising ValueError if the token isn't of that type. "rest" is handled
+# specially by the parser, since it's not a single token.
+TYPES = {
+        "word": lambda s: s,
+        "int": int,
+        "duration": parse_duration,
+        "nick": _matching(_nick_re, "nick"),
+        "hostmask": _matching(_hostmask_re, "hostmask"),
+        "channel": _channel,
+        }
+
+_token_re = re.compile(r"[^ ]+")
+
+class Arg(object):
+    """One argument of a command.
+
+    name is the key the value is stored under in the match's groupdict.
+
+    type is one of the names in TYPES, "rest" for the rest of the line
+    (which must be the last argument), or a callable that takes a token and
+    returns its value or raises ValueError.
+
+    If optional is true and the next token isn't of the right type, the value
+    is None and the token is left for the next argument.
+
+    keyword is a word that may come before the value, as in "for 10m". It's
+    skipped if it's there and followed by a valid value.
+
+    """
+    def __init__(self, name, type="word", optional=False, keyword=None):
+        self.name = name
+        self.optional = optional
+        self.keyword = keyword
+        self.rest = type == "rest"
+        if self.rest:
+            self.convert = None
+        elif callable(type):
+            self.convert = type
+        else:
+            try:
+                self.convert = TYPES[type]
+            except KeyError:
+                raise ValueError("Unknown argument type %r" % (type,))
+
+    def usage(self):
+        text = "<%s>" % self.name
+        if self.keyword:
+            text = "%s %s" % (self.keyword, text)
+        if self.optional:
+            text = "[%s]" % text
+        return text
+
+class ArgMatch(object):
+    """The result of a successful parse. Looks enough like a re.Match object
+    for command callbacks.
+
+    """
+    def __init__(self, string, values):
+        self.string = string
+        self._values = values
+
+    def group(self, *names):
+        if not names:
+            names = (0,)
+        values = tuple(self.string if name == 0 else self._values[name]
+                for name in names)
+        return values[0] if len(values) == 1 else values
+
+    def groupdict(self, default=None):
+        return dict((name, default if value is None else value)
+                for name, value in self._values.iteritems())
+
+    def __repr__(self):
+        return "<ArgMatch %r %r>" % (self.string, self._values)
+
+class ArgParser(object):
+    """Compiled from a list of Arg objects. parse() returns an ArgMatch, or
+    None if the string doesn't fit the spec.
+
+    """
+    def __init__(self, args):
+        self.args = list(args)
+        for arg in self.args[:-1]:
+            if arg.rest:
+                raise ValueError("A rest of line argument must be the last argument")
+
+    def usage(self):
+        return " ".join(arg.usage() for arg in self.args)
+
+    def parse(self, string, whole=None):
+        """Parses the arguments in string. whole is the string reported as
+        group 0 of the match, and defaults to string.
+
+        """
+        tokens = [(m.group(), m.start()) for m in _token_re.finditer(string)]
+        values = {}
+        i = 0
+        for arg in self.args:
+            start = i
+            if (arg.keyword and i < len(tokens) - 1 and
+                    tokens[i][0] == arg.keyword):
+                i += 1
+
+            if arg.rest:
+                if i < len(tokens):
+                    values[arg.name] = string[tokens[i][1]:]
+                    i = len(tokens)
+                    continue
+            elif i < len(tokens):
+                try:
+                    values[arg.name] = arg.convert(tokens[i][0])
+                except ValueError:
+                    pass
+                else:
+                    i += 1
+                    continue
+
+            # No value. Put back the keyword, if one was skipped.
+            if not arg.optional:
+                return None
+            values[arg.name] = None
+            i = start
+
+        if i < len(tokens):
+            # Left over arguments
+            return None
+        return ArgMatch(string if whole is None else whole, values)
+
+    def pattern(self, command_str):
+        """Returns an object with a match() method like a compiled regular
+        expression, matching command_str followed by these arguments
+
+        """
+        return _CommandPattern(re.compile(command_str + "(?: |$)"), self)
+
+class _CommandPattern(object):
+    def __init__(self, command_re, parser):
+        self.command_re = command_re
+        self.parser = parser
+
+    def match(self, string):
+        m = self.command_re.match(string)
+        if not m:
+            return None
+        return self.parser.parse(string[m.end():], whole=string)
@@ -1,13 +1,21 @@
 import re
-from collections import namedtuple
+from collections import namedtuple, defaultdict
 import random
 from functools import wraps
+from itertools import count
+import weakref
 
 from twisted.python import log
 from twisted.internet import reactor
 from twisted.internet import defer
 
+from twisted.python.failure import Failure
+
 from .pluginbase import BotPlugin
+from .cmdargs import ArgParser
+from .stats import CommandStats, timer
+from .cache import TTLCache
+from .ratelimit import RateLimiter
 
 """
 
@@ -45,6 +53,13 @@ This command framework has a few nice features: easily defined commands with
 flexible argument parsing with regular expressions, an integrated help system,
 and automatic permission checking.
 
+Command plugins don't each listen for irc.on_privmsg. Instead, every command is
+registered with a _CommandRouter shared by all the command plugins of a bot.
+The router looks at each message once, and uses the first word of the command
+to find the few commands that could possibly match, so lines that aren't
+commands are cheap to ignore. Only those commands' regular expressions are
+tried.
+
 """
 def require_channel(func):
     """Wraps command callbacks and requires them to be in response to a channel
@@ -72,12 +87,16 @@ class _CommandGroup(object):
             permission=None,
             helptext=None,
             globalprefix=None,
+            plugin=None,
+            router=None,
             ):
         self.grpname = grpname
         self.cmdlist = cmdlist
         self.prefix = prefix
         self.permission = permission
         self.globalprefix = globalprefix
+        self.plugin = plugin
+        self.router = router
 
         if grpname:
             help_re = re.compile("(?:help )?(?:%s)?%s" % (
@@ -107,12 +126,15 @@ class _CommandGroup(object):
             ))
 
         self.subcmds = []
-        cmdglist.append(_CommandGroupTuple(
+        cmdg = _CommandGroupTuple(
             grpname=grpname,
             helpre=help_re,
             helplines=helplines,
             subcmds=self.subcmds,
-            ))
+            )
+        cmdglist.append(cmdg)
+        if grpname and router is not None:
+            router.add_group(plugin, cmdg, self.prefix)
 
     def install_command(self,
             cmdname,
@@ -123,7 +145,11 @@ class _CommandGroup(object):
             argmatch=None,
             permission=None,
             prefix=None,
-            helptext=None):
+            helptext=None,
+            args=None,
+            ratelimit=None,
+            concurrency=None,
+            queue=0):
         """Install a command.
 
         cmdname is the name of the command, used in command listing and usage
@@ -156,6 +182,13 @@ class _CommandGroup(object):
         put a $ at the end of this if given, otherwise any trailing string will
         still match.
 
+        args is an alternative to argmatch: a list of cmdargs.Arg objects
+        declaring the arguments this command takes. The callback gets an
+        object with the same group() and groupdict() methods as a match
+        object. Unlike argmatch, the arguments are converted to their types,
+        and parsing can't get stuck backtracking. If cmdusage isn't given, it
+        is generated from the args. See the cmdargs module.
+
         permission, if given, is the permission required for a user to execute
         this command. If not given, permission is taken from the command group.
 
@@ -167,6 +200,20 @@ class _CommandGroup(object):
         helptext, if given, is displayed after the usage in help messages as a
         short one-line description of this command.
 
+        ratelimit, if given, limits how often this command may be invoked. It
+        is a dict mapping "user" and/or "channel" to a (burst, period) pair:
+        each user (hostmask) or channel may invoke the command `burst` times
+        in a row, and `burst` times per `period` seconds on average.
+        Invocations over the limit are dropped before any permission checks.
+        This is only the default; see config['command']['ratelimits'].
+
+        concurrency, if given, is the most invocations of this command that
+        may run at once. An invocation runs until its callback returns, or if
+        the callback returns a deferred, until that fires. Up to `queue` more
+        invocations wait their turn in order; beyond that, the user is told to
+        try again later. Use this for commands that start processes or
+        otherwise use a lot of resources.
+
         """
         # This is to support empty self.grpname for top-level commands
         if self.grpname:
@@ -181,6 +228,15 @@ class _CommandGroup(object):
                 cmdmatch if cmdmatch else re.escape(cmdname),
                 )
 
+        if args is not None:
+            if argmatch:
+                raise ValueError("Give either argmatch or args, not both")
+            parser = ArgParser(args)
+            if cmdusage is None:
+                cmdusage = parser.usage()
+        else:
+            parser = None
+
         # Now put together a regular expression string matching the entire
         # command plus arguments
         if argmatch:
@@ -202,10 +258,13 @@ class _CommandGroup(object):
         # plus the prefix. If this command doesn't give a prefix, go with the
         # group prefix.
         prefix = prefix if prefix is not None else self.prefix
-        if prefix is not None:
-            prefix_re = re.compile(re.escape(prefix) + commandargs_str)
-        else:
+        if prefix is None:
             prefix_re = None
+        elif parser is not None:
+            prefix_re = parser.pattern(re.escape(prefix) + command_str)
+        else:
+            prefix_re = re.compile(re.escape(prefix) + commandargs_str)
+        cmdprefix = prefix
 
         # This should match the command without any arguments and an optional
         # "help" at the beginning. The \b at the end is so that the help text
@@ -235,16 +294,24 @@ class _CommandGroup(object):
                 helptext if helptext else "No documentation provided (you're on your own!)",
                 )
 
-        self.cmdlist.append(_CommandTuple(
+        cmd = _CommandTuple(
             cmdname="%s%s" % (grpname, cmdname),
             permission=permission if permission else self.permission,
-            commandre=re.compile(commandargs_str),
+            commandre=parser.pattern(command_str) if parser is not None
+                else re.compile(commandargs_str),
             prefixre=prefix_re,
             helpre=help_re,
             callback=callback,
             deniedcallback=deniedcallback,
             helplines=help_str.split("\n"),
-            ))
+            ratelimit=ratelimit,
+            semaphore=defer.DeferredSemaphore(concurrency) if concurrency else None,
+            queue=queue,
+            )
+        self.cmdlist.append(cmd)
+        if self.router is not None:
+            self.router.add_command(self.plugin, cmd,
+                    _command_words(grpname, cmdname, cmdmatch), cmdprefix)
         self.subcmds.append(
                 (cmdname,permission if permission else self.permission)
                 )
@@ -258,7 +325,10 @@ _CommandTuple = namedtuple("_CommandTuple", [
     "helpre",
     "callback",
     "deniedcallback",
-    "helplines"
+    "helplines",
+    "ratelimit",
+    "semaphore",
+    "queue",
     ])
 _CommandGroupTuple = namedtuple("_CommandGroupTuple", [
     "grpname",
@@ -267,20 +337,405 @@ _CommandGroupTuple = namedtuple("_CommandGroupTuple", [
     "subcmds",
     ])
 
+# Matches the leading word of a message or command
+_word_re = re.compile(r"\w*")
+# Matches a cmdmatch alternative that is just a word, optionally with its last
+# letter optional, and optionally anchored at the end
+_simple_alternative_re = re.compile(r"(\w+)(\??)\$?$")
+
+def _leading_word(s):
+    return _word_re.match(s).group()
+
+def _command_words(grpname, cmdname, cmdmatch):
+    """Returns the set of words a message invoking this command could start
+    with, or None if that can't be determined from the command's regular
+    expression.
+
+    The commands' regular expressions are not compiled with re.UNICODE, and a
+    word in a command is always followed by a space, a word boundary or the end
+    of the string. So the leading \w+ run of any message matching the command
+    is exactly one of these words.
+
+    """
+    if grpname:
+        word = _leading_word(grpname)
+        return set([word]) if word else None
+    if not cmdmatch:
+        word = _leading_word(cmdname)
+        return set([word]) if word else None
+
+    words = set()
+    for alternative in cmdmatch.split("|"):
+        match = _simple_alternative_re.match(alternative)
+        if not match:
+            return None
+        word, optional = match.groups()
+        words.add(word)
+        if optional:
+            if len(word) == 1:
+                return None
+            words.add(word[:-1])
+    return words
+
+class _CommandRouter(object):
+    """Dispatches irc.on_privmsg events to the commands of all command plugins.
+
+    There is one router per bot (per PluginBoss). It listens for irc.on_privmsg
+    itself, strips the nick or global prefix once, and looks up the commands
+    that could match by the first word of the message. Each candidate plugin
+    is then handed just its candidate commands, which it checks with the same
+    logic as if it had scanned all of its commands.
+
+    Commands whose first word can't be determined from their regular
+    expressions are always candidates.
+
+    Most lines aren't commands. The first character of every prefix in use
+    (the nick prefix, the global prefix and command specific prefixes) is kept
+    in a set, so lines that can't start with any of them are rejected with a
+    single lookup. The current nick is tracked through irc.on_nick_set events
+    rather than looked up for every line.
+
+    Plugins are dropped from the router once they're no longer loaded.
+
+    The router also holds a CommandStats object per command name, which the
+    command plugins update, and provides them with the command.stats request.
+
+    """
+    plugin_name = "command.router"
+
+    # Maps PluginBoss objects to their router
+    _routers = weakref.WeakKeyDictionary()
+
+    @classmethod
+    def for_plugin(cls, plugin):
+        """Returns the router for the given plugin's bot, creating it if
+        necessary
+
+        """
+        try:
+            return cls._routers[plugin.pluginboss]
+        except KeyError:
+            router = cls._routers[plugin.pluginboss] = cls(
+                    plugin.pluginboss, plugin.transport)
+            return router
+
+    def __init__(self, pluginboss, transport):
+        self.pluginboss = pluginboss
+        self.globalprefix = None
+        self.nick = None
+        # Incremented whenever commands are added or removed
+        self.generation = 0
+
+        # Routes are (sequence number, plugin, command tuple) tuples. The
+        # sequence number orders them in the order they were installed.
+        self._seq = count()
+
+        # Maps the first word of commands to the routes for those commands
+        self.by_word = defaultdict(list)
+        # Routes for commands we couldn't find the first word of
+        self.fallback = []
+        # Maps each command specific prefix to a dict like by_word, for the
+        # commands with that prefix
+        self.by_prefix = defaultdict(lambda: defaultdict(list))
+        # Maps each command specific prefix to fallback routes for it
+        self.prefix_fallback = defaultdict(list)
+        # Maps the first word of command groups to routes for those groups
+        self.groups = defaultdict(list)
+        # Routes for groups we couldn't find the first word of
+        self.group_fallback = []
+
+        # Maps the first character of each command specific prefix to the
+        # prefixes starting with it
+        self.prefixes_by_char = defaultdict(list)
+        # The first characters of every prefix. A line that doesn't start
+        # with one of these can only be a command in a direct message.
+        self.first_chars = frozenset()
+        # True if some command has an empty prefix, so every line may match
+        self.match_all = False
+
+        # Maps command names to CommandStats objects
+        self.command_stats = {}
+
+        self.ratelimiter = RateLimiter()
+        # The ratelimits from the config, and the limits resolved for each
+        # command from those and the command's own
+        self.ratelimits = {}
+        self._limits = {}
+        # Hostmasks recently told they're over a rate limit, so we don't
+        # reply to every single message of someone flooding us
+        self._warned = TTLCache(60, maxsize=1000)
+
+        transport.listen_for_event("irc.on_privmsg", self)
+        transport.listen_for_event("irc.on_nick_set", self)
+        transport.provides_request("command.stats", self)
+
+    def reload(self, config):
+        self.globalprefix = config.get("command", {}).get("prefix", None)
+        self._index_prefixes()
+        self.ratelimits = config.get("command", {}).get("ratelimits", {})
+        self._limits = {}
+
+    def limits_for(self, cmd):
+        """Returns the rate limits that apply to the given command. The limits
+        in config['command']['ratelimits'] for the command's name take
+        precedence, then the ones for its permission or the closest parent
+        permission, then the ones the command was installed with, then the
+        ones under "*".
+
+        """
+        try:
+            return self._limits[cmd.cmdname]
+        except KeyError:
+            pass
+        candidates = [cmd.cmdname]
+        if cmd.permission:
+            parts = cmd.permission.split(".")
+            candidates.extend(".".join(parts[:i])
+                    for i in xrange(len(parts), 0, -1))
+        for name in candidates:
+            if name in self.ratelimits:
+                limits = self.ratelimits[name]
+                break
+        else:
+            limits = cmd.ratelimit or self.ratelimits.get("*") or {}
+        self._limits[cmd.cmdname] = limits
+        return limits
+
+    def ratelimited(self, event, cmd):
+        """Returns True if the invocation of cmd by this event is over its
+        rate limit, in which case the user is told so (at most once a minute)
+
+        """
+        limits = self.limits_for(cmd)
+        if not limits:
+            return False
+        channel = None if event.direct else event.channel
+        wait = self.ratelimiter.check(cmd.cmdname, limits, event.user, channel)
+        if not wait:
+            return False
+        log.msg("Rate limited %s from %s" % (cmd.cmdname, event.user))
+        self.stats_for(cmd.cmdname).ratelimited += 1
+        if event.user not in self._warned:
+            self._warned[event.user] = True
+            event.reply(notice=True, direct=True,
+                    msg="You're using %s too often. Try again in %d seconds" % (
+                        cmd.cmdname, int(wait) + 1))
+        return True
+
+    def stats_for(self, cmdname):
+        try:
+            return self.command_stats[cmdname]
+        except KeyError:
+            stats = self.command_stats[cmdname] = CommandStats()
+            return stats
+
+    def incoming_request(self, name, *args, **kwargs):
+        if name == "command.stats":
+            # Returns the dict mapping command names to CommandStats objects
+            return self.command_stats
+        raise NotImplementedError("Unknown request %s" % name)
+
+    def current_nick(self):
+        """Returns the bot's current nick, or None if it isn't known yet"""
+        if self.nick is None:
+            # We were created after the nick was set. Ask the IRC plugin
+            # once; irc.on_nick_set events keep it current from then on.
+            try:
+                client = self.pluginboss.loaded_plugins['irc.IRCBotPlugin'].client
+            except KeyError:
+                return None
+            if client is not None:
+                self.nick = client.nickname
+        return self.nick
+
+    def _index_prefixes(self):
+        chars = set(self.prefixes_by_char)
+        chars.discard("")
+        globalprefix = self.globalprefix.strip() if self.globalprefix else None
+        if globalprefix:
+            chars.add(globalprefix[0])
+        nick = self.current_nick()
+        if nick:
+            chars.add(nick[0])
+        self.first_chars = frozenset(chars)
+        self.match_all = "" in self.prefixes_by_char
+
+    def _add_prefix(self, prefix):
+        if prefix not in self.prefixes_by_char[prefix[:1]]:
+            self.prefixes_by_char[prefix[:1]].append(prefix)
+            self._index_prefixes()
+
+    def add_command(self, plugin, cmd, words, prefix):
+        self.generation += 1
+        route = (next(self._seq), plugin, cmd)
+        if words is None:
+            self.fallback.append(route)
+        else:
+            for word in words:
+                self.by_word[word].append(route)
+
+        if prefix is not None:
+            self._add_prefix(prefix)
+            if words is None:
+                self.prefix_fallback[prefix].append(route)
+            else:
+                for word in words:
+                    self.by_prefix[prefix][word].append(route)
+
+    def add_group(self, plugin, cmdg, prefix):
+        self.generation += 1
+        route = (next(self._seq), plugin, cmdg)
+        if prefix is not None:
+            # So help requests with this prefix get looked up
+            self.by_prefix[prefix]
+            self._add_prefix(prefix)
+        word = _leading_word(cmdg.grpname)
+        if word:
+            self.groups[word].append(route)
+        else:
+            self.group_fallback.append(route)
+
+    def remove_plugin(self, plugin):
+        self.generation += 1
+        def purge(routes):
+            routes[:] = [r for r in routes if r[1] is not plugin]
+        for routes in self.by_word.itervalues():
+            purge(routes)
+        purge(self.fallback)
+        for words in self.by_prefix.itervalues():
+            for routes in words.itervalues():
+                purge(routes)
+        for routes in self.prefix_fallback.itervalues():
+            purge(routes)
+        for routes in self.groups.itervalues():
+            purge(routes)
+        purge(self.group_fallback)
+
+    def _keys(self, message):
+        """Returns the words to look up for the given message, which has had
+        any nick or global prefix stripped.
+
+        Besides the first word, a help request for a command (with or without
+        that command's own prefix) looks up the command after "help ".
+
+        """
+        keys = [_leading_word(message)]
+        if message.startswith("help "):
+            rest = message[5:]
+            keys.append(_leading_word(rest))
+        else:
+            rest = message
+        prefixes = self.prefixes_by_char.get(rest[:1], [])
+        if self.match_all:
+            prefixes = prefixes + self.prefixes_by_char[""]
+        for prefix in prefixes:
+            if rest.startswith(prefix):
+                keys.append(_leading_word(rest[len(prefix):]))
+        return keys
+
+    def received_event(self, event):
+        if event.eventtype == "irc.on_nick_set":
+            self.nick = event.nick
+            self._index_prefixes()
+            return
+        if event.eventtype != "irc.on_privmsg":
+            return
+
+        message = event.message
+        if not (event.direct or self.match_all):
+            # The quick check. Command specific prefixes are matched against
+            # the line with leading whitespace stripped.
+            first = message[:1]
+            if first.isspace():
+                first = message.lstrip()[:1]
+            if first not in self.first_chars:
+                return
+
+        # First see if this looks like a command. A command takes the form of
+        # <botname>: <command>
+        # or
+        # <global prefix> <command>
+        nick = self.current_nick()
+        nickprefix = nick + ":" if nick else None
+        globalprefix = self.globalprefix.strip() if self.globalprefix else None
+        if nickprefix and message.startswith(nickprefix):
+            message = message[len(nickprefix):].strip()
+        elif globalprefix and message.startswith(globalprefix):
+            message = message[len(globalprefix):].strip()
+        elif event.direct:
+            # Don't require a prefix if this was sent in a direct message to me
+            message = message
+        else:
+            # Don't match the command by itself... we require a prefix (but
+            # don't return just yet, there could be a command-specific prefix
+            # that could still match)
+            message = None
+
+        commands = []
+        groups = []
+        if message:
+            for key in self._keys(message):
+                commands.extend(self.by_word.get(key, ()))
+                groups.extend(self.groups.get(key, ()))
+            commands.extend(self.fallback)
+            groups.extend(self.group_fallback)
+
+        stripped = event.message.strip()
+        prefixes = self.prefixes_by_char.get(stripped[:1], [])
+        if self.match_all:
+            prefixes = prefixes + self.prefixes_by_char[""]
+        for prefix in prefixes:
+            if stripped.startswith(prefix):
+                commands.extend(self.by_prefix[prefix].get(
+                    _leading_word(stripped[len(prefix):]), ()))
+                commands.extend(self.prefix_fallback[prefix])
+
+        if not commands and not groups:
+            return
+
+        # Group the candidates by plugin, in the order they were installed.
+        # The same route may have been found under more than one key.
+        plugins = []
+        candidates = {}
+        for routes, index in ((commands, 0), (groups, 1)):
+            for _, plugin, item in sorted(dict((r[0], r) for r in routes).itervalues()):
+                if plugin not in candidates:
+                    plugins.append(plugin)
+                    candidates[plugin] = ([], [])
+                candidates[plugin][index].append(item)
+
+        loaded_plugins = self.pluginboss.loaded_plugins
+        for plugin in plugins:
+            cmds, cmdgs = candidates[plugin]
+            if loaded_plugins.get(plugin.plugin_name) is not plugin:
+                # This plugin failed to start, or was unloaded without being
+                # stopped
+                self.remove_plugin(plugin)
+                continue
+            try:
+                plugin._dispatch_commands(event, message, cmds, cmdgs)
+            except Exception:
+                # We don't want one plugin's errors to prevent other plugins
+                # from being called
+                import traceback
+                log.msg(traceback.format_exc())
+
 class CommandPluginSuperclass(BotPlugin):
     """This class is meant to be a superclass of plugins that wish to use the
     command abstractions. It is NOT to be installed as a plugin itself.
 
     It provides several things:
 
-    the install_command() function will install a command. This means the
-    plugin will listen to incoming irc.on_privmsg events, determine if it is a
-    command directed at this bot, verify permissions, and then call the
-    callback. See the documentation for the Command() class.
+    the install_command() function will install a command. This means
+    incoming irc.on_privmsg events will be checked (by the shared command
+    router) to determine if they are a command directed at this bot, then
+    permissions are verified, and then the callback is called. See the
+    documentation for the Command() class.
 
-    This plugin overrides on_event_irc_on_privmsg(), reload() and start(), so
-    if you implement these functions in a subclass, be sure to call the
-    superclass's method!
+    This plugin overrides reload(), so if you implement it in a subclass, be
+    sure to call the superclass's method! Command plugins no longer listen for
+    irc.on_privmsg themselves, so subclasses that want those events must call
+    self.listen_for_event("irc.on_privmsg").
 
     Use of the permissions in installed commands requires the use of the
     auth.Auth plugin.
@@ -311,14 +766,34 @@ class CommandPluginSuperclass(BotPlugin):
     def cmdgs(self):
         return self.__cmdgs
 
-    def start(self):
-        super(CommandPluginSuperclass, self).start()
-        self.listen_for_event("irc.on_privmsg")
+    @property
+    def command_generation(self):
+        """A number that changes whenever any command plugin installs commands
+        or is removed from the command router. Useful as part of a cache key
+        for anything computed from the installed commands.
+
+        """
+        return _CommandRouter.for_plugin(self).generation
+
+    @property
+    def command_stats(self):
+        """The dict mapping command names to abbott.stats.CommandStats objects,
+        shared by all command plugins
+
+        """
+        return _CommandRouter.for_plugin(self).command_stats
+
+    def stop(self):
+        super(CommandPluginSuperclass, self).stop()
+        # Drop our routes now, so the router doesn't hold on to this instance
+        # until a line happens to match one of its commands
+        _CommandRouter.for_plugin(self).remove_plugin(self)
 
     def reload(self):
         super(CommandPluginSuperclass, self).reload()
         commandconfig = self.pluginboss.config.get("command", {})
         self.__globalprefix = commandconfig.get("prefix", None)
+        _CommandRouter.for_plugin(self).reload(self.pluginboss.config)
 
     def install_cmdgroup(self,
             grpname,
@@ -363,49 +838,37 @@ class CommandPluginSuperclass(BotPlugin):
                 permission=permission,
                 helptext=helptext,
                 globalprefix=self.__globalprefix,
+                plugin=self,
+                router=_CommandRouter.for_plugin(self),
                 )
 
     def on_event_irc_on_privmsg(self, event):
-        """Checks to see if this is a command. If so, dispatch to the command
-        handler as appropriate.
+        """Commands are dispatched by the shared command router, which calls
+        _dispatch_commands(). This is kept so that subclasses that listen for
+        irc.on_privmsg themselves can still call the superclass's method.
 
         """
-        # dig deep to find the current nickname; we use it in a couple checks
-        # below
-        nick = self.pluginboss.loaded_plugins['irc.IRCBotPlugin'].client.nickname
+        pass
 
-        # First see if this looks like a command. A command takes the form of
-        # <botname>: <command>
-        # or
-        # <global prefix> <command>
-        message = event.message
+    def _dispatch_commands(self, event, message, cmds, cmdgs):
+        """Called by the command router with the commands and command groups of
+        this plugin that may match this event, in the order they were
+        installed. message is the event's message with the nick or global
+        prefix stripped, or None if it had neither and wasn't direct.
 
-        nickprefix = nick + ":"
-        globalprefix = self.__globalprefix.strip() if self.__globalprefix else None
-        if message.startswith(nickprefix):
-            message = message[len(nickprefix):].strip()
-        elif globalprefix and message.startswith(globalprefix):
-            message = message[len(globalprefix):].strip()
-        elif event.direct:
-            # Don't require a prefix if this was sent in a direct message to me
-            message = message
-        else:
-            # Don't match the command by itself... we require a prefix (but
-            # don't return just yet, there could be a command-specific prefix
-            # that could still match)
-            message = None
+        Dispatches to the command handler or help as appropriate.
 
-        # Look through all our defined commands to see if any match
-        for cmd in self.__cmds:
+        """
+        router = _CommandRouter.for_plugin(self)
+        # Look through the candidate commands to see if any match
+        for cmd in cmds:
             m = cmd.commandre.match(message) if message else None
-            if m:
-                self.__do_command(event, cmd, m)
-                return
-            if cmd.prefixre:
+            if not m and cmd.prefixre:
                 m = cmd.prefixre.match(event.message.strip())
-                if m:
+            if m:
+                if not router.ratelimited(event, cmd):
                     self.__do_command(event, cmd, m)
-                    return
+                return
             if message and cmd.helpre.match(message):
                 self.__do_help(event, cmd)
                 return
@@ -413,7 +876,7 @@ class CommandPluginSuperclass(BotPlugin):
         # No commands or help for a specific command matched, now check for a
         # match on help for a command group. These checks are done in reverse
         # order so that we always display the most specific help text we can.
-        for cmdg in reversed(self.__cmdgs):
+        for cmdg in reversed(cmdgs):
             if cmdg.helpre and message and cmdg.helpre.match(message):
                 self.__do_help(event, cmdg)
                 return
@@ -427,11 +890,46 @@ class CommandPluginSuperclass(BotPlugin):
 
         """
 
+        stats = _CommandRouter.for_plugin(self).stats_for(cmd.cmdname)
+
         if (yield event.has_permission(cmd.permission, event.channel)):
             log.msg("User %s is auth'd to perform %s" % (event.user, cmd.cmdname))
-            cmd.callback(event, match)
+
+            semaphore = cmd.semaphore
+            if semaphore is not None:
+                if not semaphore.tokens and len(semaphore.waiting) >= cmd.queue:
+                    log.msg("Too many %s commands running, rejecting" % cmd.cmdname)
+                    stats.queue_full += 1
+                    event.reply(notice=True, direct=True,
+                            msg="I'm busy with too many %s commands right now. Try again later" % cmd.cmdname)
+                    return
+                stats.queued += 1
+                try:
+                    yield semaphore.acquire()
+                finally:
+                    stats.queued -= 1
+
+            stats.invocations += 1
+            start = timer()
+            def done(result):
+                stats.latency.add(timer() - start, isinstance(result, Failure))
+                if semaphore is not None:
+                    semaphore.release()
+                return result
+            try:
+                result = cmd.callback(event, match)
+            except Exception:
+                done(Failure())
+                raise
+            if isinstance(result, defer.Deferred):
+                # Time inlineCallbacks callbacks and the like until they're
+                # done, and hold their concurrency slot until then too
+                result.addBoth(done)
+            else:
+                done(result)
         else:
             log.msg("User %s does not have permission for %s" % (event.user, cmd.cmdname))
+            stats.denials += 1
 
             # Before we reply with a scathing retort to the user that tried to
             # invoke a command they shouldn't, check to see if the user's
@@ -451,27 +949,10 @@ class CommandPluginSuperclass(BotPlugin):
             nick = nickmaps.get(nick, nick)
             
             authplugin = self.pluginboss.loaded_plugins['auth.Auth']
-            from .plugins.auth import satisfies
-            if nick in authplugin.permissions and authplugin.permissions[nick]:
-                perms = authplugin.permissions[nick]
-                # Now check if any permission in perms grants the required
-                # permission. Some of this code is swiped from the
-                # has_permission() method
-                for perm_channel, user_perm in perms:
-                    if not (
-                            perm_channel is None or
-                            perm_channel == event.channel
-                            ):
-                        continue
-                    if satisfies(user_perm, cmd.permission):
-                        event.reply("You would have access to this command, but you need to identify yourself first.")
-                        # Erase this user from the permission cache here, just
-                        # so they can identify and try again immediately
-                        try:
-                            del authplugin.authd_users[event.user]
-                        except KeyError:
-                            pass
-                        return
+            if authplugin.would_have_permission(event.user, nick,
+                    cmd.permission, event.channel):
+                event.reply("You would have access to this command, but you need to identify yourself first.")
+                return
 
             # Try the denied callback, if one exists
             if cmd.deniedcallback and cmd.deniedcallback(event, match):
@@ -488,7 +969,9 @@ class CommandPluginSuperclass(BotPlugin):
     @defer.inlineCallbacks
     def __do_help(self, event, cmd):
         """Send to the user help info about this command"""
-        nick = self.pluginboss.loaded_plugins['irc.IRCBotPlugin'].client.nickname
+        name = cmd.grpname if hasattr(cmd, "subcmds") else cmd.cmdname
+        _CommandRouter.for_plugin(self).stats_for(name).helps += 1
+        nick = _CommandRouter.for_plugin(self).current_nick()
         if hasattr(cmd, "subcmds"):
             # This is a command group
             for line in cmd.helplines:
@@ -498,8 +981,9 @@ class CommandPluginSuperclass(BotPlugin):
             cmds_with_access = []
             cmds_with_global_access = []
 
-            for subcmd in cmd.subcmds:
-                where = (yield event.where_permission(subcmd[1]))
+            wheres = (yield event.where_permissions(
+                [subcmd[1] for subcmd in cmd.subcmds]))
+            for subcmd, where in zip(cmd.subcmds, wheres):
                 if None in where:
                     cmds_with_global_access.append(subcmd[0])
                 elif where:
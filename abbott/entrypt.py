@@ -12,6 +12,7 @@ def main():
         sys.exit(1)
     transportobj = transport.Transport()
     boss = pluginbase.PluginBoss(sys.argv[1], transportobj)
+    transportobj.configure(boss.config['core'].get('transport', {}))
 
     observer = log.FileLogObserver(sys.stdout)
     observer.timeFormat = "%Y-%m-%d %H:%M:%S"
@@ -12,6 +12,8 @@ from twisted.internet import defer
 from twisted.internet import reactor
 from twisted.python import log
 
+from .transport import PRIORITY_NORMAL
+
 class PluginConfig(UserDict.UserDict):
     """Installed in plugins as self.config. Provides a dictionary-like
     interface with a method .save() to save to persistent storage. Uses a json
@@ -300,11 +302,13 @@ class BotPlugin(object):
     def install_middleware(self, matchstr):
         self.transport.install_middleware(matchstr, self)
 
-    def listen_for_event(self, matchstr):
-        self.transport.listen_for_event(matchstr, self)
+    def listen_for_event(self, matchstr, priority=PRIORITY_NORMAL):
+        self.transport.listen_for_event(matchstr, self, priority)
 
-    def provides_request(self, name):
-        self.transport.provides_request(name, self)
+    def provides_request(self, name, timeout=None, coalesce=False,
+            cache_ttl=None, invalidate_on=()):
+        self.transport.provides_request(name, self, timeout, coalesce,
+                cache_ttl, invalidate_on)
 
 class EventWatcher(object):
     """This is a mixin for plugins that adds event watching features, which
@@ -347,9 +351,8 @@ class EventWatcher(object):
             for event_match, d, timer in self.__watchers[event.eventtype]:
                 # Every attribute specified in the event_match template object must
                 # be equal to the corresponding attribute in the received event
-                for attr in dir(event_match):
-                    if attr.startswith("_"): continue
-                    if not hasattr(event, attr) or getattr(event_match, attr) != getattr(event, attr):
+                for attr, value in event_match.attributes().iteritems():
+                    if not hasattr(event, attr) or value != getattr(event, attr):
                         break
                 else:
                     # we have a match
@@ -427,6 +430,9 @@ def non_reentrant(**keyargs):
     Can only wrap methods which return a deferred or are decorated with
     defer.inlineCallbacks.
 
+    For request handlers, the coalesce option of provides_request() does the
+    same thing at the transport level, and also handles cancellation.
+
     keyargs is a dictionary mapping keyword argument names (in **kwargs) to the
     positional index (in *args), as a way of declaring the arguments you want
     part of the key.  The positional index can be None if the argument to key
@@ -462,18 +468,17 @@ def non_reentrant(**keyargs):
 
             # Now that we have a key by which to track invocations, check our
             # entrants dict
-            if key_arguments not in entrants:
-                entrants[key_arguments] = []
-
-                real_d = func(*args, **kwargs)
-                def done(param):
-                    waiters = entrants.pop(key_arguments)
-                    for _, other_d in waiters:
-                        other_d.callback(param)
-                real_d.addBoth(done)
-
             d = defer.Deferred()
-            entrants[key_arguments].append(d)
+            if key_arguments in entrants:
+                entrants[key_arguments].append(d)
+                return d
+
+            waiters = entrants[key_arguments] = [d]
+            def done(param):
+                del entrants[key_arguments]
+                for other_d in waiters:
+                    other_d.callback(param)
+            defer.maybeDeferred(func, *args, **kwargs).addBoth(done)
             return d
 
         return new_func
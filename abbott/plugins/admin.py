@@ -1,6 +1,5 @@
 from collections import defaultdict, deque
 import time
-import re
 import random
 
 from twisted.internet import reactor
@@ -8,26 +7,11 @@ from twisted.python import log
 from twisted.internet import defer
 
 from ..command import CommandPluginSuperclass, require_channel
-from ..transport import Event
+from ..cmdargs import Arg
+from ..transport import Event, RequestTimedOut
 from . import ircutil
 from . import ircop
 
-duration_match = r"(?P<duration>\d+[dhmsw])"
-def parse_time(timestr):
-    duration = 0
-    multipliers = {
-            's': 1,
-            'm': 60,
-            'h': 60*60,
-            'd': 60*60*24,
-            'w': 60*60*24*7,
-            }
-    for component in re.findall(duration_match, timestr):
-        t, unit = component[:-1], component[-1]
-        duration += int(t) * multipliers[unit]
-
-    return duration
-
 class IRCAdmin(CommandPluginSuperclass):
     """Provides a command interface to IRC operator tasks. Uses the plugins in
     the ircop module to perform the operations.
@@ -35,6 +19,10 @@ class IRCAdmin(CommandPluginSuperclass):
     """
     REQUIRES = ["ircop.OpProvider"]
 
+    # Seconds to wait for a whois, including any time it spends queued behind
+    # other whois requests. Whoever asked for the ban is waiting on it.
+    whois_deadline = 30
+
     def __init__(self, *args):
         self.started = False
 
@@ -239,7 +227,10 @@ class IRCAdmin(CommandPluginSuperclass):
                 cmdname="quiet",
                 cmdmatch="quiet|QUIET|mute",
                 cmdusage="<nick or hostmask> [for <duration>]",
-                argmatch = "(?P<nick>[^ ]+)(?: (?:for )?{0}+)?$".format(duration_match),
+                args=[
+                    Arg("nick", "hostmask"),
+                    Arg("duration", "duration", optional=True, keyword="for"),
+                    ],
                 prefix=".",
                 permission="irc.op.quiet",
                 callback=self.quiet,
@@ -251,7 +242,10 @@ class IRCAdmin(CommandPluginSuperclass):
                 cmdname="unquiet",
                 cmdmatch="unquiet|UNQUIET|unmute",
                 cmdusage="<nick or hostmask> [in <delay>]",
-                argmatch = "(?P<nick>[^ ]+)(?: (?:in )?{0}+)?$".format(duration_match),
+                args=[
+                    Arg("nick", "hostmask"),
+                    Arg("duration", "duration", optional=True, keyword="in"),
+                    ],
                 prefix=".",
                 permission="irc.op.quiet",
                 callback=self.unquiet,
@@ -263,7 +257,11 @@ class IRCAdmin(CommandPluginSuperclass):
                 cmdname="ban",
                 cmdmatch="ban|BAN",
                 cmdusage="<nick or hostmask> [for <duration>] [reason]",
-                argmatch = "(?P<nick>[^ ]+)(?: (?:for )?{0}+)?(?: (?P<reason>.+))?$".format(duration_match),
+                args=[
+                    Arg("nick", "hostmask"),
+                    Arg("duration", "duration", optional=True, keyword="for"),
+                    Arg("reason", "rest", optional=True),
+                    ],
                 prefix=".",
                 permission="irc.op.ban",
                 callback=self.ban,
@@ -274,7 +272,10 @@ class IRCAdmin(CommandPluginSuperclass):
                 cmdname="unban",
                 cmdmatch="unban|UNBAN",
                 cmdusage="<nick or hostmask> [in <delay>]",
-                argmatch = "(?P<nick>[^ ]+)(?: (?:in )?{0}+)?$".format(duration_match),
+                args=[
+                    Arg("nick", "hostmask"),
+                    Arg("duration", "duration", optional=True, keyword="in"),
+                    ],
                 prefix=".",
                 permission="irc.op.ban",
                 callback=self.unban,
@@ -303,7 +304,11 @@ class IRCAdmin(CommandPluginSuperclass):
             defer.returnValue(nick)
             return
 
-        whois_results = (yield self.transport.issue_request("irc.whois", nick))
+        try:
+            whois_results = (yield self.transport.issue_request_within(
+                self.whois_deadline, "irc.whois", nick))
+        except RequestTimedOut:
+            raise ircutil.WhoisTimedout("No whois response in time")
 
         whoisuser = whois_results['RPL_WHOISUSER']
 
@@ -481,8 +486,8 @@ class IRCAdmin(CommandPluginSuperclass):
     @defer.inlineCallbacks
     def _do_moderequest(self, mode, reply, nick, duration, channel):
         """Does the work to set a mode on a nick (or hostmask) in a channel for
-        an optional duration. If duration is None, we will not set it back
-        after any length of time.
+        an optional duration in seconds. If duration is None, we will not set
+        it back after any length of time.
 
         reply is used to send error messages. It should take a string.
 
@@ -515,8 +520,6 @@ class IRCAdmin(CommandPluginSuperclass):
             return
 
         if duration:
-            if isinstance(duration, basestring):
-                duration = parse_time(duration)
             self._set_timer(duration, mask, channel, mode)
 
     @require_channel
@@ -549,8 +552,6 @@ class IRCAdmin(CommandPluginSuperclass):
             return
 
         if duration:
-            if isinstance(duration, basestring):
-                duration = parse_time(duration)
             self._set_timer(duration, mask, channel, mode)
             reply("It shall be done")
             return
@@ -4,11 +4,13 @@ import re
 from itertools import chain
 
 from twisted.python import log
-from twisted.internet import defer, reactor
+from twisted.internet import defer
 
 from .. import command
+from ..cache import TTLCache
 from ..transport import Event
 from . import ircutil
+from .irc import UnknownAccount
 
 def satisfies(user_perm, auth_perm):
     """Does the user permission satisfy the required auth_perm?
@@ -50,23 +52,162 @@ def satisfies(user_perm, auth_perm):
         return True
     return False
 
+class PermissionTrie(object):
+    """A compiled list of [channel, permission] grants. Answers which
+    channels a permission is granted in, by the same rules as satisfies(),
+    without comparing it against every grant.
+
+    Granted permissions are stored in a trie keyed by their dot separated
+    segments. Segments with globs are kept apart on each node, compiled to
+    regular expressions. A lookup walks the segments of the required
+    permission down the trie; each grant ending at a node on the way grants
+    the permission.
+
+    """
+    __slots__ = ("children", "globs", "channels")
+
+    def __init__(self, grants=()):
+        # Maps literal segments to child tries
+        self.children = {}
+        # Maps glob segments to (compiled regex, child trie) pairs
+        self.globs = {}
+        # Channels a grant ending at this node applies to, None for globally
+        self.channels = set()
+        for channel, permission in grants:
+            self.add(permission, channel)
+
+    def add(self, permission, channel=None):
+        node = self
+        for segment in permission.split("."):
+            if "*" in segment:
+                try:
+                    _, node = node.globs[segment]
+                except KeyError:
+                    regex = re.compile("[^.]*".join(
+                        re.escape(x) for x in segment.split("*")) + "$")
+                    child = PermissionTrie()
+                    node.globs[segment] = (regex, child)
+                    node = child
+            else:
+                child = node.children.get(segment)
+                if child is None:
+                    child = node.children[segment] = PermissionTrie()
+                node = child
+        node.channels.add(channel)
+
+    def channels_for(self, permission):
+        """Returns the set of channels `permission` is granted in, with None
+        standing for everywhere
+
+        """
+        channels = set()
+        nodes = [self]
+        for segment in permission.split("."):
+            matched = []
+            for node in nodes:
+                child = node.children.get(segment)
+                if child is not None:
+                    matched.append(child)
+                for regex, child in node.globs.itervalues():
+                    if regex.match(segment):
+                        matched.append(child)
+            if not matched:
+                break
+            for node in matched:
+                channels.update(node.channels)
+            nodes = matched
+        return channels
+
+    def granted(self, permission, channel):
+        """Is `permission` granted in `channel`, either there or globally?"""
+        channels = self.channels_for(permission)
+        return None in channels or channel in channels
+
+class IdentityCache(TTLCache):
+    """Remembers which authname each user was identified as, so they don't
+    have to be whoised for every command.
+
+    Entries are keyed by nick, since a nick belongs to one user at a time,
+    and each remembers the hostmask it was looked up for; a lookup for a
+    different hostmask with the same nick is a miss. This makes it cheap to
+    forget a user when they change nicks, quit, or log in or out.
+
+    Users who couldn't be identified are remembered for negative_ttl seconds,
+    so they can identify and try again soon. Expired entries are dropped
+    when looked up or pushed out by newer ones, so no timers are needed.
+
+    """
+    def __init__(self, ttl, negative_ttl, maxsize, clock=None):
+        super(IdentityCache, self).__init__(ttl, maxsize=maxsize, clock=clock)
+        self.negative_ttl = negative_ttl
+
+    def lookup(self, hostmask):
+        """Returns the authname the user was identified as, None if they
+        couldn't be, or raises KeyError if they haven't been looked up
+
+        """
+        nick = hostmask.split("!", 1)[0]
+        known_hostmask, authname = self[nick]
+        if known_hostmask != hostmask:
+            # Somebody else had this nick. That's a miss, not a hit.
+            self.hits -= 1
+            self.misses += 1
+            del self[nick]
+            raise KeyError(hostmask)
+        return authname
+
+    def store(self, hostmask, authname):
+        self.set(hostmask.split("!", 1)[0], (hostmask, authname),
+                None if authname is not None else self.negative_ttl)
+
+    def forget(self, user):
+        """Forgets the user with the given nick or hostmask"""
+        self.pop(user.split("!", 1)[0])
+
 class Auth(command.CommandPluginSuperclass):
     """Auth plugin.
 
     Provides a reliable set of permissions other plugins can rely on. For
     certain irc events, installs a has_permission() callback which can be used
     to query if a user has a particular permission.
+
+    Each user's permissions, together with the default permissions, are
+    compiled into a PermissionTrie the first time they're needed. Permission
+    decisions are also memoized per (authname, permission, channel), since
+    the same few commands get checked for the same few users over and over.
+    Both are keyed by authname, not hostmask, so they need no invalidation
+    when a user's identity changes; they are thrown away whenever
+    permissions or default permissions are changed.
     
     """
+    # Incremented whenever permissions change. See _forget_decisions()
+    generation = 0
+
+    # How long to remember who a user is identified as, when we had to whois
+    # them. Users who aren't identified are whoised again sooner.
+    identity_ttl = 60*60
+    negative_identity_ttl = 60
+    identity_cache_size = 2000
+
+    # Marks replies to our WHOX queries. Any number of up to three digits.
+    whox_token = "472"
+
     def start(self):
         super(Auth, self).start()
 
         # Install a middleware hook for all irc events
         self.install_middleware("irc.on_*")
 
-        # maps hostmasks to authenticated usernames, or None to indicate the
-        # user doesn't have any auth information
-        self.authd_users = {}
+        # Remembers the authnames of users we had to whois, or None for users
+        # without any auth information
+        self.authd_users = IdentityCache(self.identity_ttl,
+                self.negative_identity_ttl, self.identity_cache_size)
+        self.listen_for_event("irc.on_nick_change")
+        self.listen_for_event("irc.on_user_quit")
+        self.listen_for_event("irc.on_account_change")
+        self.listen_for_event("irc.on_join")
+        self.listen_for_event("irc.on_unknown")
+        self.provides_request("auth.identities")
 
         permgroup = self.install_cmdgroup(
                 grpname="permission",
@@ -169,32 +310,38 @@ class Auth(command.CommandPluginSuperclass):
                 ]:
             event.has_permission = functools.partial(self._has_permission, event.user)
             event.where_permission = functools.partial(self._where_permission, event.user)
+            event.where_permissions = functools.partial(self._where_permissions, event.user)
+            event.get_authname = functools.partial(self._get_authname, event.user)
 
         return event
 
 
     @defer.inlineCallbacks
-    def _get_permissions(self, hostmask):
-        """This function returns the permissions granted to the given user,
-        identifying them in the process by doing a whois lookup if necessary.
+    def _get_authname(self, hostmask):
+        """Identifies the given user, doing a whois lookup if necessary.
 
         It returns a deferred object. The parameter to the deferred callback is
-        a list of (channel, permissionstr) the user has, or an empty list of the
-        user does not have any permissions or the user could not be identified.
-        It does NOT include any default permissions, only permissions
-        explicitly granted to the user.
-        
-        This method may send a whois to the server, in which case it looks for
-        an IRC 330 command back from the server indicating the user's authname
+        the user's authname, or None if the user could not be identified.
 
-        """
-        # Check if the user is already identified by a previous whois
-        if hostmask in self.authd_users:
-            authname = self.authd_users[hostmask]
+        The IRC plugin's account tracking is asked first. If the server doesn't
+        support it, this method may send a whois to the server, in which case
+        it looks for an IRC 330 command back from the server indicating the
+        user's authname
 
+        """
+        try:
+            authname = (yield self.transport.issue_request("irc.account", hostmask))
+        except (UnknownAccount, NotImplementedError):
+            pass
         else:
-            # No cached entry for that hostmask in authd_users. Do a whois and look
-            # it up.
+            defer.returnValue(authname)
+            return
+
+        # Check if the user is already identified by a previous whois
+        try:
+            authname = self.authd_users.lookup(hostmask)
+        except KeyError:
+            # No cached entry for that user. Do a whois and look it up.
             log.msg("Permission request for %s, but I don't know the authname. Doing a whois" % (hostmask,))
             nick = hostmask.split("!")[0]
             try:
@@ -203,23 +350,159 @@ class Auth(command.CommandPluginSuperclass):
                 log.msg("Whois failed: %s" % e)
                 whois_info = {}
 
-            if "330" not in whois_info:
-                # No auth information. Cache this value for one minute
-                authname = None
-                self.authd_users[hostmask] = None
-                def cacheprune():
-                    if hostmask in self.authd_users and self.authd_users[hostmask] == None:
-                        del self.authd_users[hostmask]
-                reactor.callLater(60, cacheprune)
+            # No 330 means no auth information
+            authname = whois_info["330"][1] if "330" in whois_info else None
+            self.authd_users.store(hostmask, authname)
 
-            else:
-                authname = self.authd_users[hostmask] = whois_info["330"][1]
+        defer.returnValue(authname)
+
+    ### Events that make cached identities stale
+    def on_event_irc_on_nick_change(self, event):
+        self.authd_users.forget(event.oldnick)
+
+    def on_event_irc_on_user_quit(self, event):
+        self.authd_users.forget(event.user)
+
+    def on_event_irc_on_account_change(self, event):
+        self.authd_users.forget(event.user)
+
+    ### Identifying everyone in a channel at once
+    @defer.inlineCallbacks
+    def on_event_irc_on_join(self, event):
+        """When we join a channel, identify everyone in it with a single WHOX
+        query, instead of a whois for each user when they first use a
+        command. Servers without WHOX don't get the query, and their users
+        are whoised as needed.
+
+        """
+        try:
+            whox = (yield self.transport.issue_request("irc.supports", "WHOX"))
+        except NotImplementedError:
+            whox = False
+        if not whox:
+            return
+        log.msg("Identifying the users in %s with WHOX" % event.channel)
+        self.transport.send_event(Event("irc.do_raw",
+            line="WHO %s %%tuhna,%s" % (event.channel, self.whox_token)))
+
+    def on_event_irc_on_unknown(self, event):
+        """Replies to our WHOX queries come in as 354 lines, with the fields
+        we asked for in a fixed order: token, username, host, nick, account.
+        The account is 0 for users who aren't logged in.
+
+        """
+        params = event.params
+        if (event.command == "354" and len(params) == 6 and
+                params[1] == self.whox_token):
+            _, _, username, host, nick, account = params
+            self.authd_users.store("%s!%s@%s" % (nick, username, host),
+                    None if account == "0" else account)
+
+    def on_request_auth_identities(self):
+        """Returns the IdentityCache, for stats"""
+        return self.authd_users
 
+    @defer.inlineCallbacks
+    def _get_permissions(self, hostmask):
+        """This function returns the permissions granted to the given user,
+        identifying them in the process by doing a whois lookup if necessary.
+
+        It returns a deferred object. The parameter to the deferred callback is
+        a list of (channel, permissionstr) the user has, or an empty list of the
+        user does not have any permissions or the user could not be identified.
+        It does NOT include any default permissions, only permissions
+        explicitly granted to the user.
+
+        """
+        authname = (yield self._get_authname(hostmask))
         # authname could be none, indicating a recent whois for that
         # hostmask didn't return any auth info
         perms = self.permissions[authname] if authname else []
         defer.returnValue(perms)
 
+    def _forget_decisions(self):
+        """Forgets all compiled permissions and memoized permission
+        decisions. Called whenever permissions change.
+
+        generation is incremented every time, so other plugins caching
+        something computed from permissions can tell when it's stale.
+
+        """
+        self.decisions = {}
+        self.where_decisions = {}
+        self.compiled = {}
+        self.generation += 1
+
+    def _compiled_permissions(self, authname):
+        """Returns the PermissionTrie of the permissions the user with the
+        given authname has, including the default permissions
+
+        """
+        try:
+            return self.compiled[authname]
+        except KeyError:
+            pass
+        user_perms = self.permissions.get(authname, []) if authname else []
+        trie = self.compiled[authname] = PermissionTrie(
+                chain(user_perms, self.config['defaultperms']))
+        return trie
+
+    def authname_has_permission(self, authname, permission, channel):
+        """Does the user with the given authname have `permission` in
+        `channel`? authname may be None for an unidentified user, who only has
+        the default permissions. Unlike event.has_permission(), this returns
+        the answer directly. Decisions are memoized.
+
+        """
+        if permission == None:
+            return True
+
+        key = (authname, permission, channel)
+        try:
+            return self.decisions[key]
+        except KeyError:
+            pass
+
+        decision = self._compiled_permissions(authname).granted(permission, channel)
+        self.decisions[key] = decision
+        return decision
+
+    def authname_where_permission(self, authname, permission):
+        """Returns the set of channels where the user with the given authname
+        has `permission`, with None standing for everywhere. Like
+        authname_has_permission(), this returns the answer directly and
+        memoizes it.
+
+        """
+        if permission == None:
+            return set([None])
+
+        key = (authname, permission)
+        try:
+            return set(self.where_decisions[key])
+        except KeyError:
+            pass
+
+        channels = self._compiled_permissions(authname).channels_for(permission)
+        self.where_decisions[key] = frozenset(channels)
+        return channels
+
+    def would_have_permission(self, hostmask, authname, permission, channel):
+        """Called when the user identified by hostmask was denied
+        `permission`. Returns True if they would have had it had they been
+        identified as `authname`, which is usually their nick.
+
+        If so, their cached identity is dropped so they can identify and try
+        again immediately.
+
+        """
+        if not self.permissions.get(authname):
+            return False
+        if not self.authname_has_permission(authname, permission, channel):
+            return False
+        self.authd_users.forget(hostmask)
+        return True
+
     @defer.inlineCallbacks
     def _has_permission(self, hostmask, permission, channel):
         """Asks if the user identified by hostmask has the given permission
@@ -238,24 +521,8 @@ class Auth(command.CommandPluginSuperclass):
             defer.returnValue(True)
             return
 
-        user_perms = (yield self._get_permissions(hostmask))
-
-        for perm_channel, user_perm in chain(user_perms, self.config['defaultperms']):
-            # Does perm_channel apply to `channel`?
-            if not (
-                    # One of these must be true for this permission to
-                    # apply here.
-                    perm_channel is None or
-                    perm_channel == channel
-                    ):
-                continue
-
-            # Does user_perm satisfy `permission`?
-
-            if satisfies(user_perm, permission):
-                defer.returnValue(True)
-                return
-        defer.returnValue(False)
+        authname = (yield self._get_authname(hostmask))
+        defer.returnValue(self.authname_has_permission(authname, permission, channel))
 
     @defer.inlineCallbacks
     def _where_permission(self, hostmask, permission):
@@ -276,28 +543,38 @@ class Auth(command.CommandPluginSuperclass):
             defer.returnValue([None])
             return
 
-        user_perms = (yield self._get_permissions(hostmask))
+        authname = (yield self._get_authname(hostmask))
+        defer.returnValue(self.authname_where_permission(authname, permission))
 
-        channels = set()
-        for perm_channel, user_perm in chain(user_perms, self.config['defaultperms']):
+    @defer.inlineCallbacks
+    def _where_permissions(self, hostmask, permissions):
+        """Like _where_permission(), but for a list of permissions at once.
+        The user is only identified once, so this is much cheaper than calling
+        where_permission() for each one.
 
-            # If the user's permission user_perm grants `permission`, add
-            # `perm_channel` to the channel set
-            if satisfies(user_perm, permission):
-                channels.add(perm_channel)
+        This function is installed on event objects as
+        event.where_permissions(), partially evaluated with the hostname.
 
-        defer.returnValue(channels)
+        This returns a deferred. It produces a list of sets of channels, one
+        for each permission in `permissions`, in the same order.
+
+        """
+        authname = (yield self._get_authname(hostmask))
+        defer.returnValue([self.authname_where_permission(authname, permission)
+            for permission in permissions])
 
     def _save(self):
         # Make a copy... don't store the defaultdict (probably wouldn't matter though)
         self.config['perms'] = dict(self.permissions)
         self.config.save()
+        self._forget_decisions()
 
     ### Reload event
     def reload(self):
         super(Auth, self).reload()
         self.permissions = defaultdict(list)
         self.permissions.update(self.config.get('perms', {}))
+        self._forget_decisions()
 
     ### The command plugin callbacks, installed above
 
@@ -351,9 +628,10 @@ class Auth(command.CommandPluginSuperclass):
             msgstr = "user %s has" % name
         else:
             # Get info about the current user
-            perms = list((yield self._get_permissions(event.user)))
-            if self.authd_users.get(event.user, None):
-                event.reply("You are identified as %s" % self.authd_users[event.user])
+            authname = (yield self._get_authname(event.user))
+            perms = list(self.permissions[authname]) if authname else []
+            if authname:
+                event.reply("You are identified as %s" % authname)
             else:
                 event.reply("I don't know who you are")
             msgstr = "you have"
@@ -397,6 +675,7 @@ class Auth(command.CommandPluginSuperclass):
         if [channel, permission] not in self.config['defaultperms']:
             self.config['defaultperms'].append([channel, permission])
             self.config.save()
+            self._forget_decisions()
             if channel:
                 event.reply("Done! Everybody now has %s in %s!" % (permission, channel))
             else:
@@ -414,6 +693,7 @@ class Auth(command.CommandPluginSuperclass):
             event.reply("That permission is not in the default list")
         else:
             self.config.save()
+            self._forget_decisions()
             event.reply("Done. Revoked.")
 
     def list_default(self, event, match):
@@ -42,6 +42,7 @@ class RunCommand(CommandPluginSuperclass):
                 )
 
     def stop(self):
+        super(RunCommand, self).stop()
         if self.currentprocess:
             self.currentprocess.transport.signalProcess("KILL")
 
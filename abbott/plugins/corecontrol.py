@@ -3,6 +3,7 @@ from collections import defaultdict
 from twisted.internet import reactor, defer
 
 from ..command import CommandPluginSuperclass
+from ..cache import TTLCache
 
 class CoreControl(CommandPluginSuperclass):
     def start(self):
@@ -23,6 +24,21 @@ class CoreControl(CommandPluginSuperclass):
                 helptext="Re-reads the config on disk and updates in-memory configuration",
                 )
 
+        self.install_command(
+                cmdname="stats",
+                cmdusage="[reset | caches | commands | <plugin name>]",
+                argmatch=r"(?P<arg>[^ ]+)?$",
+                permission="core.stats",
+                callback=self.display_stats,
+                helptext="Shows which plugins' event handlers, requests and commands take the most time",
+                )
+
+        self.provides_request("core.stats")
+
+    def on_request_core_stats(self):
+        """Returns the transport's abbott.stats.Stats object"""
+        return self.transport.stats
+
     def shutdown(self, event, match):
         event.reply("Goodbye")
         reactor.callLater(2, reactor.stop)
@@ -37,6 +53,66 @@ class CoreControl(CommandPluginSuperclass):
         for plugin in self.pluginboss.loaded_plugins.itervalues():
             plugin.reload()
         event.reply("Config reloaded!")
+
+    @defer.inlineCallbacks
+    def display_stats(self, event, match):
+        stats = self.transport.stats
+        arg = match.groupdict()['arg']
+        if arg == "reset":
+            stats.reset()
+            self.command_stats.clear()
+            event.reply("Stats reset")
+            return
+
+        if arg == "commands":
+            commands = sorted(self.command_stats.iteritems(),
+                    key=lambda item: item[1].latency.total, reverse=True)
+            if not commands:
+                event.reply("No commands have been used yet")
+            for cmdname, cmdstats in commands[:10]:
+                event.reply("%s: %s" % (cmdname, cmdstats.format()))
+            return
+
+        if arg == "caches":
+            caches = self.transport.request_caches()
+            if not caches:
+                event.reply("No requests are cached")
+            for name, cache in sorted(caches.iteritems()):
+                event.reply("%s: %s" % (name, cache.format()))
+            # Caches plugins keep for themselves
+            for label, request in [
+                    ("auth identities", "auth.identities"),
+                    ("irc whois", "irc.whois_cache"),
+                    ]:
+                try:
+                    cache = (yield self.transport.issue_request(request))
+                except NotImplementedError:
+                    continue
+                event.reply("%s: %s" % (label, cache.format()))
+            return
+
+        if arg:
+            top = stats.top(10, plugin_name=arg)
+            if not top:
+                event.reply("I have no stats for a plugin named %s" % arg)
+                return
+            for (_, kind, name), histogram in top:
+                event.reply("%s %s: %s" % (kind, name, histogram.format()))
+            return
+
+        by_plugin = sorted(stats.by_plugin().iteritems(),
+                key=lambda item: item[1].total, reverse=True)
+        if not by_plugin:
+            event.reply("No stats recorded yet")
+            return
+        event.reply("Busiest plugins:")
+        for plugin_name, histogram in by_plugin[:5]:
+            event.reply("%s: %.2fs total, %s" % (plugin_name, histogram.total,
+                histogram.format()))
+        event.reply("Busiest handlers:")
+        for (plugin_name, kind, name), histogram in stats.top(5):
+            event.reply("%s %s %s: %s" % (plugin_name, kind, name,
+                histogram.format()))
         
 class Help(CommandPluginSuperclass):
     def start(self):
@@ -51,10 +127,20 @@ class Help(CommandPluginSuperclass):
                 cmdmatch="help$",
                 callback=self.display_help,
                 helptext="Help on the help command. Displays a helpful help message about help, helps you help yourself use help. Helpful, huh?",
+                # Help is a lot of lines
+                ratelimit={"user": (2, 60)},
                 )
 
+        self.help_cache = TTLCache(ttl=3600, maxsize=100)
+
     @defer.inlineCallbacks
-    def display_help(self, event, match):
+    def _commands_for(self, event):
+        """Returns a deferred that fires with a list of the commands the
+        event's user may use globally, and a dict mapping channels to lists of
+        commands they may use in that channel. The permissions are all looked
+        up in one go.
+
+        """
         command_groups = []
         for plugin in self.pluginboss.loaded_plugins.itervalues():
             try:
@@ -62,6 +148,9 @@ class Help(CommandPluginSuperclass):
             except AttributeError:
                 pass
 
+        permissions = [cmd[1] for group in command_groups for cmd in group.subcmds]
+        wheres = iter((yield event.where_permissions(permissions)))
+
         globalcommands = []
         channelcommands = defaultdict(list)
 
@@ -70,9 +159,9 @@ class Help(CommandPluginSuperclass):
                 # This is a group of top-level commands. List each command
                 # individually
                 for cmd in group.subcmds:
-                    # Get a list of channels where this permission applies for
-                    # this user
-                    where = (yield event.where_permission(cmd[1]))
+                    # The channels where this permission applies for this
+                    # user
+                    where = next(wheres)
                     if None in where:
                         globalcommands.append(cmd[0])
                     else:
@@ -85,7 +174,7 @@ class Help(CommandPluginSuperclass):
                 # metacommand
                 chans = set()
                 for cmd in group.subcmds:
-                    chans.update((yield event.where_permission(cmd[1])))
+                    chans.update(next(wheres))
 
                 if None in chans:
                     globalcommands.append(group.grpname)
@@ -93,6 +182,25 @@ class Help(CommandPluginSuperclass):
                     for channel in chans:
                         channelcommands[channel].append(group.grpname)
 
+        defer.returnValue((globalcommands, dict(channelcommands)))
+
+    @defer.inlineCallbacks
+    def display_help(self, event, match):
+        # Which commands a user may see only changes when commands or
+        # permissions do, so the lists are cached per authname
+        authname = (yield event.get_authname())
+        key = (
+                authname,
+                self.pluginboss.loaded_plugins['auth.Auth'].generation,
+                self.command_generation,
+                frozenset(self.pluginboss.loaded_plugins),
+                )
+        try:
+            globalcommands, channelcommands = self.help_cache[key]
+        except KeyError:
+            globalcommands, channelcommands = (yield self._commands_for(event))
+            self.help_cache[key] = (globalcommands, channelcommands)
+
         try:
             prefix = self.pluginboss.config['command']['prefix']
         except KeyError:
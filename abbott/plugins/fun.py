@@ -8,7 +8,7 @@ from twisted.python import log
 
 from ..pluginbase import BotPlugin
 from ..command import CommandPluginSuperclass
-from ..transport import Event
+from ..transport import Event, PRIORITY_BEST_EFFORT
 
 """
 This module has miscellaneous fun plugins that don't do anything useful
@@ -20,7 +20,6 @@ class RMSPlugin(CommandPluginSuperclass):
 
     def start(self):
         super(RMSPlugin, self).start()
-        self.recent = {}
         self.install_command(
                 cmdname="rmsify",
                 callback=self.rmsify,
@@ -28,18 +27,12 @@ class RMSPlugin(CommandPluginSuperclass):
                 argmatch=r"(?P<text>.+)$",
                 permission=None,
                 helptext="RMS a thing",
+                ratelimit={"user": (1, self.timeout)},
                 )
 
     def rmsify(self, event, match):
-        user=event.user
         thing = match.groupdict()['text']
 
-        if time.time() < self.recent.get(user, 0)+self.timeout:
-            event.reply("Try again later")
-            return
-        else:
-            self.recent[user] = time.time()
-
         quote = u"""
 I’d just like to interject for a moment. What you’re refering to as {0}, is in fact, GNU/{0}, or as I’ve recently taken to calling it, GNU plus {0}.
 {1} is not an operating system unto itself, but rather another free component of a fully functioning GNU system made useful by the GNU corelibs, shell utilities and vital system components comprising a full OS as defined by POSIX.
@@ -63,7 +56,7 @@ class Repeater(BotPlugin):
     chance = 0.7
 
     def start(self):
-        self.listen_for_event("irc.on_privmsg")
+        self.listen_for_event("irc.on_privmsg", PRIORITY_BEST_EFFORT)
 
         self.lastline = None
         self.lasttime = 0
@@ -109,6 +102,8 @@ class Reverse(CommandPluginSuperclass):
         super(Reverse, self).start()
 
         self.on = False
+        # The event that last toggled the polarity. It isn't reversed itself.
+        self.toggle_event = None
 
         self.install_middleware("irc.do_msg")
         self.listen_for_event("irc.on_privmsg")
@@ -122,6 +117,7 @@ class Reverse(CommandPluginSuperclass):
 
     def reverse(self, event, match):
         self.on = not self.on
+        self.toggle_event = event
         event.reply("Polarity reversed!")
         
     def on_middleware_irc_do_msg(self, event):
@@ -133,17 +129,15 @@ class Reverse(CommandPluginSuperclass):
 
     def on_event_irc_on_privmsg(self, event):
 
-        if self.on and not hasattr(event, "_reversed"):
-            revent = Event("irc.on_privmsg")
-            revent.__dict__.update(event.__dict__)
+        # The command router may run the command that turned this on before
+        # this handler, so check for that to avoid loopbacks
+        if (self.on and not hasattr(event, "_reversed") and
+                event is not self.toggle_event):
+            revent = Event("irc.on_privmsg", **event.attributes())
             revent.message = revent.message[::-1]
             revent._reversed = True
             self.transport.send_event(revent)
 
-        # Do this second. This will process the command, turning it on, so this
-        # needs to go here to avoid loopbacks
-        super(Reverse, self).on_event_irc_on_privmsg(event)
-
 class Sneeze(BotPlugin):
 
     def start(self):
@@ -151,7 +145,7 @@ class Sneeze(BotPlugin):
 
         self.timers = {}
 
-        self.listen_for_event("irc.on_privmsg")
+        self.listen_for_event("irc.on_privmsg", PRIORITY_BEST_EFFORT)
 
     def stop(self):
         super(Sneeze, self).stop()
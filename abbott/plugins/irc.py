@@ -7,7 +7,7 @@ from twisted.internet.ssl import ClientContextFactory
 from twisted.python import log
 
 from ..pluginbase import BotPlugin
-from ..transport import Event
+from ..transport import Event, declare_event, new_event
 from ..command import CommandPluginSuperclass
 
 """
@@ -17,6 +17,65 @@ twisted Protocol-derived object (IRCBot) used in conjunction with IRCBotPlugin
 
 """
 
+# Compact classes for the events emitted by the IRCBotPlugin, one per line
+# from the server, with the attributes documented in the plugin docs. Some
+# also carry attributes inserted by middleware: auth.Auth adds has_permission,
+# where_permission, where_permissions and get_authname, and
+# ircutil.ReplyInserter adds reply.
+_AUTH_ATTRS = ("has_permission", "where_permission", "where_permissions",
+        "get_authname")
+declare_event("irc.on_join", "channel")
+declare_event("irc.on_part", "channel")
+declare_event("irc.on_kicked", "channel", "kicker", "message")
+declare_event("irc.on_disconnected")
+declare_event("irc.on_privmsg", "user", "channel", "message", "direct",
+        "reply", *_AUTH_ATTRS)
+declare_event("irc.on_notice", "user", "channel", "message")
+declare_event("irc.on_mode_change", "user", "channel", "set", "mode", "arg")
+declare_event("irc.on_user_joined", "user", "channel", *_AUTH_ATTRS)
+declare_event("irc.on_user_part", "user", "channel")
+declare_event("irc.on_user_quit", "user", "message")
+declare_event("irc.on_user_kick", "kickee", "channel", "kicker", "message")
+declare_event("irc.on_action", "user", "channel", "data", *_AUTH_ATTRS)
+declare_event("irc.on_topic_updated", "user", "channel", "newtopic", *_AUTH_ATTRS)
+declare_event("irc.on_nick_change", "oldnick", "newnick")
+declare_event("irc.on_nick_set", "nick")
+declare_event("irc.on_account_change", "user", "account")
+declare_event("irc.on_unknown", "prefix", "command", "params")
+
+class UnknownAccount(Exception):
+    """The irc.account request doesn't know which account a user is logged in
+    to, either because the server doesn't support account tracking or
+    because we haven't seen the user yet. Fall back to a whois.
+
+    """
+    pass
+
+_tag_escapes = {":": ";", "s": " ", "\\": "\\", "r": "\r", "n": "\n"}
+
+def parse_tags(tags):
+    """Parses the IRCv3 message tags at the start of a line (without the
+    leading @) into a dict. Tags without a value map to an empty string.
+
+    """
+    parsed = {}
+    for tag in tags.split(";"):
+        key, _, value = tag.partition("=")
+        if "\\" in value:
+            chars = []
+            escaped = False
+            for c in value:
+                if escaped:
+                    chars.append(_tag_escapes.get(c, c))
+                    escaped = False
+                elif c == "\\":
+                    escaped = True
+                else:
+                    chars.append(c)
+            value = "".join(chars)
+        parsed[key] = value
+    return parsed
+
 class IRCBot(irc.IRCClient):
     """This is the IRC protocol object (not a bot plugin). One of these objects
     is created per connection to an IRC server by the Factory object
@@ -24,7 +83,16 @@ class IRCBot(irc.IRCClient):
 
     See twisted.words.protocols.irc for more information.
 
+    If the server supports them, the IRCv3 capabilities in wanted_caps are
+    negotiated when connecting. The account_caps let us keep track of which
+    account each user we can see is logged in to, in self.accounts, so that
+    the Auth plugin doesn't have to whois them. multi-prefix makes NAMES
+    replies list all of a user's prefixes (like @+nick), not just the
+    highest.
+
     """
+    account_caps = frozenset(["account-notify", "extended-join", "account-tag"])
+    wanted_caps = account_caps | frozenset(["multi-prefix"])
 
     ### ALL METHODS BELOW ARE OVERRIDDEN METHODS OF irc.IRCClient (or ancestors)
     ### AND ARE CALLED AUTOMATICALLY UPON THE APPROPRIATE EVENTS FROM THE IRC
@@ -36,8 +104,25 @@ class IRCBot(irc.IRCClient):
             line = line.decode("UTF-8")
         except UnicodeDecodeError:
             line = line.decode("CP1252", 'replace')
+
+        # Twisted doesn't know about message tags, so strip them off here.
+        # They're kept in self.tags while the line is handled.
+        if line.startswith("@"):
+            tags, _, line = line.partition(" ")
+            self.tags = parse_tags(tags[1:])
+        else:
+            self.tags = {}
         return irc.IRCClient.lineReceived(self, line)
 
+    def handleCommand(self, command, prefix, params):
+        """Overrides IRCClient.handleCommand to pick up the account-tag from
+        any message sent by a user, before it's handled
+
+        """
+        if "account-tag" in self.caps and prefix and "!" in prefix:
+            self.set_account(prefix, self.tags.get("account"))
+        irc.IRCClient.handleCommand(self, command, prefix, params)
+
     def sendLine(self, line):
         """Overrides IRCClient.sendLine to encode outgoing lines with UTF-8.
         Also implements some rate-limiting logic.
@@ -100,10 +185,22 @@ class IRCBot(irc.IRCClient):
         self.time_of_last_line = 0
         self.line_count = 0
 
+        # IRCv3 state. caps is the set of capabilities the server agreed to,
+        # and accounts maps nicks to (hostmask, account) pairs, where account
+        # is None if the user isn't logged in.
+        self.tags = {}
+        self.caps = set()
+        self.offered_caps = set()
+        self.accounts = {}
+
         # Can't use super() because twisted doesn't use new-style classes
         irc.IRCClient.connectionMade(self)
         self.factory.client = self
 
+        # Lets the event transport stop reading from the socket while its
+        # queue is full
+        self.factory.transport.register_producer(self.transport)
+
         log.msg("Connection made")
 
         # Join the configured channels
@@ -116,12 +213,118 @@ class IRCBot(irc.IRCClient):
         
         """
         self.factory.client = None
+        self.factory.transport.unregister_producer(self.transport)
         irc.IRCClient.connectionLost(self, reason)
+        self.factory.broadcast_message("irc.on_disconnected")
 
         log.msg("IRC Connection lost!")
 
+    def register(self, nickname, hostname='foo', servername='bar'):
+        """Overrides IRCClient.register to start capability negotiation
+        first. Servers that support it hold off registration until we send CAP
+        END; older servers just reply that they don't know the command.
+
+        """
+        self.sendLine("CAP LS 302")
+        irc.IRCClient.register(self, nickname, hostname, servername)
+
+    def irc_CAP(self, prefix, params):
+        """Capability negotiation. params is our nick (or *), the
+        subcommand, possibly a * meaning more lines are coming, and the list
+        of capabilities.
+
+        """
+        subcommand = params[1]
+        caps = params[-1].split()
+        if subcommand == "LS":
+            # CAP LS 302 may give values, as in sasl=PLAIN
+            self.offered_caps.update(cap.split("=", 1)[0] for cap in caps)
+            if len(params) > 3 and params[2] == "*":
+                return
+            wanted = self.wanted_caps & self.offered_caps
+            if wanted:
+                self.sendLine("CAP REQ :%s" % " ".join(sorted(wanted)))
+            else:
+                self.sendLine("CAP END")
+        elif subcommand == "ACK":
+            for cap in caps:
+                if cap.startswith("-"):
+                    self.caps.discard(cap[1:])
+                else:
+                    self.caps.add(cap)
+            log.msg("Enabled capabilities: %s" % ", ".join(sorted(self.caps)))
+            self.sendLine("CAP END")
+        elif subcommand == "NAK":
+            log.msg("Server refused capabilities %s" % params[-1])
+            self.sendLine("CAP END")
+        elif subcommand == "DEL":
+            self.caps.difference_update(caps)
+            if "account-notify" not in self.caps:
+                self.accounts.clear()
+
+    def set_account(self, hostmask, account):
+        """Records which account the user is logged in to, or None if they're
+        not. This is only done while account-notify is enabled, since
+        otherwise there's no telling when it changes.
+
+        """
+        if "account-notify" not in self.caps:
+            return
+        if account == "*":
+            account = None
+        self.accounts[hostmask.split("!", 1)[0]] = (hostmask, account)
+
+    def account_for(self, hostmask):
+        """Returns the account the user is logged in to, or None if they're
+        not logged in. Raises KeyError if we don't know.
+
+        """
+        known_hostmask, account = self.accounts[hostmask.split("!", 1)[0]]
+        if known_hostmask != hostmask:
+            raise KeyError(hostmask)
+        return account
+
+    def irc_JOIN(self, prefix, params):
+        """Overrides IRCClient.irc_JOIN to handle extended-join, which puts
+        the account name and real name after the channel
+
+        """
+        if "extended-join" in self.caps and len(params) == 3:
+            self.set_account(prefix, params[1])
+            params = params[:1]
+        irc.IRCClient.irc_JOIN(self, prefix, params)
+
+    def irc_ACCOUNT(self, prefix, params):
+        """account-notify: a user logged in to or out of an account"""
+        self.set_account(prefix, params[0])
+        self.factory.broadcast_message("irc.on_account_change",
+                user=prefix, account=None if params[0] == "*" else params[0])
+
+    def irc_NICK(self, prefix, params):
+        """Overrides IRCClient.irc_NICK to carry the user's account over to
+        their new nick
+
+        """
+        nick, _, userhost = prefix.partition("!")
+        try:
+            _, account = self.accounts.pop(nick)
+        except KeyError:
+            pass
+        else:
+            self.accounts[params[0]] = ("%s!%s" % (params[0], userhost), account)
+        irc.IRCClient.irc_NICK(self, prefix, params)
+
     ### The following are things that happen to us
 
+    def signedOn(self):
+        """We have registered with the server, so our nick is settled"""
+        self.factory.broadcast_message("irc.on_nick_set", nick=self.nickname)
+
+    def nickChanged(self, nick):
+        """Our own nick has changed"""
+        irc.IRCClient.nickChanged(self, nick)
+        self.factory.broadcast_message("irc.on_nick_set", nick=nick)
+
     def joined(self, channel):
         """We have joined a channel"""
         log.msg("Joined channel %s" % channel)
@@ -139,6 +342,15 @@ class IRCBot(irc.IRCClient):
             self.factory.config['channels'].remove(channel)
             self.factory.config.save()
 
+    def kickedFrom(self, channel, kicker, message):
+        """We have been kicked from a channel. Unlike parting, this doesn't
+        remove the channel from the config, so we rejoin it next time we
+        connect.
+
+        """
+        self.factory.broadcast_message("irc.on_kicked",
+                channel=channel, kicker=kicker, message=message)
+
     ### Things we see other users doing or observe about the channel
 
     def privmsg(self, user, channel, message):
@@ -185,14 +397,19 @@ class IRCBot(irc.IRCClient):
                 user=user, channel=channel)
 
     def userLeft(self, user, channel):
+        # They may still share another channel with us, but if not we'd miss
+        # their account changes, so forget it until we see them again
+        self.accounts.pop(user, None)
         self.factory.broadcast_message("irc.on_user_part",
                 user=user, channel=channel)
 
     def userQuit(self, user, message):
+        self.accounts.pop(user, None)
         self.factory.broadcast_message("irc.on_user_quit",
                 user=user, message=message)
 
     def userKicked(self, kickee, channel, kicker, message):
+        self.accounts.pop(kickee, None)
         self.factory.broadcast_message("irc.on_user_kick",
                 kickee=kickee, channel=channel, kicker=kicker, message=message)
 
@@ -264,7 +481,13 @@ class IRCBotPlugin(protocol.ReconnectingClientFactory, BotPlugin):
             return d
         self.shutdown_trigger = reactor.addSystemEventTrigger("before", "shutdown", shutdown)
 
-        self.provides_request("irc.getnick")
+        # Asked for over and over, e.g. on every mode change, but only changes
+        # when we're told
+        self.provides_request("irc.getnick", cache_ttl=60*60,
+                invalidate_on=["irc.on_nick_set", "irc.on_disconnected"])
+        self.provides_request("irc.account")
+        self.provides_request("irc.supports")
+        self.provides_request("irc.feature")
 
     def stop(self):
         log.msg("IRCBotPlugin stopping...")
@@ -290,7 +513,7 @@ class IRCBotPlugin(protocol.ReconnectingClientFactory, BotPlugin):
         comes in from the network
         
         """
-        event = Event(eventname, **kwargs)
+        event = new_event(eventname, **kwargs)
         self.transport.send_event(event)
 
     def received_event(self, event):
@@ -341,6 +564,36 @@ class IRCBotPlugin(protocol.ReconnectingClientFactory, BotPlugin):
     def on_request_irc_getnick(self):
         return defer.succeed(self.client.nickname)
 
+    def on_request_irc_supports(self, feature):
+        """Returns whether the server advertised the given feature in its
+        ISUPPORT (005) lines, such as WHOX
+
+        """
+        return self.client is not None and self.client.supported.hasFeature(feature)
+
+    def on_request_irc_feature(self, feature):
+        """Returns the value of a feature from the server's ISUPPORT lines,
+        parsed by twisted, or None. For example, PREFIX gives a dict mapping
+        each prefix mode to its prefix character and rank, highest first.
+
+        """
+        if self.client is None:
+            return None
+        return self.client.supported.getFeature(feature)
+
+    def on_request_irc_account(self, hostmask):
+        """Returns the account the user is logged in to, or None. Raises
+        UnknownAccount if the server doesn't support account tracking or we
+        haven't seen this user.
+
+        """
+        if self.client is None:
+            raise UnknownAccount(hostmask)
+        try:
+            return self.client.account_for(hostmask)
+        except KeyError:
+            raise UnknownAccount(hostmask)
+
 
 class IRCController(CommandPluginSuperclass):
     """This plugin provides a few administrative tasks in conjunction with the
@@ -1,12 +1,12 @@
 import re
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 
-from twisted.internet import reactor
 from twisted.python import log
 from twisted.internet import defer
 
 from ..command import CommandPluginSuperclass
-from ..transport import Event
+from ..cache import TTLCache
+from ..transport import Event, RequestTimedOut
 from ..pluginbase import BotPlugin, EventWatcher, non_reentrant
 
 """
@@ -23,26 +23,83 @@ class WhoisTimedout(WhoisError):
 class NoSuchNick(WhoisError):
     pass
 
+def irc_lower(name):
+    """Lower cases a nick or channel name the way IRC servers compare them,
+    using the rfc1459 casemapping
+
+    """
+    return (name.lower().replace("[", "{").replace("]", "}")
+            .replace("\\", "|").replace("~", "^"))
+
+class _Whois(object):
+    """One WHOIS: the nick, the deferreds of everyone waiting for it, and the
+    replies collected so far
+
+    """
+    __slots__ = ("nick", "waiters", "info", "finished", "timer")
+
+    def __init__(self, nick):
+        self.nick = nick
+        self.waiters = []
+        self.info = {}
+        self.finished = False
+        self.timer = None
+
+    def succeed(self):
+        self.finished = True
+        waiters, self.waiters = self.waiters, []
+        for d in waiters:
+            d.callback(dict(self.info))
+
+    def fail(self, error):
+        self.finished = True
+        waiters, self.waiters = self.waiters, []
+        for d in waiters:
+            d.errback(error)
+
 class IRCWhois(CommandPluginSuperclass):
     """Provides a request:
 
     irc.whois
 
-    takes one argument: the nickname
+    takes one argument: the nickname, and optionally fresh=True to skip the
+    cache
     deferred fires with a dictionary of information returned from the server.
 
     deferreds returned may also errback with one of the following exceptions:
     WhoisTimedout
     NoSuchNick
 
+    Every whois reply from the server has the nick it's about as its first
+    parameter, so replies are collected per nick and several whoises can be
+    outstanding at once. Requests for a nick that's already being whoised
+    wait for that whois instead of sending another. At most "window" (from
+    the config, 4 by default) whoises are sent to the server at a time; the
+    rest wait their turn in order.
+
+    Results are cached for cache_ttl seconds. A user's whois info rarely
+    changes under the same nick, and when it does we usually hear about it,
+    so a nick's entry is dropped when they change nicks, quit or log in or
+    out.
+
     """
+    # Seconds to wait for the end of a whois
+    timeout = 10
+    cache_ttl = 60
+    cache_size = 500
 
     def start(self):
         super(IRCWhois, self).start()
 
+        # Requests are coalesced and cached here rather than by the
+        # transport, so that entries can be dropped one nick at a time
         self.provides_request("irc.whois")
+        self.provides_request("irc.whois_cache")
 
         self.listen_for_event("irc.on_unknown")
+        self.listen_for_event("irc.on_nick_change")
+        self.listen_for_event("irc.on_user_quit")
+        self.listen_for_event("irc.on_account_change")
 
         self.install_command(
                 cmdname="whois",
@@ -53,76 +110,117 @@ class IRCWhois(CommandPluginSuperclass):
                 permission="irc.whois",
                 )
 
-        # nick of the current whois that is coming in on the wire right this
-        # moment
-        self.currentwhois = None
-        # Maps the command to the parameters. command is a string and is either
-        # a symbolic representation like RPL_WHOISUSER or for unknown commands
-        # a string number like "330"
-        self.currentinfo = {}
-
-        # Map of nicks to deferred callbacks
-        self.pendingwhoises = defaultdict(set)
+        # Maps lower cased nicks to the _Whois sent to the server for them.
+        # There's never more than one per nick on the wire, or we couldn't
+        # tell their replies apart.
+        self.outstanding = {}
+        # Whoises waiting for a free slot, in the order they were requested
+        self.queued = OrderedDict()
+        # Maps lower cased nicks to the info from their last whois
+        self.cache = TTLCache(self.cache_ttl, maxsize=self.cache_size,
+                clock=self.transport.clock)
 
     def on_event_irc_on_unknown(self, event):
-        """Here's how this works. When we get a RPL_WHOISUSER, we assume all
-        the unknown category of lines from the server are about that user until
-        we get an RPL_ENDOFWHOIS
+        """Replies to a whois all have the nick as their first parameter
+        (after our own nick), and end with an RPL_ENDOFWHOIS. Servers send an
+        ERR_NOSUCHNICK before the RPL_ENDOFWHOIS if there's no such user.
 
         """
-        command = event.command
         params = event.params
-        if command == "RPL_WHOISUSER":
-            # Start a new one
-            if self.currentwhois:
-                log.err("Got a RPL_WHOISUSER but we're already in a whois!")
-            nick = params[1]
-            self.currentwhois = nick
-            self.currentinfo = {command: params[1:]}
-
-        elif command == "RPL_ENDOFWHOIS":
-            if not self.currentwhois or not self.pendingwhoises[self.currentwhois]:
-                return
-
-            for callback in self.pendingwhoises.pop(self.currentwhois):
-                callback.callback(dict(self.currentinfo))
-
-            self.currentwhois = None
+        if len(params) < 2:
+            return
+        whois = self.outstanding.get(irc_lower(params[1]))
+        if whois is None:
+            return
 
+        command = event.command
+        if command == "RPL_ENDOFWHOIS":
+            self._done(whois)
+            if not whois.finished:
+                self.cache[irc_lower(whois.nick)] = whois.info
+                whois.succeed()
         elif command == "ERR_NOSUCHNICK":
-            nick = params[1]
-            for callback in self.pendingwhoises.pop(nick):
-                callback.errback(NoSuchNick(params[2]))
-
+            # Don't free the slot until the RPL_ENDOFWHOIS, or it could be
+            # taken for the next whois of the same nick
+            whois.fail(NoSuchNick(params[-1]))
         else:
-            self.currentinfo[command] = params[1:]
-
-    def on_request_irc_whois(self, nick):
-        d = defer.Deferred()
-        self.pendingwhoises[nick].add(d)
-
-        event = Event("irc.do_whois",
-                nickname=nick,
-                )
-        self.transport.send_event(event)
-
-        def timeout():
-            d.errback(WhoisTimedout("No whois response from server"))
-            self.pendingwhoises[nick].remove(d)
-        timer = reactor.callLater(10, timeout)
-        def canceltimer(info):
-            timer.cancel()
-            return info
-        d.addBoth(canceltimer)
-
+            whois.info[command] = params[1:]
+
+    def on_event_irc_on_nick_change(self, event):
+        self.cache.pop(irc_lower(event.oldnick))
+        self.cache.pop(irc_lower(event.newnick))
+
+    def on_event_irc_on_user_quit(self, event):
+        self.cache.pop(irc_lower(event.user))
+
+    def on_event_irc_on_account_change(self, event):
+        self.cache.pop(irc_lower(event.user.split("!", 1)[0]))
+
+    def on_request_irc_whois_cache(self):
+        """Returns the whois cache, for stats"""
+        return self.cache
+
+    def on_request_irc_whois(self, nick, fresh=False):
+        key = irc_lower(nick)
+        if not fresh:
+            try:
+                return dict(self.cache[key])
+            except KeyError:
+                pass
+
+        whois = self.queued.get(key)
+        if whois is None:
+            whois = self.outstanding.get(key)
+            if whois is None or whois.finished:
+                whois = self.queued[key] = _Whois(nick)
+
+        d = defer.Deferred(lambda d: self._cancel(whois, d))
+        whois.waiters.append(d)
+        self._send_queued()
         return d
 
+    def _cancel(self, whois, d):
+        whois.waiters.remove(d)
+        key = irc_lower(whois.nick)
+        if not whois.waiters and self.queued.get(key) is whois:
+            # Nobody wants it any more, and it hasn't been sent yet
+            del self.queued[key]
+
+    def _send_queued(self):
+        """Sends queued whoises while there's room in the window"""
+        window = self.config.get("window", 4)
+        for key in list(self.queued):
+            if len(self.outstanding) >= window:
+                break
+            if key in self.outstanding:
+                # Still waiting for the end of the last whois of this nick
+                continue
+            whois = self.outstanding[key] = self.queued.pop(key)
+            whois.timer = self.transport.clock.callLater(self.timeout,
+                    self._timed_out, whois)
+            self.transport.send_event(Event("irc.do_whois",
+                    nickname=whois.nick,
+                    ))
+
+    def _done(self, whois):
+        """Frees the whois's slot, and sends the next ones"""
+        del self.outstanding[irc_lower(whois.nick)]
+        if whois.timer.active():
+            whois.timer.cancel()
+        self._send_queued()
+
+    def _timed_out(self, whois):
+        self._done(whois)
+        if not whois.finished:
+            whois.fail(WhoisTimedout("No whois response from server"))
+
     @defer.inlineCallbacks
     def do_whois(self, event, match):
         """A request from a !whois command"""
         nick = match.groupdict()['nick']
         try:
-            info = (yield self.transport.issue_request("irc.whois", nick))
+            info = (yield self.transport.issue_request("irc.whois", nick,
+                fresh=True))
         except WhoisTimedout:
             event.reply("No response from the server. huh.")
             return
@@ -137,14 +235,59 @@ class IRCWhois(CommandPluginSuperclass):
         #for command, params in info.iteritems():
         #    event.reply("%s: %s" % (command, params))
 
+class _Member(object):
+    __slots__ = ("nick", "modes")
+
+    def __init__(self, nick, modes=()):
+        self.nick = nick
+        # The prefix modes the user has in the channel, such as o and v
+        self.modes = set(modes)
+
+class _Channel(object):
+    """What we know about who is in a channel we're in"""
+    __slots__ = ("members", "synced")
+
+    def __init__(self):
+        # Maps lower cased nicks to _Members
+        self.members = {}
+        # False until the NAMES reply after joining has arrived
+        self.synced = False
+
 class Names(CommandPluginSuperclass):
-    """Provides a NAMES request for other plugins and a !names command"""
+    """Keeps track of who is in each channel we're in, and their prefix modes
+    (op, voice and so on), and provides it as the irc.names request.
+
+    The members of a channel come from the NAMES reply the server sends when
+    we join it. After that they're kept up to date from joins, parts, kicks,
+    quits, nick changes and mode changes, so irc.names is answered from
+    memory. Passing resync=True asks the server again, as does asking about a
+    channel we're not in.
+
+    """
+    # Until the server tells us its PREFIX, assume the usual op and voice
+    default_prefixes = {"o": ("@", 0), "v": ("+", 1)}
+
     def start(self):
         super(Names, self).start()
 
-        self.provides_request("irc.names")
-
-        self.listen_for_event("irc.on_unknown")
+        # NAMES replies can go missing, e.g. if we part the channel first
+        self.provides_request("irc.names", timeout=10, coalesce=True)
+
+        for eventname in [
+                "irc.on_unknown",
+                "irc.on_join",
+                "irc.on_part",
+                "irc.on_kicked",
+                "irc.on_disconnected",
+                "irc.on_user_joined",
+                "irc.on_user_part",
+                "irc.on_user_quit",
+                "irc.on_user_kick",
+                "irc.on_nick_change",
+                "irc.on_nick_set",
+                "irc.on_mode_change",
+                ]:
+            self.listen_for_event(eventname)
 
         #self.install_command(
         #        cmdname="names",
@@ -155,39 +298,175 @@ class Names(CommandPluginSuperclass):
         #        permission="irc.names",
         #        )
 
-        self.currentinfo = []
+        # Maps lower cased channel names to _Channels, for channels we're in
+        self.channels = {}
+        # Maps lower cased channel names to the names from the RPL_NAMREPLY
+        # lines received so far, until the RPL_ENDOFNAMES
+        self.incoming = defaultdict(list)
+        # Maps lower cased channel names to deferreds waiting for a NAMES reply
         self.pending = defaultdict(set)
+        self.nick = None
+        self._set_prefixes(self.default_prefixes)
+        self._ask_server()
 
-    @defer.inlineCallbacks
-    def on_request_irc_names(self, channel):
-        self.transport.send_event(Event("irc.do_raw",
-                line="NAMES " + channel))
-        log.msg("NAMES line sent for channel %s. Awaiting reply..." % channel)
+    def _set_prefixes(self, prefixes):
+        # Maps prefix modes to (prefix character, rank) pairs, rank 0 highest
+        self.prefixes = dict(prefixes)
+        # Maps prefix characters back to modes
+        self.prefix_modes = dict((prefix, mode)
+                for mode, (prefix, _) in self.prefixes.iteritems())
+
+    def _ask_server(self):
+        """Finds out our nick and the server's prefix modes, if we're
+        connected
+
+        """
+        def got_prefixes(prefixes):
+            if prefixes:
+                self._set_prefixes(prefixes)
+        def got_nick(nick):
+            if self.nick is None:
+                self.nick = nick
+        ignore = lambda failure: None
+        self.transport.issue_request("irc.feature", "PREFIX").addCallbacks(
+                got_prefixes, ignore)
+        self.transport.issue_request("irc.getnick").addCallbacks(
+                got_nick, ignore)
+
+    def _prefix(self, modes):
+        """Returns the prefix character of the highest of the modes, or an
+        empty string if there are none
+
+        """
+        ranked = [self.prefixes[mode] for mode in modes if mode in self.prefixes]
+        if not ranked:
+            return ""
+        return min(ranked, key=lambda prefix_rank: prefix_rank[1])[0]
+
+    def _names(self, members):
+        """The member list in the form of a NAMES reply, with each nick
+        preceded by its highest prefix
 
-        d = defer.Deferred()
-        self.pending[channel].add(d)
+        """
+        return [self._prefix(member.modes) + member.nick
+                for member in members.itervalues()]
 
-        names = (yield d)
+    def _parse_names(self, names):
+        """Parses the names from a NAMES reply, each preceded by its prefixes
+        (all of them, with multi-prefix), into a dict of _Members
 
-        defer.returnValue(names)
+        """
+        members = {}
+        for name in names:
+            modes = []
+            while name and name[0] in self.prefix_modes:
+                modes.append(self.prefix_modes[name[0]])
+                name = name[1:]
+            members[irc_lower(name)] = _Member(name, modes)
+        return members
+
+    def on_request_irc_names(self, channel, resync=False):
+        key = irc_lower(channel)
+        state = self.channels.get(key)
+        if state is not None and state.synced and not resync:
+            return self._names(state.members)
+
+        d = defer.Deferred(lambda d: self.pending[key].discard(d))
+        # Don't ask if a reply is already on its way, including the one the
+        # server sends when we join
+        if not self.pending[key] and (state is None or state.synced):
+            self.transport.send_event(Event("irc.do_raw",
+                    line="NAMES " + channel))
+            log.msg("NAMES line sent for channel %s. Awaiting reply..." % channel)
+        self.pending[key].add(d)
+        return d
 
     def on_event_irc_on_unknown(self, event):
         command = event.command
 
         if command == "RPL_NAMREPLY":
             channel = event.params[2]
-            names = event.params[3]
-            self.currentinfo.append(names)
+            self.incoming[irc_lower(channel)].extend(event.params[3].split())
 
         elif command == "RPL_ENDOFNAMES":
-            channel = event.params[1]
-            names = " ".join(self.currentinfo)
-            name_list = names.split()
-            self.currentinfo = []
-            if channel in self.pending:
-                for d in self.pending.pop(channel):
-                    d.callback(name_list)
+            key = irc_lower(event.params[1])
+            members = self._parse_names(self.incoming.pop(key, []))
+            state = self.channels.get(key)
+            if state is not None:
+                state.members = members
+                state.synced = True
+            for d in self.pending.pop(key, ()):
+                d.callback(self._names(members))
+
+    ### Keeping track of channel members
+    def _members(self, channel):
+        """Returns the members dict for the channel, or an empty dict if
+        we're not in it
+
+        """
+        state = self.channels.get(irc_lower(channel))
+        return state.members if state is not None else {}
+
+    def _rename(self, oldnick, newnick):
+        for state in self.channels.itervalues():
+            member = state.members.pop(irc_lower(oldnick), None)
+            if member is not None:
+                member.nick = newnick
+                state.members[irc_lower(newnick)] = member
+
+    def on_event_irc_on_join(self, event):
+        # The server follows up with a NAMES reply
+        self.channels[irc_lower(event.channel)] = _Channel()
+        self._ask_server()
 
+    def on_event_irc_on_part(self, event):
+        self.channels.pop(irc_lower(event.channel), None)
+
+    def on_event_irc_on_kicked(self, event):
+        self.channels.pop(irc_lower(event.channel), None)
+
+    def on_event_irc_on_disconnected(self, event):
+        # We'll rejoin on reconnect, but maybe not every channel (if it's
+        # become +i, or we're banned), so forget them all until we do
+        self.channels.clear()
+        self.incoming.clear()
+
+    def on_event_irc_on_user_joined(self, event):
+        nick = event.user.split("!", 1)[0]
+        state = self.channels.get(irc_lower(event.channel))
+        if state is not None:
+            state.members[irc_lower(nick)] = _Member(nick)
+
+    def on_event_irc_on_user_part(self, event):
+        self._members(event.channel).pop(irc_lower(event.user), None)
+
+    def on_event_irc_on_user_kick(self, event):
+        self._members(event.channel).pop(irc_lower(event.kickee), None)
+
+    def on_event_irc_on_user_quit(self, event):
+        key = irc_lower(event.user)
+        for state in self.channels.itervalues():
+            state.members.pop(key, None)
+
+    def on_event_irc_on_nick_change(self, event):
+        self._rename(event.oldnick, event.newnick)
+
+    def on_event_irc_on_nick_set(self, event):
+        """Our own nick changed"""
+        if self.nick is not None and self.nick != event.nick:
+            self._rename(self.nick, event.nick)
+        self.nick = event.nick
+
+    def on_event_irc_on_mode_change(self, event):
+        if event.mode not in self.prefixes or not event.arg:
+            return
+        member = self._members(event.channel).get(irc_lower(event.arg))
+        if member is None:
+            return
+        if event.set:
+            member.modes.add(event.mode)
+        else:
+            member.modes.discard(event.mode)
 
     @defer.inlineCallbacks
     def do_names(self, event, match):
@@ -309,8 +588,10 @@ class HasOp(BotPlugin):
 
         self.has_op = {}
 
-        self.provides_request("irc.has_op")
+        self.provides_request("irc.has_op", coalesce=True)
         self.listen_for_event("irc.on_join")
+        self.listen_for_event("irc.on_kicked")
+        self.listen_for_event("irc.on_disconnected")
         self.listen_for_event("irc.on_mode_change")
 
     @defer.inlineCallbacks
@@ -337,6 +618,12 @@ class HasOp(BotPlugin):
         """
         self.has_op[event.channel] = False
 
+    def on_event_irc_on_kicked(self, event):
+        self.has_op[event.channel] = False
+
+    def on_event_irc_on_disconnected(self, event):
+        self.has_op.clear()
+
     @defer.inlineCallbacks
     def on_event_irc_on_mode_change(self, event):
         """Called when we observe a mode change. Check to see if it was an op
@@ -368,7 +655,7 @@ class ChanMode(EventWatcher, BotPlugin):
 
         self.mode = {}
 
-        self.provides_request("irc.chanmode")
+        self.provides_request("irc.chanmode", coalesce=True)
 
         self.listen_for_event("irc.on_join")
         self.listen_for_event("irc.on_mode_change")
@@ -395,7 +682,7 @@ class ChanMode(EventWatcher, BotPlugin):
                 timeout=5))
         
         if not reply:
-            raise Exception("no response from server")
+            raise RequestTimedOut("No mode reply for {0}".format(channel))
 
         mode, params = reply.params[2], reply.params[3:]
 
@@ -9,4 +9,4 @@ class Log(BotPlugin):
     def received_event(self, event):
         print
         print "Received event %s" % (event.eventtype,)
-        print pprint.pformat(event.__dict__)
+        print pprint.pformat(event.attributes())
@@ -339,6 +339,10 @@ class PyExec(CommandPluginSuperclass):
                 permission=None,
                 helptext="Run a python statement and print the result",
                 callback=self.run_command,
+                ratelimit={"user": (3, 60)},
+                # Each one is a pypy-sandbox process
+                concurrency=2,
+                queue=5,
                 )
         
     def reload(self):
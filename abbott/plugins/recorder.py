@@ -0,0 +1,72 @@
+import json
+import time
+
+from twisted.internet import task
+
+from ..pluginbase import BotPlugin
+
+"""
+Records events to a file, for replaying later with abbott.replay
+
+"""
+
+class Recorder(BotPlugin):
+    """Appends every event matching the configured globs to a file, one JSON
+    list per line: [timestamp, eventtype, {attributes}]
+
+    Attributes that can't be serialized to JSON, such as the callables that
+    middleware adds, are left out. Those are added again when the events are
+    replayed through the same middleware.
+
+    The events are recorded as middleware. The transport runs middleware in
+    the order its globs were first installed, but middleware installed with
+    the same glob runs in no particular order. So this plugin only sees events
+    before other middleware modifies them if it's loaded first and its globs
+    aren't installed by anyone else. auth.Auth installs irc.on_* too, the
+    default here, so its attributes may or may not have been added yet; they
+    are callables and get left out either way.
+
+    """
+    DEFAULT_CONFIG = {
+            "file": "events.jsonl",
+            # Only the incoming IRC events are needed for a replay; every
+            # other event is a consequence of those
+            "events": ["irc.on_*"],
+            }
+
+    def start(self):
+        super(Recorder, self).start()
+
+        self.out = open(self.config["file"], "a")
+        self.recorded = 0
+
+        for matchstr in self.config["events"]:
+            self.install_middleware(matchstr)
+
+        # Don't flush after every line, but don't lose more than a few
+        # seconds of events if we crash either
+        self.flusher = task.LoopingCall(self.out.flush)
+        self.flusher.start(5, now=False)
+
+    def stop(self):
+        super(Recorder, self).stop()
+        self.flusher.stop()
+        self.out.close()
+
+    def received_middleware_event(self, event):
+        attrs = {}
+        for name, value in event.attributes().iteritems():
+            if callable(value):
+                continue
+            try:
+                json.dumps(value)
+            except (TypeError, ValueError):
+                # Not serializable. Includes byte strings that aren't UTF-8
+                continue
+            attrs[name] = value
+
+        self.out.write(json.dumps([time.time(), event.eventtype, attrs],
+            separators=(",", ":")))
+        self.out.write("\n")
+        self.recorded += 1
+        return event
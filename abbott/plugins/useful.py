@@ -11,6 +11,7 @@ from twisted.internet.protocol import ProcessProtocol
 
 from ..pluginbase import BotPlugin
 from ..command import CommandPluginSuperclass
+from ..transport import PRIORITY_BEST_EFFORT
 
 """
 Miscellaneous, useful plugins
@@ -58,7 +59,7 @@ class TempConverter(BotPlugin):
             """, re.X)
 
     def start(self):
-        self.listen_for_event("irc.on_privmsg")
+        self.listen_for_event("irc.on_privmsg", PRIORITY_BEST_EFFORT)
 
     def on_event_irc_on_privmsg(self, event):
         for word in self.blacklist:
@@ -149,6 +150,8 @@ class Units(CommandPluginSuperclass):
                 permission=None,
                 helptext="Invokes the 'units' command to do a unit conversion.",
                 callback=self.invoke_units,
+                concurrency=4,
+                queue=10,
                 )
 
         self.install_command(
@@ -240,6 +243,9 @@ class Mueval(CommandPluginSuperclass):
                 permission=None,
                 helptext="Evaluates a line of Haskell and replies with the output.",
                 callback=self.invoke_mueval,
+                # mueval runs ghc, which is heavy
+                concurrency=2,
+                queue=5,
                 )
 
 
@@ -303,7 +309,7 @@ class URLShortener(BotPlugin):
         re.VERBOSE | re.IGNORECASE)
 
     def start(self):
-        self.listen_for_event("irc.on_privmsg")
+        self.listen_for_event("irc.on_privmsg", PRIORITY_BEST_EFFORT)
 
         import googl
         self.shortener = googl.Googl()
@@ -1,7 +1,7 @@
 # encoding: UTF-8
 from __future__ import division
 import random
-from collections import defaultdict, deque
+from collections import defaultdict
 import datetime
 import time
 import bisect
@@ -17,6 +17,7 @@ except ImportError:
 
 from ..command import CommandPluginSuperclass, require_channel
 from ..pluginbase import EventWatcher
+from ..ratelimit import TokenBucket
 from ..transport import Event
 from . import ircop
 
@@ -93,9 +94,14 @@ class VoiceOfTheDay(EventWatcher, CommandPluginSuperclass):
         self.started = False
         self.timer = None
 
-        # Keeps track of the last x times that the !odds command was issued.
-        # Will only do so many in a minute to prevent spam
-        self.last_odds = deque(maxlen=3)
+        # Only so many !odds replies a minute go to the channel, to prevent
+        # spam. The rest are sent privately.
+        self.odds_bucket = TokenBucket(3, 60)
+
+        # The events that invoked the !odds command. Those messages don't
+        # count as an entry. Each is removed again by on_event_irc_on_privmsg
+        # once it has waited for the command to run.
+        self.odds_events = set()
 
         super(VoiceOfTheDay, self).__init__(*args)
 
@@ -103,6 +109,7 @@ class VoiceOfTheDay(EventWatcher, CommandPluginSuperclass):
         super(VoiceOfTheDay, self).start()
 
         self.listen_for_event("irc.on_nick_change")
+        self.listen_for_event("irc.on_privmsg")
 
         votdgroup = self.install_cmdgroup(
             grpname="votd",
@@ -150,6 +157,7 @@ class VoiceOfTheDay(EventWatcher, CommandPluginSuperclass):
             callback=self.check_prob,
             helptext="Check your odds for winning voice of the day",
             permission=None,
+            ratelimit={"user": (3, 60)},
         )
 
         # Don't forget!
@@ -162,6 +170,7 @@ class VoiceOfTheDay(EventWatcher, CommandPluginSuperclass):
         self.lastspoken = 0
 
     def stop(self):
+        super(VoiceOfTheDay, self).stop()
         if self.timer:
             self.timer.cancel()
 
@@ -452,19 +461,21 @@ class VoiceOfTheDay(EventWatcher, CommandPluginSuperclass):
 
     @defer.inlineCallbacks
     def on_event_irc_on_privmsg(self, event):
-        super(VoiceOfTheDay, self).on_event_irc_on_privmsg(event)
-
         if event.channel == self.config["channel"]:
             self.lastspoken = time.time()
 
-        if getattr(event, "_was_odds", False):
-            return
-
         # This delay is a bit of a hack. If we do e.g. a configreload, and this
         # handler happens to run before the reload, this will save the config,
         # clobbering the new one. So here we wait a second to let the other
         # handler run, reload our config, THEN we increment the counter.
+        # This also gives the command router a chance to run the !odds
+        # command, which may be after this handler.
         yield self.wait_for(timeout=1)
+
+        if event in self.odds_events:
+            self.odds_events.discard(event)
+            return
+
         if event.channel == self.config["channel"]:
             nick = event.user.split("!")[0]
             self.config["counter"][nick] += 1
@@ -532,14 +543,13 @@ class VoiceOfTheDay(EventWatcher, CommandPluginSuperclass):
         self.config.save()
 
     def check_prob(self, event, match):
-        event._was_odds = True
+        self.odds_events.add(event)
         user = match.groupdict()['user']
 
-        if len(self.last_odds) == self.last_odds.maxlen and time.time() - self.last_odds[0] < 60:
-            reply_opts = {"notice": True, "direct": True}
-        else:
+        if self.odds_bucket.consume():
             reply_opts = {}
-        self.last_odds.append(time.time())
+        else:
+            reply_opts = {"notice": True, "direct": True}
 
         if not user:
             user = event.user.split("!")[0]
@@ -0,0 +1,113 @@
+from twisted.internet import reactor
+
+from .cache import TTLCache
+
+"""
+Token bucket rate limiting, used by the command framework to limit how often
+users and channels may invoke commands, and available to plugins that need to
+throttle something themselves.
+
+"""
+
+class TokenBucket(object):
+    """Holds up to `capacity` tokens, and refills at a rate of `capacity`
+    tokens per `period` seconds. Each action takes a token; an action is
+    allowed as long as there's a token to take. This allows bursts of up to
+    `capacity` actions, and `capacity` actions per period on average.
+
+    clock is an object with a seconds() method, normally the reactor.
+
+    """
+    __slots__ = ("capacity", "rate", "tokens", "stamp", "clock")
+
+    def __init__(self, capacity, period, clock=None):
+        self.capacity = capacity
+        self.rate = float(capacity) / period
+        self.clock = clock if clock is not None else reactor
+        self.tokens = float(capacity)
+        self.stamp = self.clock.seconds()
+
+    def _refill(self):
+        now = self.clock.seconds()
+        self.tokens = min(self.capacity,
+                self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def available(self, n=1):
+        """Returns True if n tokens could be taken right now"""
+        self._refill()
+        return self.tokens >= n
+
+    def consume(self, n=1):
+        """Takes n tokens and returns True, or returns False without taking
+        any if there aren't enough
+
+        """
+        self._refill()
+        if self.tokens < n:
+            return False
+        self.tokens -= n
+        return True
+
+    def delay(self, n=1):
+        """Returns the number of seconds until n tokens are available"""
+        self._refill()
+        return max(0, (n - self.tokens) / self.rate)
+
+class RateLimiter(object):
+    """Keeps a TokenBucket per command, scope and key, where the scope is
+    "user" (keyed by hostmask) or "channel".
+
+    Limits are given as a dict mapping scopes to (capacity, period) pairs,
+    e.g. {"user": (3, 60), "channel": (10, 60)}.
+
+    Buckets that haven't been used for a whole period are full again, and
+    are forgotten to save memory.
+
+    """
+    SCOPES = ("user", "channel")
+
+    def __init__(self, maxsize=1000, clock=None):
+        self.maxsize = maxsize
+        self.clock = clock if clock is not None else reactor
+        # Maps (name, scope, capacity, period) to a TTLCache of buckets for
+        # that limit, keyed by hostmask or channel
+        self._buckets = {}
+        self.rejected = 0
+
+    def _bucket(self, name, scope, key, limit):
+        capacity, period = limit
+        try:
+            cache = self._buckets[(name, scope, capacity, period)]
+        except KeyError:
+            cache = self._buckets[(name, scope, capacity, period)] = TTLCache(
+                    period, maxsize=self.maxsize, clock=self.clock)
+        bucket = cache.get(key)
+        if bucket is None:
+            bucket = TokenBucket(capacity, period, clock=self.clock)
+        # Set it again to push back its expiry
+        cache[key] = bucket
+        return bucket
+
+    def check(self, name, limits, hostmask, channel):
+        """Takes a token from each of the buckets the limits apply to. If any
+        of them is empty, no tokens are taken, and the number of seconds until
+        the action would be allowed is returned. Otherwise returns 0.
+
+        """
+        buckets = []
+        for scope, key in (("user", hostmask), ("channel", channel)):
+            limit = limits.get(scope)
+            if limit and key is not None:
+                buckets.append(self._bucket(name, scope, key, limit))
+
+        wait = max([b.delay() for b in buckets] or [0])
+        if wait:
+            self.rejected += 1
+            return wait
+        for bucket in buckets:
+            bucket.consume()
+        return 0
+
+    def clear(self):
+        self._buckets.clear()
@@ -0,0 +1,193 @@
+from . import pluginbase
+from . import transport
+from .pluginbase import BotPlugin
+
+from twisted.internet import reactor
+from twisted.python import log
+
+import json
+import os
+import os.path
+import random
+import shutil
+import sys
+import tempfile
+import time
+from optparse import OptionParser
+
+"""
+Replays a recording made by the recorder.Recorder plugin through a bot's
+plugins, for benchmarking and regression testing dispatch.
+
+The given config directory is copied to a temporary directory first, so
+plugins that save their config or state don't touch the original. Every
+configured plugin is loaded except the recorder and the IRC connection. The
+IRC connection is replaced with a stub that provides what other plugins ask of
+it and swallows the outgoing irc.do_* events. The random module is seeded so
+plugins that roll dice behave the same on every run.
+
+Usage: python -m abbott.replay [--speed=max|recorded] <config dir> <recording>
+
+"""
+
+IRC_PLUGIN = "irc.IRCBotPlugin"
+# Not loaded, so a replay doesn't get recorded again
+RECORDER_PLUGIN = "recorder.Recorder"
+
+class _StubClient(object):
+    def __init__(self, nickname):
+        self.nickname = nickname
+
+class StubIRCPlugin(BotPlugin):
+    """Stands in for irc.IRCBotPlugin without connecting anywhere. Counts the
+    outgoing events it would have sent.
+
+    """
+    def start(self):
+        super(StubIRCPlugin, self).start()
+        self.client = _StubClient(self.config.get("nick", "abbott"))
+        self.sent = 0
+        self.listen_for_event("irc.do_*")
+        self.provides_request("irc.getnick")
+
+    def received_event(self, event):
+        self.sent += 1
+
+    def on_request_irc_getnick(self):
+        return self.client.nickname
+
+def make_event(eventtype, attrs):
+    attrs = dict((str(k), v) for k, v in attrs.iteritems())
+    try:
+        return transport.new_event(str(eventtype), **attrs)
+    except AttributeError:
+        # The recording has attributes the declared class doesn't. It was
+        # probably made with an older version
+        return transport.Event(str(eventtype), **attrs)
+
+def read_recording(filename):
+    with open(filename, "r") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+def load_plugins(configdir, transportobj):
+    boss = pluginbase.PluginBoss(configdir, transportobj)
+
+    stub = StubIRCPlugin(IRC_PLUGIN, transportobj, boss)
+    stub.start()
+    boss.loaded_plugins[IRC_PLUGIN] = stub
+
+    for plugin_name in boss.config['core']['plugins']:
+        if plugin_name in (IRC_PLUGIN, RECORDER_PLUGIN):
+            continue
+        try:
+            boss.load_plugin(plugin_name)
+        except Exception:
+            # Likely a missing optional dependency. Carry on without it.
+            log.err(None, "Could not load plugin %s, skipping it" % plugin_name)
+    return boss
+
+def report(transportobj, stub, count, elapsed):
+    print
+    print "Replayed %d events in %.2fs (%.0f events/s)" % (
+            count, elapsed, count / elapsed if elapsed else 0)
+    print "%d outgoing IRC events" % stub.sent
+    if transportobj.dropped_events or transportobj.shed_events:
+        print "%d events dropped, %d best effort events skipped" % (
+                transportobj.dropped_events, transportobj.shed_events)
+    print
+    print "Time per plugin:"
+    by_plugin = sorted(transportobj.stats.by_plugin().iteritems(),
+            key=lambda item: item[1].total, reverse=True)
+    for plugin_name, histogram in by_plugin:
+        print "  %-30s %8.3fs  %s" % (plugin_name, histogram.total,
+                histogram.format())
+    print
+    print "Busiest handlers:"
+    for (plugin_name, kind, name), histogram in transportobj.stats.top(10):
+        print "  %s %s %s: %s" % (plugin_name, kind, name, histogram.format())
+
+def main():
+    parser = OptionParser(usage="%prog [options] <config dir> <recording>")
+    parser.add_option("--speed", choices=["max", "recorded"], default="max",
+            help="replay as fast as possible (the default), or with the "
+            "recorded delays between events")
+    parser.add_option("--seed", type="int", default=0,
+            help="seed for the random module")
+    parser.add_option("--verbose", action="store_true",
+            help="log to stdout")
+    options, args = parser.parse_args()
+    if len(args) != 2:
+        parser.error("A config dir and a recording are required")
+    configdir, recording = args
+
+    if options.verbose:
+        log.startLogging(sys.stdout)
+
+    tempdir = tempfile.mkdtemp(prefix="abbott-replay-")
+    workdir = os.path.join(tempdir, "config")
+    shutil.copytree(configdir, workdir)
+    recording = os.path.abspath(recording)
+    # Plugins that write files relative to the working directory shouldn't
+    # touch the real ones either. Import the plugin modules first, since the
+    # import path may be relative to the working directory.
+    with open(os.path.join(configdir, "config.json")) as f:
+        for plugin_name in json.load(f)['core']['plugins']:
+            try:
+                __import__("abbott.plugins." + plugin_name.split(".")[0])
+            except Exception:
+                # load_plugins() will report it
+                pass
+    os.chdir(tempdir)
+
+    random.seed(options.seed)
+    transportobj = transport.Transport()
+    boss = load_plugins(workdir, transportobj)
+    transportobj.configure(boss.config['core'].get('transport', {}))
+    stub = boss.loaded_plugins[IRC_PLUGIN]
+
+    events = [(ts, make_event(eventtype, attrs))
+            for ts, eventtype, attrs in read_recording(recording)]
+    if not events:
+        print "The recording is empty"
+        return
+
+    def finish(start):
+        if transportobj.queue_length():
+            reactor.callLater(0, finish, start)
+            return
+        elapsed = time.time() - start
+        report(transportobj, stub, len(events), elapsed)
+        for plugin_name in list(boss.loaded_plugins):
+            if plugin_name != IRC_PLUGIN:
+                try:
+                    boss.unload_plugin(plugin_name)
+                except Exception:
+                    log.err()
+        reactor.stop()
+        shutil.rmtree(tempdir, ignore_errors=True)
+
+    def feed_max():
+        start = time.time()
+        for _, event in events:
+            transportobj.send_event(event)
+        # Let anything the events queued or scheduled with no delay run too
+        reactor.callLater(0, finish, start)
+
+    def feed_recorded():
+        start = time.time()
+        first = events[0][0]
+        for ts, event in events:
+            reactor.callLater(ts - first, transportobj.send_event, event)
+        reactor.callLater(events[-1][0] - first, finish, start)
+
+    if options.speed == "max":
+        reactor.callWhenRunning(feed_max)
+    else:
+        reactor.callWhenRunning(feed_recorded)
+    reactor.run()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+from timeit import default_timer as timer
+
+"""
+In-memory instrumentation for the transport layer.
+
+The transport times every middleware call, event listener call and request it
+makes, and records them here keyed by the plugin that handled them, the kind
+of hook ("middleware", "event" or "request") and the event or request name.
+Nothing is persisted; the numbers cover the time since the bot started or
+since the last reset().
+
+The command framework keeps a CommandStats object per command name as well.
+
+"""
+
+class Histogram(object):
+    """Counts latencies into fixed, roughly logarithmic buckets, and keeps a
+    running total and maximum. Memory use is constant no matter how many
+    samples are added.
+
+    """
+    # Upper bounds of each bucket, in seconds. There is one more bucket for
+    # everything above the last bound.
+    BOUNDS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+
+    __slots__ = ("buckets", "count", "errors", "total", "max")
+
+    def __init__(self):
+        self.buckets = [0] * (len(self.BOUNDS) + 1)
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds, error=False):
+        self.count += 1
+        if error:
+            self.errors += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+        for i, bound in enumerate(self.BOUNDS):
+            if seconds <= bound:
+                self.buckets[i] += 1
+                break
+        else:
+            self.buckets[-1] += 1
+
+    @property
+    def mean(self):
+        if not self.count:
+            return 0.0
+        return self.total / self.count
+
+    def percentile(self, p):
+        """Returns an upper bound for the pth percentile latency, where p is
+        between 0 and 100. This is the upper bound of the bucket the
+        percentile falls in, or the maximum seen if it falls in the last one.
+
+        """
+        if not self.count:
+            return 0.0
+        wanted = self.count * p / 100.0
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= wanted and n:
+                if i < len(self.BOUNDS):
+                    return min(self.BOUNDS[i], self.max)
+                break
+        return self.max
+
+    def format(self):
+        return "n={0} mean={1:.1f}ms p95={2:.1f}ms max={3:.1f}ms errors={4}".format(
+                self.count,
+                self.mean * 1000,
+                self.percentile(95) * 1000,
+                self.max * 1000,
+                self.errors,
+                )
+
+class Stats(object):
+    """Holds a Histogram for each (plugin name, kind, name) key"""
+    def __init__(self):
+        self.histograms = {}
+
+    def record(self, plugin_name, kind, name, seconds, error=False):
+        key = (plugin_name, kind, name)
+        try:
+            histogram = self.histograms[key]
+        except KeyError:
+            histogram = self.histograms[key] = Histogram()
+        histogram.add(seconds, error)
+
+    def reset(self):
+        self.histograms.clear()
+
+    def top(self, n=None, plugin_name=None):
+        """Returns a list of (key, histogram) tuples, ordered by the total
+        time spent, most first. If plugin_name is given, only that plugin's
+        entries are included. If n is given, at most n entries are returned.
+
+        """
+        items = [(key, h) for key, h in self.histograms.iteritems()
+                if plugin_name is None or key[0] == plugin_name]
+        items.sort(key=lambda item: item[1].total, reverse=True)
+        if n is not None:
+            del items[n:]
+        return items
+
+    def by_plugin(self):
+        """Returns a dict mapping plugin names to a Histogram merging all of
+        that plugin's entries
+
+        """
+        merged = {}
+        for (plugin_name, _, _), h in self.histograms.iteritems():
+            try:
+                m = merged[plugin_name]
+            except KeyError:
+                m = merged[plugin_name] = Histogram()
+            m.count += h.count
+            m.errors += h.errors
+            m.total += h.total
+            m.max = max(m.max, h.max)
+            m.buckets = [a + b for a, b in zip(m.buckets, h.buckets)]
+        return merged
+
+class CommandStats(object):
+    """Counts how often one command was invoked, denied, rate limited and
+    asked for help on, and how long its callback took to complete. For
+    callbacks returning a deferred, that's until the deferred fired.
+
+    For commands with a concurrency limit, queued is the number of
+    invocations currently waiting for a slot, and queue_full counts the ones
+    turned away because the queue was full.
+
+    """
+    __slots__ = ("invocations", "denials", "ratelimited", "helps", "latency",
+            "queued", "queue_full")
+
+    def __init__(self):
+        self.invocations = 0
+        self.denials = 0
+        self.ratelimited = 0
+        self.helps = 0
+        self.latency = Histogram()
+        self.queued = 0
+        self.queue_full = 0
+
+    def format(self):
+        return "calls={0} denied={1} limited={2} help={3} queued={4} full={5} {6}".format(
+                self.invocations,
+                self.denials,
+                self.ratelimited,
+                self.helps,
+                self.queued,
+                self.queue_full,
+                self.latency.format(),
+                )
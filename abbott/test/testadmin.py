@@ -0,0 +1,48 @@
+from twisted.internet import defer, task
+from twisted.trial import unittest
+
+from ..transport import Transport
+from ..plugins.admin import IRCAdmin
+from ..plugins.ircutil import WhoisTimedout
+from .testcommand import FakeBoss
+
+
+class Whois(object):
+    plugin_name = "ircutil.IRCWhois"
+
+    def __init__(self):
+        self.pending = []
+
+    def incoming_request(self, name, nick):
+        d = defer.Deferred()
+        self.pending.append(nick)
+        return d
+
+
+class TestNickToHostmask(unittest.TestCase):
+
+    def setUp(self):
+        self.transport = Transport()
+        self.transport.clock = task.Clock()
+        self.whois = Whois()
+        self.transport.provides_request("irc.whois", self.whois)
+        self.boss = FakeBoss(self.transport)
+        self.admin = self.boss.load(IRCAdmin, "admin.IRCAdmin")
+
+    def lookup(self, nick):
+        results = []
+        self.admin._nick_to_hostmask(nick).addBoth(results.append)
+        return results
+
+    def test_hostmask_passed_through(self):
+        self.assertEquals(["*!*@host"], self.lookup("*!*@host"))
+        self.assertEquals(["$a:alice"], self.lookup("$a:alice"))
+        self.assertEquals([], self.whois.pending)
+
+    def test_deadline(self):
+        results = self.lookup("bob")
+        self.assertEquals(["bob"], self.whois.pending)
+        self.transport.clock.advance(IRCAdmin.whois_deadline - 1)
+        self.assertEquals([], results)
+        self.transport.clock.advance(1)
+        results[0].trap(WhoisTimedout)
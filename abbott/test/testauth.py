@@ -0,0 +1,274 @@
+from twisted.trial import unittest
+from twisted.internet import task
+
+from ..transport import Transport, Event
+from ..plugins.auth import Auth, IdentityCache, PermissionTrie, satisfies
+from ..plugins.corecontrol import Help
+from .testcommand import FakeBoss, Commands
+
+
+class FakeMatch(object):
+    def __init__(self, **groups):
+        self.groups = groups
+
+    def groupdict(self):
+        return self.groups
+
+
+class TestPermissionTrie(unittest.TestCase):
+
+    GRANTS = ["irc.op", "admin.*", "admin.*.foo", "*", "fun", "a*b.c", ""]
+    REQUIRED = ["irc.op", "irc.op.kick", "irc.open", "irc", "admin",
+            "admin.x", "admin.x.foo", "admin.x.y.foo", "fun.roll", "funny",
+            "ab.c", "axyb.c.d", "ab.cd", "anything", ""]
+
+    def test_same_as_satisfies(self):
+        for grant in self.GRANTS:
+            trie = PermissionTrie([[None, grant]])
+            for required in self.REQUIRED:
+                self.assertEquals(satisfies(grant, required),
+                        trie.granted(required, None),
+                        "%r granting %r" % (grant, required))
+
+    def test_channels(self):
+        trie = PermissionTrie([
+            ["#a", "irc.op"],
+            ["#b", "irc.*"],
+            [None, "irc.op.kick"],
+            ["#c", "fun"],
+            ])
+        self.assertEquals(set(["#a", "#b", None]), trie.channels_for("irc.op.kick"))
+        self.assertEquals(set(["#a", "#b"]), trie.channels_for("irc.op"))
+        self.assertEquals(set(), trie.channels_for("irc"))
+        self.assertTrue(trie.granted("irc.op.kick", "#z"))
+        self.assertTrue(trie.granted("fun.roll", "#c"))
+        self.assertFalse(trie.granted("fun.roll", "#a"))
+        self.assertFalse(trie.granted("fun.roll", None))
+
+
+class RawListener(object):
+    """Collects the lines plugins send to the server"""
+    plugin_name = "test.RawListener"
+
+    def __init__(self):
+        self.lines = []
+
+    def received_event(self, event):
+        self.lines.append(event.line)
+
+
+class TestIdentityCache(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.cache = IdentityCache(3600, 60, 2, clock=self.clock)
+
+    def test_negative_ttl(self):
+        self.cache.store("alice!a@host", "alice")
+        self.cache.store("mallory!m@host", None)
+        self.clock.advance(60)
+        self.assertEquals("alice", self.cache.lookup("alice!a@host"))
+        self.assertRaises(KeyError, self.cache.lookup, "mallory!m@host")
+
+    def test_other_hostmask(self):
+        self.cache.store("alice!a@host", "alice")
+        self.assertRaises(KeyError, self.cache.lookup, "alice!x@elsewhere")
+        self.assertEquals((0, 1), (self.cache.hits, self.cache.misses))
+        self.assertEquals(0, len(self.cache))
+
+    def test_bounded(self):
+        for i in range(10):
+            self.cache.store("user%d!u@host" % i, None)
+        self.assertEquals(2, len(self.cache))
+        self.assertEquals([], self.clock.getDelayedCalls())
+
+    def test_forget(self):
+        self.cache.store("alice!a@host", "alice")
+        self.cache.forget("alice!a@host")
+        self.cache.forget("nobody")
+        self.assertEquals(0, len(self.cache))
+
+
+class TestPermissionDecisions(unittest.TestCase):
+
+    def setUp(self):
+        self.transport = Transport()
+        self.boss = FakeBoss(self.transport)
+        self.auth = self.boss.load(Auth, "auth.Auth")
+        self.auth.permissions["alice"] = [[None, "irc.op"], ["#chan", "admin.*"]]
+        self.auth._save()
+        self.auth.authd_users.store("alice!a@host", "alice")
+        self.auth.authd_users.store("mallory!m@host", None)
+        self.replies = []
+
+    def has_permission(self, hostmask, permission, channel=None):
+        results = []
+        self.auth._has_permission(hostmask, permission, channel).addCallback(
+                results.append)
+        return results[0]
+
+    def event(self):
+        return Event("irc.on_privmsg", user="root!r@host", channel="#chan",
+                reply=self.replies.append)
+
+    def test_decisions(self):
+        self.assertTrue(self.has_permission("alice!a@host", "irc.op.kick"))
+        self.assertTrue(self.has_permission("alice!a@host", "admin.foo", "#chan"))
+        self.assertFalse(self.has_permission("alice!a@host", "admin.foo", "#other"))
+        self.assertFalse(self.has_permission("mallory!m@host", "irc.op"))
+        self.assertTrue(self.has_permission("mallory!m@host", None))
+
+    def test_memoized(self):
+        self.has_permission("alice!a@host", "irc.op.kick", "#chan")
+        self.assertEquals({("alice", "irc.op.kick", "#chan"): True},
+                self.auth.decisions)
+
+    def test_grant_invalidates(self):
+        self.assertFalse(self.has_permission("alice!a@host", "auth.edit"))
+        self.auth.permission_add(self.event(),
+                FakeMatch(name="alice", perm="auth", channel=None))
+        self.assertTrue(self.has_permission("alice!a@host", "auth.edit"))
+
+    def test_revoke_invalidates(self):
+        self.assertTrue(self.has_permission("alice!a@host", "irc.op"))
+        self.auth.permission_revoke(self.event(),
+                FakeMatch(name="alice", perm="irc.op", channel=None))
+        self.assertFalse(self.has_permission("alice!a@host", "irc.op"))
+
+    def test_default_invalidates(self):
+        self.assertFalse(self.has_permission("mallory!m@host", "fun.roll"))
+        self.auth.add_default(self.event(), FakeMatch(perm="fun", channel=None))
+        self.assertTrue(self.has_permission("mallory!m@host", "fun.roll"))
+        self.auth.revoke_default(self.event(), FakeMatch(perm="fun", channel=None))
+        self.assertFalse(self.has_permission("mallory!m@host", "fun.roll"))
+
+    def test_identity_change(self):
+        self.assertTrue(self.has_permission("alice!a@host", "irc.op"))
+        self.auth.authd_users.store("alice!a@host", None)
+        self.assertFalse(self.has_permission("alice!a@host", "irc.op"))
+
+    def test_where_permission(self):
+        results = []
+        self.auth._where_permission("alice!a@host", "admin.foo").addCallback(
+                results.append)
+        self.assertEquals(set(["#chan"]), results[0])
+        # Changing the returned set doesn't change the memo
+        results[0].add("#other")
+        self.assertEquals(set(["#chan"]),
+                self.auth.authname_where_permission("alice", "admin.foo"))
+
+    def test_would_have_permission(self):
+        self.auth.authd_users.store("alice!a@otherhost", None)
+        self.assertTrue(self.auth.would_have_permission("alice!a@otherhost",
+            "alice", "irc.op", "#chan"))
+        self.assertRaises(KeyError, self.auth.authd_users.lookup,
+                "alice!a@otherhost")
+        self.assertFalse(self.auth.would_have_permission("mallory!m@host",
+            "mallory", "irc.op", "#chan"))
+
+    def test_account_tracking(self):
+        class Accounts(object):
+            plugin_name = "irc.IRCBotPlugin"
+            def incoming_request(self, name, hostmask):
+                return {"alice!a@elsewhere": "alice"}[hostmask]
+        self.transport.provides_request("irc.account", Accounts())
+        # Known to the server's account tracking, no whois needed
+        self.assertTrue(self.has_permission("alice!a@elsewhere", "irc.op"))
+        self.assertRaises(KeyError, self.auth.authd_users.lookup,
+                "alice!a@elsewhere")
+
+    def test_identity_invalidation(self):
+        self.transport.send_event(Event("irc.on_nick_change",
+            oldnick="alice", newnick="alice_"))
+        self.transport.send_event(Event("irc.on_user_quit",
+            user="mallory", message="bye"))
+        self.assertEquals(0, len(self.auth.authd_users))
+        self.auth.authd_users.store("alice!a@host", "alice")
+        self.transport.send_event(Event("irc.on_account_change",
+            user="alice!a@host", account=None))
+        self.assertEquals(0, len(self.auth.authd_users))
+
+    def test_whox(self):
+        class Supports(object):
+            plugin_name = "irc.IRCBotPlugin"
+            def incoming_request(self, name, feature):
+                return feature == "WHOX"
+        listener = RawListener()
+        self.transport.listen_for_event("irc.do_raw", listener)
+        self.transport.provides_request("irc.supports", Supports())
+
+        self.transport.send_event(Event("irc.on_join", channel="#big"))
+        self.assertEquals(["WHO #big %tuhna,472"], listener.lines)
+        for params in [
+                ["abbott", "472", "b", "host", "bob", "bob"],
+                ["abbott", "472", "e", "host", "eve", "0"],
+                ["abbott", "999", "t", "host", "trudy", "alice"],
+                ]:
+            self.transport.send_event(Event("irc.on_unknown", prefix="server",
+                command="354", params=params))
+        self.assertEquals("bob", self.auth.authd_users.lookup("bob!b@host"))
+        self.assertEquals(None, self.auth.authd_users.lookup("eve!e@host"))
+        self.assertRaises(KeyError, self.auth.authd_users.lookup,
+                "trudy!t@host")
+
+    def test_no_whox(self):
+        listener = RawListener()
+        self.transport.listen_for_event("irc.do_raw", listener)
+        self.transport.send_event(Event("irc.on_join", channel="#big"))
+        self.assertEquals([], listener.lines)
+
+    def test_where_permissions(self):
+        results = []
+        self.auth._where_permissions("alice!a@host",
+                ["admin.foo", "irc.op", None, "nothing"]).addCallback(
+                        results.append)
+        self.assertEquals([set(["#chan"]), set([None]), set([None]), set()],
+                results[0])
+
+
+class TestHelp(unittest.TestCase):
+
+    def setUp(self):
+        self.transport = Transport()
+        self.boss = FakeBoss(self.transport)
+        self.auth = self.boss.load(Auth, "auth.Auth")
+        self.auth.permissions["alice"] = [[None, "irc.op"]]
+        self.auth._save()
+        self.auth.authd_users.store("alice!a@host", "alice")
+        self.help = self.boss.load(Help, "corecontrol.Help")
+        self.replies = []
+
+        self.lookups = 0
+        where = self.auth.authname_where_permission
+        def counting(*args):
+            self.lookups += 1
+            return where(*args)
+        self.auth.authname_where_permission = counting
+
+    def help_text(self):
+        del self.replies[:]
+        self.transport.send_event(Event("irc.on_privmsg",
+            user="alice!a@host", channel="#chan", message="!help",
+            direct=False, reply=lambda msg, **kwargs: self.replies.append(msg)))
+        return self.replies[1:-1]
+
+    def test_cached(self):
+        first = self.help_text()
+        lookups = self.lookups
+        self.assertTrue(lookups)
+        self.assertEquals(first, self.help_text())
+        self.assertEquals(lookups, self.lookups)
+
+    def test_new_commands(self):
+        first = self.help_text()
+        self.boss.load(Commands, "test.Commands")
+        self.assertNotEqual(first, self.help_text())
+        self.assertIn("votd", self.replies[1])
+
+    def test_permission_change(self):
+        self.help_text()
+        lookups = self.lookups
+        self.auth.add_default(Event("irc.on_privmsg", reply=self.replies.append),
+                FakeMatch(perm="fun", channel=None))
+        self.help_text()
+        self.assertNotEqual(lookups, self.lookups)
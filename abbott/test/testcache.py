@@ -0,0 +1,59 @@
+from twisted.trial import unittest
+from twisted.internet import task
+
+from ..cache import TTLCache
+
+
+class TestTTLCache(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.cache = TTLCache(10, maxsize=2, clock=self.clock)
+
+    def test_expiry(self):
+        self.cache["a"] = 1
+        self.clock.advance(9)
+        self.assertEquals(1, self.cache["a"])
+        self.clock.advance(1)
+        self.assertRaises(KeyError, self.cache.__getitem__, "a")
+        self.assertEquals(1, self.cache.hits)
+        self.assertEquals(1, self.cache.misses)
+
+    def test_lru_eviction(self):
+        self.cache["a"] = 1
+        self.cache["b"] = 2
+        # Touch a, so b is the least recently used
+        self.cache["a"]
+        self.cache["c"] = 3
+        self.assertIn("a", self.cache)
+        self.assertNotIn("b", self.cache)
+        self.assertIn("c", self.cache)
+
+    def test_clear_bumps_generation(self):
+        self.cache["a"] = 1
+        generation = self.cache.generation
+        self.cache.clear()
+        self.assertEquals(0, len(self.cache))
+        self.assertNotEquals(generation, self.cache.generation)
+
+    def test_expire(self):
+        self.cache["a"] = 1
+        self.clock.advance(5)
+        self.cache["b"] = 2
+        self.clock.advance(5)
+        self.cache.expire()
+        self.assertEquals(["b"], self.cache.keys())
+
+    def test_own_ttl(self):
+        self.cache.set("a", 1, ttl=1)
+        self.cache["b"] = 2
+        self.clock.advance(1)
+        self.assertNotIn("a", self.cache)
+        self.assertIn("b", self.cache)
+
+    def test_hit_rate(self):
+        self.assertEquals(0, self.cache.hit_rate())
+        self.cache["a"] = 1
+        self.cache.get("a")
+        self.cache.get("b")
+        self.assertEquals(0.5, self.cache.hit_rate())
@@ -0,0 +1,100 @@
+from twisted.trial import unittest
+
+from ..cmdargs import Arg, ArgParser, parse_duration
+
+BAN_ARGS = [
+    Arg("nick", "hostmask"),
+    Arg("duration", "duration", optional=True, keyword="for"),
+    Arg("reason", "rest", optional=True),
+    ]
+
+class TestArgParser(unittest.TestCase):
+
+    def setUp(self):
+        self.ban = ArgParser(BAN_ARGS)
+
+    def test_duration(self):
+        self.assertEquals(90, parse_duration("1m30s"))
+        self.assertEquals(60*60*24*7 + 2, parse_duration("1w2s"))
+        self.assertRaises(ValueError, parse_duration, "1x")
+        self.assertRaises(ValueError, parse_duration, "")
+
+    def test_required_only(self):
+        m = self.ban.parse("someone")
+        self.assertEquals({"nick": "someone", "duration": None, "reason": None},
+                m.groupdict())
+
+    def test_missing_required(self):
+        self.assertEquals(None, self.ban.parse(""))
+
+    def test_keyword(self):
+        m = self.ban.parse("*!*@host for 1h30m being rude")
+        self.assertEquals("*!*@host", m.group("nick"))
+        self.assertEquals(5400, m.group("duration"))
+        self.assertEquals("being rude", m.group("reason"))
+
+    def test_keyword_optional(self):
+        m = self.ban.parse("someone 10m")
+        self.assertEquals(600, m.group("duration"))
+        self.assertEquals(None, m.group("reason"))
+
+    def test_keyword_without_value(self):
+        # "for" isn't followed by a duration, so it's part of the reason
+        m = self.ban.parse("someone for being rude")
+        self.assertEquals(None, m.group("duration"))
+        self.assertEquals("for being rude", m.group("reason"))
+
+    def test_rest_keeps_spacing(self):
+        m = self.ban.parse("someone  spaced   out ")
+        self.assertEquals("spaced   out ", m.group("reason"))
+
+    def test_leftover(self):
+        parser = ArgParser([Arg("pos", "int"), Arg("text")])
+        self.assertEquals(None, parser.parse("1 two three"))
+        m = parser.parse("-1 two")
+        self.assertEquals((-1, "two"), m.group("pos", "text"))
+
+    def test_types(self):
+        parser = ArgParser([
+            Arg("channel", "channel", optional=True),
+            Arg("nick", "nick"),
+            ])
+        self.assertEquals("#abbott", parser.parse("#abbott nick").group("channel"))
+        self.assertEquals(None, parser.parse("nick").group("channel"))
+        self.assertEquals(None, parser.parse("#abbott 1nick"))
+
+    def test_custom_type(self):
+        def color(s):
+            if s not in ("red", "green"):
+                raise ValueError(s)
+            return s.upper()
+        parser = ArgParser([Arg("color", color)])
+        self.assertEquals("RED", parser.parse("red").group("color"))
+        self.assertEquals(None, parser.parse("blue"))
+
+    def test_groupdict_default(self):
+        m = self.ban.parse("someone")
+        self.assertEquals("", m.groupdict("")["reason"])
+
+    def test_usage(self):
+        self.assertEquals("<nick> [for <duration>] [<reason>]", self.ban.usage())
+
+    def test_bad_spec(self):
+        self.assertRaises(ValueError, ArgParser, [Arg("a", "rest"), Arg("b")])
+        self.assertRaises(ValueError, Arg, "a", "nosuchtype")
+
+    def test_pattern(self):
+        pattern = self.ban.pattern(r"(?:ban|BAN)")
+        m = pattern.match("ban someone for 1d")
+        self.assertEquals("ban someone for 1d", m.group(0))
+        self.assertEquals(86400, m.group("duration"))
+        self.assertEquals(None, pattern.match("banana"))
+        self.assertEquals(None, pattern.match("ban"))
+
+    def test_linear(self):
+        # Lines like this made the old unquiet regex backtrack for ages
+        unquiet = ArgParser([
+            Arg("nick", "hostmask"),
+            Arg("duration", "duration", optional=True, keyword="in"),
+            ])
+        self.assertEquals(None, unquiet.parse("x " + "1m" * 5000 + "!"))
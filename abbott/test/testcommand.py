@@ -0,0 +1,306 @@
+from collections import defaultdict
+
+from twisted.internet import defer, task
+from twisted.trial import unittest
+
+from ..command import CommandPluginSuperclass, _CommandRouter
+from ..transport import Transport, Event
+from ..cmdargs import Arg
+from ..ratelimit import RateLimiter
+
+
+class FakeConfig(dict):
+    def save(self):
+        pass
+
+
+class FakeClient(object):
+    nickname = "abbott"
+
+
+class FakeIRCPlugin(object):
+    plugin_name = "irc.IRCBotPlugin"
+    client = FakeClient()
+
+
+class FakeAuth(object):
+    plugin_name = "auth.Auth"
+
+    def would_have_permission(self, hostmask, authname, permission, channel):
+        return False
+
+
+class FakeBoss(object):
+    """Just enough of a PluginBoss to load command plugins"""
+    def __init__(self, transport):
+        self.transport = transport
+        self.config = {"command": {"prefix": "!"}}
+        self.loaded_plugins = {"irc.IRCBotPlugin": FakeIRCPlugin()}
+        self.configs = defaultdict(FakeConfig)
+
+    def get_plugin_config(self, plugin_name):
+        return self.configs[plugin_name]
+
+    def load(self, cls, plugin_name):
+        plugin = cls(plugin_name, self.transport, self)
+        plugin.start()
+        self.loaded_plugins[plugin_name] = plugin
+        return plugin
+
+
+class Commands(CommandPluginSuperclass):
+    def start(self):
+        super(Commands, self).start()
+        self.calls = []
+
+        self.install_command(
+                cmdname="ping",
+                callback=self.called,
+                )
+        self.install_command(
+                cmdname="convert",
+                cmdmatch="convert|units?",
+                argmatch="(?P<arg>.+)$",
+                callback=self.called,
+                )
+        self.install_command(
+                cmdname="ban",
+                prefix=".",
+                argmatch="(?P<arg>.+)$",
+                callback=self.called,
+                )
+        self.install_command(
+                cmdname="weird",
+                cmdmatch="w(?:ei|ie)rd",
+                callback=self.called,
+                )
+        group = self.install_cmdgroup(
+                grpname="votd",
+                helptext="Voice of the Day",
+                )
+        group.install_command(
+                cmdname="enable",
+                callback=self.called,
+                )
+
+    def called(self, event, match):
+        self.calls.append(match.group(0))
+
+
+class TestCommandRouter(unittest.TestCase):
+
+    def setUp(self):
+        self.transport = Transport()
+        self.boss = FakeBoss(self.transport)
+        self.plugin = self.boss.load(Commands, "test.Commands")
+        self.replies = []
+
+    def send(self, message, direct=False):
+        self.transport.send_event(Event("irc.on_privmsg",
+            user="someone!user@host",
+            channel="someone" if direct else "#channel",
+            message=message,
+            direct=direct,
+            reply=lambda msg, **kwargs: self.replies.append(msg),
+            has_permission=lambda perm, channel: defer.succeed(True),
+            where_permission=lambda perm: defer.succeed([None]),
+            where_permissions=lambda perms: defer.succeed([[None]] * len(perms)),
+            ))
+
+    def test_prefixes(self):
+        self.send("!ping")
+        self.send("abbott: ping")
+        self.send("ping", direct=True)
+        self.assertEquals(["ping"]*3, self.plugin.calls)
+
+    def test_chatter_ignored(self):
+        self.send("ping")
+        self.send("!pingpong")
+        self.send("some ordinary chatter")
+        self.assertEquals([], self.plugin.calls)
+        self.assertEquals([], self.replies)
+
+    def test_alternatives(self):
+        self.send("!units 5 m")
+        self.send("!unit 5 m")
+        self.send("!convert 5 m")
+        self.send("!unitsx")
+        self.assertEquals(["units 5 m", "unit 5 m", "convert 5 m"], self.plugin.calls)
+
+    def test_command_prefix(self):
+        self.send(".ban someone")
+        self.assertEquals([".ban someone"], self.plugin.calls)
+
+    def test_fallback(self):
+        self.send("!weird")
+        self.send("!wierd")
+        self.assertEquals(["weird", "wierd"], self.plugin.calls)
+
+    def test_group(self):
+        self.send("!votd enable")
+        self.assertEquals(["votd enable"], self.plugin.calls)
+        self.send("!votd bogus")
+        self.assertIn("Voice of the Day", self.replies)
+
+    def test_help(self):
+        self.send("!help ping")
+        self.assertEquals([], self.plugin.calls)
+        self.assertIn("Usage: !ping ", self.replies)
+
+    def test_help_with_command_prefix(self):
+        self.send("!help .ban")
+        self.assertTrue(self.replies[0].startswith("Usage: .ban "))
+        self.assertEquals([], self.plugin.calls)
+
+    def test_unloaded_plugin(self):
+        del self.boss.loaded_plugins["test.Commands"]
+        self.send("!ping")
+        self.assertEquals([], self.plugin.calls)
+
+    def test_stopped_plugin(self):
+        router = _CommandRouter.for_plugin(self.plugin)
+        self.plugin.stop()
+        # Dropped right away, not when a line next matches
+        routes = (list(router.fallback) + list(router.group_fallback) +
+                [r for routes in router.by_word.values() for r in routes] +
+                [r for routes in router.groups.values() for r in routes])
+        self.assertEquals([], [r for r in routes if r[1] is self.plugin])
+
+    def test_reloaded_plugin(self):
+        new = self.boss.load(Commands, "test.Commands")
+        self.send("!ping")
+        self.assertEquals([], self.plugin.calls)
+        self.assertEquals(["ping"], new.calls)
+
+    def test_nick_set(self):
+        self.transport.send_event(Event("irc.on_nick_set", nick="abbott_"))
+        self.send("abbott: ping")
+        self.send("abbott_: ping")
+        self.assertEquals(["ping"], self.plugin.calls)
+
+    def test_leading_whitespace(self):
+        self.send("  .ban someone")
+        self.assertEquals([".ban someone"], self.plugin.calls)
+
+    def test_empty_prefix(self):
+        self.plugin.install_command(
+                cmdname="karma",
+                prefix="",
+                callback=self.plugin.called,
+                )
+        self.send("karma")
+        self.send("ping")
+        self.assertEquals(["karma"], self.plugin.calls)
+
+    def test_args(self):
+        matches = []
+        self.plugin.install_command(
+                cmdname="mute",
+                prefix=".",
+                args=[
+                    Arg("nick", "nick"),
+                    Arg("duration", "duration", optional=True, keyword="for"),
+                    ],
+                callback=lambda event, match: matches.append(match.groupdict()),
+                )
+        self.send("!mute someone for 5m")
+        self.send(".mute someone")
+        self.send("!mute")
+        self.assertEquals([
+            {"nick": "someone", "duration": 300},
+            {"nick": "someone", "duration": None},
+            ], matches)
+        self.assertEquals(["Usage: .mute <nick> [for <duration>]"],
+                [r for r in self.replies if r.startswith("Usage")])
+
+    def test_stats(self):
+        d = defer.Deferred()
+        self.plugin.install_command(
+                cmdname="slow",
+                callback=lambda event, match: d,
+                )
+        self.send("!ping")
+        self.send("!ping")
+        self.send("!help ping")
+        self.send("!slow")
+
+        stats = self.plugin.command_stats
+        self.assertEquals(2, stats["ping"].invocations)
+        self.assertEquals(2, stats["ping"].latency.count)
+        self.assertEquals(1, stats["ping"].helps)
+
+        # Not done until its deferred fires
+        self.assertEquals(1, stats["slow"].invocations)
+        self.assertEquals(0, stats["slow"].latency.count)
+        d.callback(None)
+        self.assertEquals(1, stats["slow"].latency.count)
+
+        results = []
+        self.transport.issue_request("command.stats").addCallback(results.append)
+        self.assertIs(stats, results[0])
+
+    def test_denied_stats(self):
+        def send_denied(message):
+            self.transport.send_event(Event("irc.on_privmsg",
+                user="someone!user@host", channel="#channel",
+                message=message, direct=False,
+                reply=lambda msg, **kwargs: self.replies.append(msg),
+                has_permission=lambda perm, channel: defer.succeed(False),
+                ))
+        self.boss.loaded_plugins["auth.Auth"] = FakeAuth()
+        send_denied("!ping")
+        self.assertEquals(1, self.plugin.command_stats["ping"].denials)
+        self.assertEquals(0, self.plugin.command_stats["ping"].invocations)
+
+    def test_ratelimit(self):
+        router = _CommandRouter.for_plugin(self.plugin)
+        router.ratelimiter = RateLimiter(clock=task.Clock())
+        self.plugin.install_command(
+                cmdname="spam",
+                callback=self.plugin.called,
+                ratelimit={"user": (2, 60)},
+                )
+        for _ in range(4):
+            self.send("!spam")
+        self.assertEquals(["spam", "spam"], self.plugin.calls)
+        # Told once, not for every message
+        self.assertEquals(1, len([r for r in self.replies if "too often" in r]))
+        self.assertEquals(2, self.plugin.command_stats["spam"].ratelimited)
+
+    def test_ratelimit_config(self):
+        router = _CommandRouter.for_plugin(self.plugin)
+        router.ratelimiter = RateLimiter(clock=task.Clock())
+        self.boss.config["command"]["ratelimits"] = {"ping": {"user": [1, 60]}}
+        self.plugin.reload()
+        self.send("!ping")
+        self.send("!ping")
+        self.assertEquals(["ping"], self.plugin.calls)
+
+    def test_concurrency(self):
+        running = []
+        self.plugin.install_command(
+                cmdname="slow",
+                callback=lambda event, match: running.append(defer.Deferred()) or running[-1],
+                concurrency=1,
+                queue=1,
+                )
+        self.send("!slow")
+        self.send("!slow")
+        self.send("!slow")
+        stats = self.plugin.command_stats["slow"]
+        # One running, one waiting its turn, one turned away
+        self.assertEquals(1, len(running))
+        self.assertEquals(1, stats.queued)
+        self.assertEquals(1, stats.queue_full)
+        self.assertEquals(1, len([r for r in self.replies if "busy" in r]))
+
+        running[0].callback(None)
+        self.assertEquals(2, len(running))
+        self.assertEquals(0, stats.queued)
+        running[1].errback(Exception("failed"))
+        self.failureResultOf(running[1])
+
+        # The slot is released even though the last one failed
+        self.send("!slow")
+        self.assertEquals(3, len(running))
+        self.assertEquals(3, stats.invocations)
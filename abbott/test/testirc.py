@@ -0,0 +1,144 @@
+from twisted.test.proto_helpers import StringTransport
+from twisted.trial import unittest
+
+from ..plugins.irc import IRCBot, IRCBotPlugin, UnknownAccount, parse_tags
+from ..transport import Transport
+
+
+class FakeConfig(dict):
+    def save(self):
+        pass
+
+
+class FakeFactory(object):
+    """Stands in for the IRCBotPlugin the protocol object talks to"""
+    def __init__(self):
+        self.config = FakeConfig(channels=[])
+        self.transport = Transport()
+        self.events = []
+
+    def broadcast_message(self, eventname, **kwargs):
+        self.events.append((eventname, kwargs))
+
+
+class TestAccountTracking(unittest.TestCase):
+
+    def setUp(self):
+        self.factory = FakeFactory()
+        self.bot = IRCBot()
+        self.bot.factory = self.factory
+        self.bot.nickname = "abbott"
+        self.wire = StringTransport()
+        self.bot.makeConnection(self.wire)
+
+    def sent(self):
+        lines = self.wire.value().splitlines()
+        self.wire.clear()
+        return lines
+
+    def receive(self, line):
+        self.bot.lineReceived(line)
+
+    def negotiate(self):
+        self.receive(":server CAP * LS * :multi-prefix sasl=PLAIN account-tag")
+        self.receive(":server CAP * LS :extended-join account-notify")
+        self.sent()
+        self.receive(":server CAP * ACK :account-notify account-tag extended-join")
+
+    def test_negotiation(self):
+        self.assertEquals("CAP LS 302", self.sent()[0])
+        self.receive(":server CAP * LS * :multi-prefix sasl=PLAIN account-tag")
+        # Waits for the rest of the list
+        self.assertEquals([], self.sent())
+        self.receive(":server CAP * LS :extended-join account-notify")
+        self.assertEquals(["CAP REQ :account-notify account-tag extended-join multi-prefix"],
+                self.sent())
+        self.receive(":server CAP * ACK :account-notify account-tag extended-join multi-prefix")
+        self.assertEquals(["CAP END"], self.sent())
+        self.assertEquals(IRCBot.wanted_caps, self.bot.caps)
+
+    def test_no_support(self):
+        self.sent()
+        self.receive(":server CAP * LS :sasl")
+        self.assertEquals(["CAP END"], self.sent())
+        self.receive("@account=alice :alice!a@host PRIVMSG #chan :hi")
+        self.assertRaises(KeyError, self.bot.account_for, "alice!a@host")
+
+    def test_extended_join(self):
+        self.negotiate()
+        self.receive(":alice!a@host JOIN #chan alice :Alice")
+        self.receive(":bob!b@host JOIN #chan * :Bob")
+        self.assertEquals("alice", self.bot.account_for("alice!a@host"))
+        self.assertEquals(None, self.bot.account_for("bob!b@host"))
+        self.assertIn(("irc.on_user_joined", {"user": "alice", "channel": "#chan"}),
+                self.factory.events)
+
+    def test_account_notify(self):
+        self.negotiate()
+        self.receive(":bob!b@host JOIN #chan * :Bob")
+        self.receive(":bob!b@host ACCOUNT bob")
+        self.assertEquals("bob", self.bot.account_for("bob!b@host"))
+        self.assertEquals(("irc.on_account_change",
+            {"user": "bob!b@host", "account": "bob"}), self.factory.events[-1])
+        self.receive(":bob!b@host ACCOUNT *")
+        self.assertEquals(None, self.bot.account_for("bob!b@host"))
+
+    def test_account_tag(self):
+        self.negotiate()
+        self.receive("@time=x;account=alice :alice!a@host PRIVMSG #chan :hi")
+        self.assertEquals("alice", self.bot.account_for("alice!a@host"))
+        self.receive(":alice!a@host PRIVMSG #chan :hi")
+        self.assertEquals(None, self.bot.account_for("alice!a@host"))
+
+    def test_nick_and_quit(self):
+        self.negotiate()
+        self.receive(":alice!a@host JOIN #chan alice :Alice")
+        self.receive("@account=alice :alice!a@host NICK alice_")
+        self.assertEquals("alice", self.bot.account_for("alice_!a@host"))
+        self.assertRaises(KeyError, self.bot.account_for, "alice!a@host")
+        self.receive(":alice_!a@host QUIT :bye")
+        self.assertRaises(KeyError, self.bot.account_for, "alice_!a@host")
+
+    def test_different_host(self):
+        self.negotiate()
+        self.receive(":alice!a@host JOIN #chan alice :Alice")
+        self.assertRaises(KeyError, self.bot.account_for, "alice!a@elsewhere")
+
+    def test_request(self):
+        self.negotiate()
+        self.receive(":alice!a@host JOIN #chan alice :Alice")
+        plugin = IRCBotPlugin.__new__(IRCBotPlugin)
+        plugin.client = self.bot
+        self.assertEquals("alice", plugin.on_request_irc_account("alice!a@host"))
+        self.assertRaises(UnknownAccount, plugin.on_request_irc_account,
+                "bob!b@host")
+        plugin.client = None
+        self.assertRaises(UnknownAccount, plugin.on_request_irc_account,
+                "alice!a@host")
+
+    def test_parse_tags(self):
+        self.assertEquals({"a": "b c;d", "flag": ""},
+                parse_tags(r"a=b\sc\:d\;flag"))
+
+
+class TestOwnEvents(unittest.TestCase):
+
+    def setUp(self):
+        self.factory = FakeFactory()
+        self.bot = IRCBot()
+        self.bot.factory = self.factory
+        self.bot.nickname = "abbott"
+        self.bot.makeConnection(StringTransport())
+
+    def test_kicked(self):
+        self.factory.config["channels"].append("#chan")
+        self.bot.lineReceived(":alice!a@host KICK #chan abbott :out")
+        self.assertEquals(("irc.on_kicked",
+            {"channel": "#chan", "kicker": "alice", "message": "out"}),
+            self.factory.events[-1])
+        # Still rejoined on reconnect
+        self.assertEquals(["#chan"], self.factory.config["channels"])
+
+    def test_disconnected(self):
+        self.bot.connectionLost(None)
+        self.assertEquals(("irc.on_disconnected", {}), self.factory.events[-1])
@@ -0,0 +1,308 @@
+from twisted.internet import task
+from twisted.trial import unittest
+
+from ..transport import Transport, Event
+from ..plugins.ircutil import IRCWhois, Names, HasOp, NoSuchNick, \
+        WhoisTimedout
+from .testcommand import FakeBoss
+
+
+class TestIRCWhois(unittest.TestCase):
+    plugin_name = "test.Wire"
+
+    def setUp(self):
+        self.transport = Transport()
+        self.transport.clock = task.Clock()
+        self.boss = FakeBoss(self.transport)
+        self.boss.configs["ircutil.IRCWhois"]["window"] = 2
+        self.whois = self.boss.load(IRCWhois, "ircutil.IRCWhois")
+        self.sent = []
+        # Catch the whoises sent to the server
+        self.transport.listen_for_event("irc.do_whois", self)
+
+    def received_event(self, event):
+        self.sent.append(event.nickname)
+
+    def request(self, nick):
+        results = []
+        self.transport.issue_request("irc.whois", nick).addBoth(results.append)
+        return results
+
+    def reply(self, command, *params):
+        self.transport.send_event(Event("irc.on_unknown", prefix="server",
+            command=command, params=["abbott"] + list(params)))
+
+    def test_interleaved(self):
+        alice = self.request("alice")
+        bob = self.request("bob")
+        self.assertEquals(["alice", "bob"], self.sent)
+        self.reply("RPL_WHOISUSER", "bob", "b", "host", "*", "Bob")
+        self.reply("RPL_WHOISUSER", "alice", "a", "host", "*", "Alice")
+        self.reply("330", "alice", "alice", "is logged in as")
+        self.reply("RPL_ENDOFWHOIS", "alice", "End of WHOIS")
+        self.reply("RPL_ENDOFWHOIS", "Bob", "End of WHOIS")
+        self.assertEquals(["alice", "a", "host", "*", "Alice"],
+                alice[0]["RPL_WHOISUSER"])
+        self.assertIn("330", alice[0])
+        self.assertEquals(["bob", "b", "host", "*", "Bob"],
+                bob[0]["RPL_WHOISUSER"])
+        self.assertNotIn("330", bob[0])
+
+    def test_coalesced(self):
+        first = self.request("alice")
+        second = self.request("ALICE")
+        self.assertEquals(["alice"], self.sent)
+        self.reply("RPL_ENDOFWHOIS", "Alice", "End of WHOIS")
+        self.assertEquals({}, first[0])
+        self.assertEquals({}, second[0])
+
+    def test_window(self):
+        results = [self.request(nick) for nick in ["a", "b", "c"]]
+        self.assertEquals(["a", "b"], self.sent)
+        self.reply("RPL_ENDOFWHOIS", "b", "End of WHOIS")
+        self.assertEquals(["a", "b", "c"], self.sent)
+        self.assertEquals([], results[0])
+        self.assertEquals([{}], results[1])
+
+    def test_no_such_nick(self):
+        first = self.request("ghost")
+        self.reply("ERR_NOSUCHNICK", "ghost", "No such nick/channel")
+        self.assertTrue(first[0].check(NoSuchNick))
+        # A new whois for the same nick isn't sent until the old one ends,
+        # so its end can't be mistaken for the new one's
+        second = self.request("ghost")
+        self.assertEquals(["ghost"], self.sent)
+        self.reply("RPL_ENDOFWHOIS", "ghost", "End of WHOIS")
+        self.assertEquals(["ghost", "ghost"], self.sent)
+        self.assertEquals([], second)
+
+    def test_timeout(self):
+        result = self.request("slow")
+        self.request("other")
+        queued = self.request("queued")
+        self.transport.clock.advance(10)
+        self.assertTrue(result[0].check(WhoisTimedout))
+        self.assertEquals(["slow", "other", "queued"], self.sent)
+        self.assertEquals([], queued)
+
+    def test_cancel_queued(self):
+        self.request("a")
+        self.request("b")
+        d = self.transport.issue_request("irc.whois", "c")
+        d.addErrback(lambda f: None)
+        d.cancel()
+        self.reply("RPL_ENDOFWHOIS", "a", "End of WHOIS")
+        self.assertEquals(["a", "b"], self.sent)
+
+    def test_cached(self):
+        self.request("alice")
+        self.reply("RPL_WHOISUSER", "alice", "a", "host", "*", "Alice")
+        self.reply("RPL_ENDOFWHOIS", "alice", "End of WHOIS")
+        cached = self.request("Alice")
+        self.assertEquals(["alice"], self.sent)
+        self.assertEquals(["alice", "a", "host", "*", "Alice"],
+                cached[0]["RPL_WHOISUSER"])
+
+        # Changing a result doesn't change the cache
+        cached[0]["330"] = ["alice", "alice", "is logged in as"]
+        self.assertNotIn("330", self.request("alice")[0])
+
+        self.transport.issue_request("irc.whois", "alice", fresh=True)
+        self.assertEquals(["alice", "alice"], self.sent)
+
+    def test_cache_expiry(self):
+        self.request("alice")
+        self.reply("RPL_ENDOFWHOIS", "alice", "End of WHOIS")
+        self.transport.clock.advance(60)
+        self.request("alice")
+        self.assertEquals(["alice", "alice"], self.sent)
+
+    def test_cache_invalidation(self):
+        for nick in ["alice", "bob", "carol"]:
+            self.request(nick)
+            self.reply("RPL_ENDOFWHOIS", nick, "End of WHOIS")
+        self.transport.send_event(Event("irc.on_nick_change",
+            oldnick="alice", newnick="alice_"))
+        self.transport.send_event(Event("irc.on_user_quit",
+            user="bob", message="bye"))
+        self.transport.send_event(Event("irc.on_account_change",
+            user="carol!c@host", account="carol"))
+        del self.sent[:]
+        for nick in ["alice", "bob", "carol"]:
+            self.request(nick)
+        self.assertEquals(["alice", "bob"], self.sent)
+        self.assertIn("carol", self.whois.queued)
+
+    def test_failures_not_cached(self):
+        self.request("ghost")
+        self.reply("ERR_NOSUCHNICK", "ghost", "No such nick/channel")
+        self.reply("RPL_ENDOFWHOIS", "ghost", "End of WHOIS")
+        self.request("ghost")
+        self.assertEquals(["ghost", "ghost"], self.sent)
+
+
+class TestNames(unittest.TestCase):
+    plugin_name = "test.Wire"
+
+    def setUp(self):
+        self.transport = Transport()
+        self.transport.clock = task.Clock()
+        self.boss = FakeBoss(self.transport)
+        self.boss.load(Names, "ircutil.Names")
+        self.sent = []
+        # Catch the lines sent to the server
+        self.transport.listen_for_event("irc.do_raw", self)
+
+        self.send("irc.on_nick_set", nick="abbott")
+        self.send("irc.on_join", channel="#chan")
+        self.reply("RPL_NAMREPLY", "=", "#chan", "@abbott @+alice +bob")
+        self.reply("RPL_NAMREPLY", "=", "#chan", "carol")
+        self.reply("RPL_ENDOFNAMES", "#chan", "End of /NAMES list.")
+
+    def received_event(self, event):
+        self.sent.append(event.line)
+
+    def send(self, eventname, **kwargs):
+        self.transport.send_event(Event(eventname, **kwargs))
+
+    def reply(self, command, *params):
+        self.send("irc.on_unknown", prefix="server", command=command,
+                params=["abbott"] + list(params))
+
+    def request(self, channel, **kwargs):
+        results = []
+        self.transport.issue_request("irc.names", channel, **kwargs
+                ).addBoth(results.append)
+        return results
+
+    def names(self, channel="#chan"):
+        return sorted(self.request(channel)[0])
+
+    def test_from_memory(self):
+        self.assertEquals(["+bob", "@abbott", "@alice", "carol"], self.names())
+        self.assertEquals([], self.sent)
+
+    def test_interleaved_replies(self):
+        self.send("irc.on_join", channel="#other")
+        self.reply("RPL_NAMREPLY", "=", "#other", "@abbott dave")
+        d = self.request("#elsewhere")
+        self.reply("RPL_NAMREPLY", "=", "#elsewhere", "eve")
+        self.reply("RPL_ENDOFNAMES", "#other", "End of /NAMES list.")
+        self.reply("RPL_ENDOFNAMES", "#elsewhere", "End of /NAMES list.")
+        self.assertEquals(["@abbott", "dave"], self.names("#other"))
+        self.assertEquals([["eve"]], d)
+        self.assertEquals(["NAMES #elsewhere"], self.sent)
+
+    def test_request_while_joining(self):
+        self.send("irc.on_join", channel="#new")
+        d = self.request("#new")
+        self.assertEquals([], self.sent)
+        self.reply("RPL_ENDOFNAMES", "#new", "End of /NAMES list.")
+        self.assertEquals([[]], d)
+
+    def test_membership(self):
+        self.send("irc.on_user_joined", user="dave", channel="#chan")
+        self.send("irc.on_user_part", user="bob", channel="#chan")
+        self.send("irc.on_user_kick", kickee="carol", channel="#chan",
+                kicker="alice", message="out")
+        self.assertEquals(["@abbott", "@alice", "dave"], self.names())
+        self.send("irc.on_nick_change", oldnick="dave", newnick="Dave")
+        self.send("irc.on_user_quit", user="alice", message="bye")
+        self.assertEquals(["@abbott", "Dave"], self.names())
+        self.send("irc.on_nick_set", nick="abbott_")
+        self.assertEquals(["@abbott_", "Dave"], self.names())
+
+    def test_modes(self):
+        self.send("irc.on_mode_change", user="alice", channel="#chan",
+                set=False, mode="o", arg="alice")
+        self.send("irc.on_mode_change", user="alice", channel="#chan",
+                set=True, mode="v", arg="carol")
+        self.send("irc.on_mode_change", user="alice", channel="#chan",
+                set=True, mode="b", arg="*!*@host")
+        self.assertEquals(["+alice", "+bob", "+carol", "@abbott"], self.names())
+
+    def test_part(self):
+        self.send("irc.on_part", channel="#chan")
+        self.request("#chan")
+        self.assertEquals(["NAMES #chan"], self.sent)
+
+    def test_kicked(self):
+        self.send("irc.on_kicked", channel="#chan", kicker="alice",
+                message="out")
+        self.request("#chan")
+        self.assertEquals(["NAMES #chan"], self.sent)
+
+    def test_disconnected(self):
+        self.send("irc.on_join", channel="#other")
+        self.reply("RPL_NAMREPLY", "=", "#other", "@abbott dave")
+        self.send("irc.on_disconnected")
+        self.request("#chan")
+        other = self.request("#other")
+        self.assertEquals(["NAMES #chan", "NAMES #other"], self.sent)
+        # The half received reply from before doesn't get mixed in
+        self.reply("RPL_NAMREPLY", "=", "#other", "erin")
+        self.reply("RPL_ENDOFNAMES", "#other", "End of /NAMES list.")
+        self.assertEquals([["erin"]], other)
+
+    def test_resync(self):
+        d = self.request("#chan", resync=True)
+        self.assertEquals(["NAMES #chan"], self.sent)
+        self.reply("RPL_NAMREPLY", "=", "#chan", "@abbott zed")
+        self.reply("RPL_ENDOFNAMES", "#chan", "End of /NAMES list.")
+        self.assertEquals(["@abbott", "zed"], sorted(d[0]))
+        self.assertEquals(["@abbott", "zed"], self.names())
+
+class TestHasOp(unittest.TestCase):
+    def setUp(self):
+        self.transport = Transport()
+        self.transport.clock = task.Clock()
+        self.boss = FakeBoss(self.transport)
+        self.boss.load(Names, "ircutil.Names")
+        self.hasop = self.boss.load(HasOp, "ircutil.HasOp")
+        class Nick(object):
+            plugin_name = "irc.IRCBotPlugin"
+            def incoming_request(self, name):
+                return "abbott"
+        self.transport.provides_request("irc.getnick", Nick())
+        self.sent = []
+        self.transport.listen_for_event("irc.do_raw", self)
+
+        self.send("irc.on_nick_set", nick="abbott")
+        self.send("irc.on_join", channel="#chan")
+        self.send("irc.on_unknown", prefix="server", command="RPL_ENDOFNAMES",
+                params=["abbott", "#chan", "End of /NAMES list."])
+
+    def received_event(self, event):
+        self.sent.append(event.line)
+
+    def send(self, eventname, **kwargs):
+        self.transport.send_event(Event(eventname, **kwargs))
+
+    def has_op(self, channel="#chan"):
+        results = []
+        self.transport.issue_request("irc.has_op", channel
+                ).addBoth(results.append)
+        return results[0]
+
+    def mode(self, set):
+        self.send("irc.on_mode_change", user="alice", channel="#chan",
+                set=set, mode="o", arg="abbott")
+
+    def test_remembered(self):
+        self.assertFalse(self.has_op())
+        self.assertEquals({"#chan": False}, self.hasop.has_op)
+        self.mode(True)
+        self.assertEquals({"#chan": True}, self.hasop.has_op)
+        self.assertTrue(self.has_op())
+
+    def test_invalidated(self):
+        self.mode(True)
+        self.assertTrue(self.has_op())
+        self.mode(False)
+        self.assertFalse(self.has_op())
+        self.mode(True)
+        self.assertTrue(self.has_op())
+        self.send("irc.on_kicked", channel="#chan", kicker="alice",
+                message="out")
+        self.assertFalse(self.has_op())
+        self.assertEquals([], self.sent)
@@ -0,0 +1,69 @@
+from twisted.internet import task
+from twisted.trial import unittest
+
+from ..ratelimit import TokenBucket, RateLimiter
+
+class TestTokenBucket(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.bucket = TokenBucket(3, 60, clock=self.clock)
+
+    def test_burst(self):
+        for _ in range(3):
+            self.assertTrue(self.bucket.consume())
+        self.assertFalse(self.bucket.consume())
+        self.assertEquals(20, self.bucket.delay())
+
+    def test_refill(self):
+        for _ in range(3):
+            self.bucket.consume()
+        self.clock.advance(20)
+        self.assertTrue(self.bucket.available())
+        self.assertTrue(self.bucket.consume())
+        self.assertFalse(self.bucket.consume())
+
+    def test_capacity(self):
+        self.clock.advance(600)
+        for _ in range(3):
+            self.assertTrue(self.bucket.consume())
+        self.assertFalse(self.bucket.consume())
+
+class TestRateLimiter(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.limiter = RateLimiter(clock=self.clock)
+
+    def test_user(self):
+        limits = {"user": (2, 60)}
+        self.assertEquals(0, self.limiter.check("cmd", limits, "a!a@a", "#c"))
+        self.assertEquals(0, self.limiter.check("cmd", limits, "a!a@a", "#c"))
+        self.assertEquals(30, self.limiter.check("cmd", limits, "a!a@a", "#c"))
+        # Other users and commands have their own buckets
+        self.assertEquals(0, self.limiter.check("cmd", limits, "b!b@b", "#c"))
+        self.assertEquals(0, self.limiter.check("other", limits, "a!a@a", "#c"))
+        self.assertEquals(1, self.limiter.rejected)
+
+    def test_channel(self):
+        limits = {"user": (2, 60), "channel": (1, 60)}
+        self.assertEquals(0, self.limiter.check("cmd", limits, "a!a@a", "#c"))
+        self.assertTrue(self.limiter.check("cmd", limits, "b!b@b", "#c"))
+        # Private messages have no channel bucket
+        self.assertEquals(0, self.limiter.check("cmd", limits, "b!b@b", None))
+
+    def test_no_partial_consume(self):
+        limits = {"user": (2, 60), "channel": (1, 60)}
+        self.limiter.check("cmd", limits, "a!a@a", "#c")
+        # Rejected by the channel bucket, so the user's isn't touched
+        self.assertTrue(self.limiter.check("cmd", limits, "a!a@a", "#c"))
+        self.assertEquals(0, self.limiter.check("cmd", limits, "a!a@a", "#d"))
+
+    def test_idle_buckets_forgotten(self):
+        limits = {"user": (1, 60)}
+        self.limiter.check("cmd", limits, "a!a@a", None)
+        self.clock.advance(61)
+        cache = self.limiter._buckets[("cmd", "user", 1, 60)]
+        cache.expire()
+        self.assertEquals(0, len(cache))
+        self.assertEquals(0, self.limiter.check("cmd", limits, "a!a@a", None))
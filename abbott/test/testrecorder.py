@@ -0,0 +1,113 @@
+import json
+import sys
+from StringIO import StringIO
+
+from twisted.trial import unittest
+
+from ..pluginbase import BotPlugin
+from ..transport import Transport, Event, new_event
+# Declares the IRC event classes
+from ..plugins import irc
+from ..plugins.recorder import Recorder
+from .. import replay
+from .testcommand import FakeBoss
+
+
+class Echo(BotPlugin):
+    """Answers every message, so a replay has some work and output"""
+    def start(self):
+        super(Echo, self).start()
+        self.listen_for_event("irc.on_privmsg")
+
+    def on_event_irc_on_privmsg(self, event):
+        self.transport.send_event(Event("irc.do_msg", user=event.channel,
+            message=event.message))
+
+
+class TestRecorder(unittest.TestCase):
+
+    def setUp(self):
+        self.filename = self.mktemp()
+        self.transport = Transport()
+        self.boss = FakeBoss(self.transport)
+        self.boss.configs["recorder.Recorder"]["file"] = self.filename
+        self.recorder = self.boss.load(Recorder, "recorder.Recorder")
+
+    def record(self, *events):
+        for event in events:
+            self.transport.send_event(event)
+        self.recorder.stop()
+        with open(self.filename) as f:
+            return f.read()
+
+    def privmsg(self, message, **kwargs):
+        return new_event("irc.on_privmsg", user="alice!a@host",
+                channel="#chan", message=message, direct=False, **kwargs)
+
+    def test_format(self):
+        contents = self.record(self.privmsg("hi"),
+                Event("irc.do_msg", user="#chan", message="not recorded"),
+                Event("irc.on_part", channel="#chan"))
+        lines = contents.splitlines()
+        self.assertEquals(2, len(lines))
+        timestamp, eventtype, attrs = json.loads(lines[0])
+        self.assertIsInstance(timestamp, float)
+        self.assertEquals("irc.on_privmsg", eventtype)
+        self.assertEquals({"user": "alice!a@host", "channel": "#chan",
+            "message": "hi", "direct": False}, attrs)
+        self.assertEquals(["irc.on_part", {"channel": "#chan"}],
+                json.loads(lines[1])[1:])
+        # Compact separators, one event per line
+        self.assertNotIn(", ", contents)
+        self.assertEquals(2, self.recorder.recorded)
+
+    def test_unserializable_dropped(self):
+        contents = self.record(self.privmsg("hi", reply=lambda msg: None),
+                Event("irc.on_unknown", command="PING", prefix=object(),
+                    params=["\xff"]))
+        lines = [json.loads(line) for line in contents.splitlines()]
+        self.assertEquals({"user": "alice!a@host", "channel": "#chan",
+            "message": "hi", "direct": False}, lines[0][2])
+        self.assertEquals({"command": "PING"}, lines[1][2])
+
+    def test_replay(self):
+        self.record(self.privmsg("one"), self.privmsg("two"),
+                Event("irc.on_part", channel="#chan"))
+        events = [replay.make_event(eventtype, attrs)
+                for _, eventtype, attrs in replay.read_recording(self.filename)]
+        self.assertIs(type(self.privmsg("one")), type(events[0]))
+        self.assertEquals("two", events[1].message)
+
+        transport = Transport()
+        boss = FakeBoss(transport)
+        stub = boss.load(replay.StubIRCPlugin, replay.IRC_PLUGIN)
+        boss.load(Echo, "test.Echo")
+        for event in events:
+            transport.send_event(event)
+        self.assertEquals(2, stub.sent)
+
+        results = []
+        transport.issue_request("irc.getnick").addBoth(results.append)
+        self.assertEquals(["abbott"], results)
+
+        out = StringIO()
+        self.patch(sys, "stdout", out)
+        replay.report(transport, stub, len(events), 0.5)
+        report = out.getvalue()
+        self.assertIn("Replayed 3 events in 0.50s (6 events/s)", report)
+        self.assertIn("2 outgoing IRC events", report)
+        per_plugin = report.split("Time per plugin:")[1].split(
+                "Busiest handlers:")[0]
+        self.assertIn("test.Echo", per_plugin)
+        self.assertIn(replay.IRC_PLUGIN, per_plugin)
+        self.assertIn("test.Echo event irc.on_privmsg: ", report)
+
+
+class TestMakeEvent(unittest.TestCase):
+
+    def test_unknown_attribute(self):
+        # Recorded with a version that had more attributes
+        event = replay.make_event(u"irc.on_part",
+                {u"channel": u"#chan", u"reason": u"bye"})
+        self.assertEquals("bye", event.reason)
+        self.assertEquals("irc.on_part", event.eventtype)
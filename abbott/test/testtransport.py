@@ -0,0 +1,526 @@
+from twisted.trial import unittest
+from twisted.internet import task, defer
+
+from ..transport import Transport, Event, declare_event, new_event
+from ..transport import PRIORITY_BEST_EFFORT, RequestTimedOut
+from ..stats import Histogram
+
+
+class Recorder(object):
+    """A stand-in for a plugin that records the events it receives"""
+    def __init__(self, plugin_name="recorder", swallow=False):
+        self.plugin_name = plugin_name
+        self.swallow = swallow
+        self.events = []
+        self.middleware_events = []
+
+    def received_event(self, event):
+        self.events.append(event.eventtype)
+
+    def received_middleware_event(self, event):
+        self.middleware_events.append(event.eventtype)
+        if self.swallow:
+            return None
+        return event
+
+
+class TestEventDispatch(unittest.TestCase):
+
+    def setUp(self):
+        self.transport = Transport()
+
+    def test_exact_match(self):
+        r = Recorder()
+        self.transport.listen_for_event("irc.on_privmsg", r)
+        self.transport.send_event(Event("irc.on_privmsg"))
+        self.transport.send_event(Event("irc.on_notice"))
+        self.assertEquals(["irc.on_privmsg"], r.events)
+
+    def test_glob_does_not_transcend_dots(self):
+        r = Recorder()
+        self.transport.listen_for_event("irc.*", r)
+        self.transport.send_event(Event("irc.on_privmsg"))
+        self.transport.send_event(Event("ircutil.hasop.acquired"))
+        self.transport.send_event(Event("irc.foo.bar"))
+        self.assertEquals(["irc.on_privmsg"], r.events)
+
+    def test_glob_dots_are_literal(self):
+        r = Recorder()
+        self.transport.listen_for_event("irc.on_*", r)
+        self.transport.send_event(Event("ircxon_privmsg"))
+        self.assertEquals([], r.events)
+
+    def test_pattern_installed_after_first_dispatch(self):
+        r1 = Recorder()
+        r2 = Recorder()
+        self.transport.listen_for_event("irc.on_privmsg", r1)
+        self.transport.send_event(Event("irc.on_privmsg"))
+        self.transport.listen_for_event("irc.on_*", r2)
+        self.transport.send_event(Event("irc.on_privmsg"))
+        self.assertEquals(["irc.on_privmsg"]*2, r1.events)
+        self.assertEquals(["irc.on_privmsg"], r2.events)
+
+    def test_middleware_swallows(self):
+        m = Recorder(swallow=True)
+        r = Recorder()
+        self.transport.install_middleware("irc.on_*", m)
+        self.transport.listen_for_event("irc.on_privmsg", r)
+        self.transport.send_event(Event("irc.on_privmsg"))
+        self.assertEquals(["irc.on_privmsg"], m.middleware_events)
+        self.assertEquals([], r.events)
+
+    def test_unhook(self):
+        r = Recorder()
+        self.transport.listen_for_event("irc.on_privmsg", r)
+        self.transport.install_middleware("irc.on_privmsg", r)
+        self.transport.unhook_plugin(r)
+        self.transport.send_event(Event("irc.on_privmsg"))
+        self.assertEquals([], r.events)
+        self.assertEquals([], r.middleware_events)
+
+    def test_listener_removed_during_dispatch(self):
+        transport = self.transport
+        victim = Recorder()
+        class Remover(Recorder):
+            def received_event(self, event):
+                Recorder.received_event(self, event)
+                transport.unhook_plugin(victim)
+        # Globs are resolved in the order they were installed, so the remover
+        # is called before the victim
+        transport.listen_for_event("irc.on_privmsg", Remover())
+        transport.listen_for_event("irc.on_*", victim)
+        transport.send_event(Event("irc.on_privmsg"))
+        self.assertEquals([], victim.events)
+
+    def test_resolved_listeners_are_reused(self):
+        r = Recorder()
+        self.transport.listen_for_event("irc.on_privmsg", r)
+        subscriptions = self.transport._event_listeners
+        resolved = subscriptions.resolve("irc.on_privmsg")
+        self.assertIdentical(resolved, subscriptions.resolve("irc.on_privmsg"))
+
+        # Hooking an unrelated event leaves the resolved tuple alone
+        self.transport.listen_for_event("irc.do_*", Recorder())
+        self.assertIdentical(resolved, subscriptions.resolve("irc.on_privmsg"))
+
+        # but hooking a related one doesn't
+        other = Recorder()
+        self.transport.listen_for_event("irc.on_*", other)
+        self.assertEquals((r, other), subscriptions.resolve("irc.on_privmsg"))
+
+    def test_unhook_leaves_other_plugins(self):
+        r1 = Recorder("one")
+        r2 = Recorder("two")
+        self.transport.listen_for_event("irc.on_*", r1)
+        self.transport.listen_for_event("irc.on_*", r2)
+        self.transport.unhook_plugin(r1)
+        self.transport.send_event(Event("irc.on_privmsg"))
+        self.assertEquals([], r1.events)
+        self.assertEquals(["irc.on_privmsg"], r2.events)
+
+
+class Producer(object):
+    paused = False
+    def pauseProducing(self):
+        self.paused = True
+    def resumeProducing(self):
+        self.paused = False
+
+
+class TestQueuedDispatch(unittest.TestCase):
+
+    def setUp(self):
+        self.transport = Transport()
+        self.transport.clock = self.clock = task.Clock()
+        self.transport.configure({"queued": True, "batch_size": 2,
+            "queue_limit": 4})
+
+    def tick(self):
+        """Runs the calls that are currently pending, like one iteration of a
+        real reactor. Clock.advance() would also run the calls they schedule.
+
+        """
+        for call in self.clock.getDelayedCalls():
+            self.clock.calls.remove(call)
+            call.called = 1
+            call.func(*call.args, **call.kw)
+
+    def test_dispatched_in_batches(self):
+        r = Recorder()
+        self.transport.listen_for_event("test.*", r)
+        for i in range(3):
+            self.transport.send_event(Event("test.event%d" % i))
+        self.assertEquals([], r.events)
+        self.tick()
+        self.assertEquals(["test.event0", "test.event1"], r.events)
+        self.tick()
+        self.assertEquals(["test.event0", "test.event1", "test.event2"], r.events)
+
+    def test_event_sent_from_handler_is_not_recursive(self):
+        transport = self.transport
+        class Resender(Recorder):
+            def received_event(self, event):
+                Recorder.received_event(self, event)
+                if event.eventtype == "test.first":
+                    transport.send_event(Event("test.second"))
+                    # Not handled yet
+                    assert self.events == ["test.first"]
+        r = Resender()
+        transport.listen_for_event("test.*", r)
+        transport.send_event(Event("test.first"))
+        self.tick()
+        self.assertEquals(["test.first"], r.events)
+        self.tick()
+        self.assertEquals(["test.first", "test.second"], r.events)
+
+    def test_overflow_pauses_producers(self):
+        p = Producer()
+        self.transport.register_producer(p)
+        r = Recorder()
+        self.transport.listen_for_event("test.event", r)
+        for i in range(6):
+            self.transport.send_event(Event("test.event"))
+        self.assertTrue(p.paused)
+        # Nothing is dropped
+        self.tick()
+        self.assertTrue(p.paused)
+        self.tick()
+        self.assertFalse(p.paused)
+        self.tick()
+        self.assertEquals(6, len(r.events))
+        self.assertEquals(0, self.transport.dropped_events)
+
+    def test_overflow_drop_oldest(self):
+        self.transport.configure({"overflow": "drop_oldest"})
+        r = Recorder()
+        self.transport.listen_for_event("test.*", r)
+        for i in range(6):
+            self.transport.send_event(Event("test.event%d" % i))
+        self.tick()
+        self.tick()
+        self.assertEquals(["test.event%d" % i for i in range(2, 6)], r.events)
+        self.assertEquals(2, self.transport.dropped_events)
+
+    def test_overflow_drop_newest(self):
+        self.transport.configure({"overflow": "drop_newest"})
+        r = Recorder()
+        self.transport.listen_for_event("test.*", r)
+        for i in range(6):
+            self.transport.send_event(Event("test.event%d" % i))
+        self.tick()
+        self.tick()
+        self.assertEquals(["test.event%d" % i for i in range(4)], r.events)
+        self.assertEquals(2, self.transport.dropped_events)
+
+    def test_turning_off_flushes_queue(self):
+        r = Recorder()
+        self.transport.listen_for_event("test.event", r)
+        self.transport.send_event(Event("test.event"))
+        self.transport.configure({"queued": False})
+        self.assertEquals(["test.event"], r.events)
+        self.assertEquals([], self.clock.getDelayedCalls())
+
+
+class TestLoadShedding(unittest.TestCase):
+
+    def setUp(self):
+        self.transport = Transport()
+        self.transport.clock = self.clock = task.Clock()
+        self.transport.configure({"lag_threshold": 1, "lag_interval": 1})
+        self.normal = Recorder("normal")
+        self.best_effort = Recorder("best_effort")
+        self.transport.listen_for_event("irc.on_privmsg", self.best_effort,
+                PRIORITY_BEST_EFFORT)
+        self.transport.listen_for_event("irc.on_privmsg", self.normal)
+
+    def tearDown(self):
+        self.transport.configure({"lag_threshold": None})
+
+    def test_best_effort_called_last(self):
+        order = []
+        self.normal.received_event = lambda e: order.append("normal")
+        self.best_effort.received_event = lambda e: order.append("best_effort")
+        self.transport.send_event(Event("irc.on_privmsg"))
+        self.assertEquals(["normal", "best_effort"], order)
+
+    def test_skipped_while_lagging(self):
+        self.clock.advance(1)
+        self.assertFalse(self.transport.shedding)
+
+        # The reactor was busy for 3 seconds
+        self.clock.advance(3)
+        self.assertTrue(self.transport.shedding)
+        self.transport.send_event(Event("irc.on_privmsg"))
+        self.assertEquals(["irc.on_privmsg"], self.normal.events)
+        self.assertEquals([], self.best_effort.events)
+        self.assertEquals(1, self.transport.shed_events)
+
+        # and recovers
+        self.clock.advance(1)
+        self.assertFalse(self.transport.shedding)
+        self.transport.send_event(Event("irc.on_privmsg"))
+        self.assertEquals(["irc.on_privmsg"], self.best_effort.events)
+
+    def test_unhook_best_effort(self):
+        self.transport.unhook_plugin(self.best_effort)
+        self.transport.send_event(Event("irc.on_privmsg"))
+        self.assertEquals([], self.best_effort.events)
+
+    def test_unknown_priority(self):
+        self.assertRaises(ValueError, self.transport.listen_for_event,
+                "irc.on_privmsg", Recorder(), "urgent")
+
+
+class Provider(object):
+    plugin_name = "provider"
+    def incoming_request(self, name, *args, **kwargs):
+        return (name, args, kwargs)
+
+
+class TestRequests(unittest.TestCase):
+
+    def setUp(self):
+        self.transport = Transport()
+
+    def test_unknown_request(self):
+        d = self.transport.issue_request("no.such.request")
+        return self.assertFailure(d, NotImplementedError)
+
+    def test_request(self):
+        self.transport.provides_request("test.request", Provider())
+        d = self.transport.issue_request("test.request", 1, a=2)
+        d.addCallback(self.assertEquals, ("test.request", (1,), {'a': 2}))
+        return d
+
+    def test_unhook_request(self):
+        p = Provider()
+        self.transport.provides_request("test.request", p)
+        self.transport.unhook_plugin(p)
+        d = self.transport.issue_request("test.request")
+        return self.assertFailure(d, NotImplementedError)
+
+    def test_unhook_replaced_provider(self):
+        old = Provider()
+        new = Provider()
+        self.transport.provides_request("test.request", old)
+        self.transport.provides_request("test.request", new)
+        self.transport.unhook_plugin(old)
+        return self.transport.issue_request("test.request")
+
+
+class Pending(object):
+    """A provider whose requests complete when the test says so"""
+    plugin_name = "pending"
+    def __init__(self):
+        self.calls = []
+        self.cancelled = []
+    def incoming_request(self, name, *args, **kwargs):
+        d = defer.Deferred(self.cancelled.append)
+        self.calls.append(d)
+        return d
+
+
+class TestRequestOptions(unittest.TestCase):
+
+    def setUp(self):
+        self.transport = Transport()
+        self.transport.clock = self.clock = task.Clock()
+        self.provider = Pending()
+
+    def test_default_timeout(self):
+        self.transport.provides_request("test.slow", self.provider, timeout=5)
+        d = self.transport.issue_request("test.slow")
+        self.clock.advance(5)
+        self.assertEquals(self.provider.calls, self.provider.cancelled)
+        return self.assertFailure(d, RequestTimedOut)
+
+    def test_caller_deadline(self):
+        self.transport.provides_request("test.slow", self.provider, timeout=5)
+        d = self.transport.issue_request_within(1, "test.slow")
+        self.clock.advance(1)
+        return self.assertFailure(d, RequestTimedOut)
+
+    def test_completes_in_time(self):
+        self.transport.provides_request("test.slow", self.provider, timeout=5)
+        d = self.transport.issue_request("test.slow")
+        self.provider.calls[0].callback("done")
+        self.assertEquals([], self.clock.getDelayedCalls())
+        d.addCallback(self.assertEquals, "done")
+        return d
+
+    def test_cancel_propagates(self):
+        self.transport.provides_request("test.slow", self.provider)
+        d = self.transport.issue_request("test.slow")
+        d.cancel()
+        self.assertEquals(self.provider.calls, self.provider.cancelled)
+        return self.assertFailure(d, defer.CancelledError)
+
+    @defer.inlineCallbacks
+    def test_coalesce(self):
+        self.transport.provides_request("test.slow", self.provider, coalesce=True)
+        d1 = self.transport.issue_request("test.slow", 1)
+        d2 = self.transport.issue_request("test.slow", 1)
+        d3 = self.transport.issue_request("test.slow", 2)
+        self.assertEquals(2, len(self.provider.calls))
+        self.provider.calls[0].callback("one")
+        self.provider.calls[1].callback("two")
+        self.assertEquals("one", (yield d1))
+        self.assertEquals("one", (yield d2))
+        self.assertEquals("two", (yield d3))
+
+        # Once it's completed, the next request goes to the provider again
+        self.transport.issue_request("test.slow", 1)
+        self.assertEquals(3, len(self.provider.calls))
+
+    def test_coalesce_unhashable(self):
+        self.transport.provides_request("test.slow", self.provider, coalesce=True)
+        self.transport.issue_request("test.slow", [1])
+        self.transport.issue_request("test.slow", [1])
+        self.assertEquals(2, len(self.provider.calls))
+
+    def test_coalesce_cancel(self):
+        self.transport.provides_request("test.slow", self.provider, coalesce=True)
+        d1 = self.transport.issue_request("test.slow")
+        d2 = self.transport.issue_request("test.slow")
+        d1.cancel()
+        # Still wanted by the other caller
+        self.assertEquals([], self.provider.cancelled)
+        d2.cancel()
+        self.assertEquals(self.provider.calls, self.provider.cancelled)
+        self.failureResultOf(d1, defer.CancelledError)
+        self.failureResultOf(d2, defer.CancelledError)
+
+    def test_coalesce_failure(self):
+        self.transport.provides_request("test.slow", self.provider, coalesce=True)
+        d1 = self.transport.issue_request("test.slow")
+        d2 = self.transport.issue_request("test.slow")
+        self.provider.calls[0].errback(ValueError())
+        self.failureResultOf(d1, ValueError)
+        self.failureResultOf(d2, ValueError)
+
+class TestRequestCache(unittest.TestCase):
+
+    def setUp(self):
+        self.transport = Transport()
+        self.transport.clock = self.clock = task.Clock()
+        self.provider = Pending()
+        self.transport.provides_request("test.cached", self.provider,
+                cache_ttl=10, invalidate_on=["test.changed"])
+        self.cache = self.transport.request_caches()["test.cached"]
+
+    @defer.inlineCallbacks
+    def test_hit(self):
+        d = self.transport.issue_request("test.cached", 1)
+        self.provider.calls[0].callback("one")
+        self.assertEquals("one", (yield d))
+        self.assertEquals("one", (yield self.transport.issue_request("test.cached", 1)))
+        self.assertEquals(1, len(self.provider.calls))
+        self.assertEquals(1, self.cache.hits)
+
+        # Other arguments aren't cached
+        self.transport.issue_request("test.cached", 2)
+        self.assertEquals(2, len(self.provider.calls))
+
+    def test_expires(self):
+        self.transport.issue_request("test.cached")
+        self.provider.calls[0].callback("one")
+        self.clock.advance(10)
+        self.transport.issue_request("test.cached")
+        self.assertEquals(2, len(self.provider.calls))
+
+    def test_failures_not_cached(self):
+        d = self.transport.issue_request("test.cached")
+        self.provider.calls[0].errback(ValueError())
+        self.failureResultOf(d, ValueError)
+        self.transport.issue_request("test.cached")
+        self.assertEquals(2, len(self.provider.calls))
+
+    def test_invalidated_by_event(self):
+        self.transport.issue_request("test.cached")
+        self.provider.calls[0].callback("one")
+        self.transport.send_event(Event("test.changed"))
+        self.transport.issue_request("test.cached")
+        self.assertEquals(2, len(self.provider.calls))
+
+    def test_invalidated_while_in_progress(self):
+        self.transport.issue_request("test.cached")
+        self.transport.send_event(Event("test.changed"))
+        self.provider.calls[0].callback("stale")
+        self.assertEquals(0, len(self.cache))
+
+    def test_unhook_removes_invalidator(self):
+        self.transport.unhook_plugin(self.provider)
+        self.assertEquals({}, self.transport.request_caches())
+        self.assertEquals((), self.transport._event_listeners.resolve("test.changed"))
+
+class TestEvents(unittest.TestCase):
+
+    def test_generic_event(self):
+        e = Event("test.event", a=1, b=2)
+        self.assertEquals("test.event", e.eventtype)
+        self.assertEquals({'a': 1, 'b': 2}, e.attributes())
+        e.c = 3
+        self.assertEquals(3, e.c)
+
+    def test_declared_event(self):
+        declare_event("test.declared", "a", "b", "c")
+        e = new_event("test.declared", a=1, b=2)
+        self.assertEquals("test.declared", e.eventtype)
+        self.assertEquals(1, e.a)
+        self.assertEquals({'a': 1, 'b': 2}, e.attributes())
+        self.assertFalse(hasattr(e, "c"))
+        self.assertFalse(hasattr(e, "__dict__"))
+        e.c = 3
+        self.assertEquals(3, e.c)
+        self.assertRaises(AttributeError, setattr, e, "d", 4)
+
+    def test_undeclared_event(self):
+        e = new_event("test.undeclared", a=1)
+        self.assertIsInstance(e, Event)
+        self.assertEquals(1, e.a)
+
+
+class TestStats(unittest.TestCase):
+
+    def setUp(self):
+        self.transport = Transport()
+
+    def test_listener_calls_recorded(self):
+        class Broken(Recorder):
+            def received_event(self, event):
+                raise ValueError()
+        self.transport.install_middleware("irc.on_privmsg", Recorder("mw"))
+        self.transport.listen_for_event("irc.on_privmsg", Recorder("ok"))
+        self.transport.listen_for_event("irc.on_privmsg", Broken("broken"))
+        self.transport.send_event(Event("irc.on_privmsg"))
+        self.transport.send_event(Event("irc.on_privmsg"))
+        self.flushLoggedErrors()
+
+        histograms = self.transport.stats.histograms
+        self.assertEquals(2, histograms["mw", "middleware", "irc.on_privmsg"].count)
+        self.assertEquals(0, histograms["ok", "event", "irc.on_privmsg"].errors)
+        self.assertEquals(2, histograms["broken", "event", "irc.on_privmsg"].errors)
+
+    def test_request_timed_until_fired(self):
+        d = defer.Deferred()
+        class Slow(object):
+            plugin_name = "slow"
+            def incoming_request(self, name):
+                return d
+        self.transport.provides_request("test.slow", Slow())
+        self.transport.issue_request("test.slow")
+        histograms = self.transport.stats.histograms
+        self.assertNotIn(("slow", "request", "test.slow"), histograms)
+        d.errback(ValueError())
+        self.assertEquals(1, histograms["slow", "request", "test.slow"].errors)
+        return self.assertFailure(d, ValueError)
+
+    def test_histogram(self):
+        h = Histogram()
+        for _ in range(99):
+            h.add(0.002)
+        h.add(2)
+        self.assertEquals(100, h.count)
+        self.assertEquals(0.005, h.percentile(50))
+        self.assertEquals(2, h.percentile(100))
+        self.assertAlmostEquals(0.02198, h.mean)
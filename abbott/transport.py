@@ -1,9 +1,12 @@
 import re
-from collections import defaultdict
-from itertools import chain
+from collections import defaultdict, deque
 
-from twisted.internet import defer
+from twisted.internet import defer, reactor, task
 from twisted.python import log
+from twisted.python.failure import Failure
+
+from .stats import Stats, timer
+from .cache import TTLCache
 
 """
 About the Abbott event system:
@@ -14,6 +17,9 @@ hierarchical, like domain.action, such as irc.on_privmsg (which is fired on
 receiving a PRIVMSG command from the IRC server.)
 
 Event objects carry an arbitrary (or rather, event-defined) set of attributes.
+Events that are emitted in large numbers, such as the irc.on_* family, have a
+compact class declared with declare_event() and are created with new_event().
+Those can only carry the attributes declared for them.
 
 Each BotPlugin object can register to be notified when an event is emitted by
 any other plugin. Plugins can register listeners on a particular event name, or
@@ -44,12 +50,174 @@ argument is the request name.  The rest are *args, **kwargs. It is expected to
 return a deferred object. To issue a request, call transport.send_request()
 with the request name and the appropriate arguments.
 
+By default send_event() dispatches an event immediately, before returning, so
+an event sent from within an event handler is handled on the same stack. The
+transport can instead be configured (see Transport.configure()) to queue
+events and have the reactor dispatch them in bounded batches, one batch per
+reactor iteration. Then no single burst of events can keep the reactor from
+reading the socket or running timers.
+
+Listeners may also be registered with the PRIORITY_BEST_EFFORT priority class,
+for things that are nice to have but not important, such as plugins that
+chime in on conversation. If the transport is configured with a lag threshold,
+it measures how late the reactor is running its timers, and while that lag is
+over the threshold, best effort listeners are skipped so that everything else
+stays responsive.
+
+The transport also times every middleware call, listener call and request,
+per plugin and per event or request name. See the stats attribute and the
+abbott.stats module.
+
+Providers can give a request a default timeout, and have identical requests
+that are issued while one is still in progress share its result instead of
+doing the work again. Callers can give their own deadline with
+issue_request_within(). Cancelling the deferred returned by issue_request()
+cancels the provider's deferred. Providers of idempotent requests can also have
+the transport cache their results for a while, and name the events after which
+the cached results are no longer valid.
+
 Other notes about requests: only one plugin may provide a request handler for a
 particular request name. If more than one handler tries to provide a particular
 request, the behavior is undefined.
 
 """
 
+# Priority classes for event listeners
+PRIORITY_NORMAL = "normal"
+PRIORITY_BEST_EFFORT = "best_effort"
+
+def _compile_glob(matchstr):
+    """Compiles an event glob such as irc.on_* into a regular expression
+    object matching whole event names. Globs do not transcend dots.
+
+    """
+    return re.compile("[^. ]+".join(
+        re.escape(x) for x in matchstr.split("*")
+        ) + "$")
+
+class _Subscriptions(object):
+    """Holds one kind of event hook (either middleware or normal listeners),
+    indexed by the glob they were installed with.
+
+    Each glob is compiled once, when it is first installed. The objects to
+    notify for a concrete event type are resolved once and remembered as a
+    tuple until a hook that could affect that event type is installed or
+    removed, so dispatching an event doesn't depend on how many unrelated
+    globs are installed and doesn't allocate anything.
+
+    The object sets are never mutated in place; a new frozenset is swapped in
+    on every change. This way a dispatch in progress can keep iterating over
+    the snapshot it started with.
+
+    """
+    def __init__(self):
+        # maps event names (possibly globbed) to frozensets of objects
+        self.listeners = {}
+
+        # maps event names (possibly globbed) to their compiled regex
+        self._patterns = {}
+        # The event names in the order they were first installed
+        self._order = []
+
+        # maps concrete event types to a tuple of objects to notify
+        self._resolved = {}
+
+        # Incremented on every change. Lets a dispatch in progress cheaply
+        # detect that it should double check its snapshot.
+        self.generation = 0
+
+    def add(self, matchstr, obj):
+        try:
+            obj_set = self.listeners[matchstr]
+        except KeyError:
+            obj_set = frozenset()
+            self._patterns[matchstr] = _compile_glob(matchstr)
+            self._order.append(matchstr)
+        if obj not in obj_set:
+            self.listeners[matchstr] = obj_set | frozenset([obj])
+            self._invalidate(matchstr)
+
+    def remove(self, matchstr, obj):
+        obj_set = self.listeners.get(matchstr, frozenset())
+        if obj in obj_set:
+            self.listeners[matchstr] = obj_set - frozenset([obj])
+            self._invalidate(matchstr)
+
+    def _invalidate(self, matchstr):
+        """Forget the resolved objects for every event type matching this
+        glob. Entries for other event types are unaffected.
+
+        """
+        self.generation += 1
+        regex = self._patterns[matchstr]
+        for eventtype in [x for x in self._resolved if regex.match(x)]:
+            del self._resolved[eventtype]
+
+    def resolve(self, eventtype):
+        """Returns a tuple of the objects that should be notified of the given
+        event type. Globs are considered in the order they were installed.
+
+        """
+        try:
+            return self._resolved[eventtype]
+        except KeyError:
+            resolved = self._resolved[eventtype] = tuple(
+                    obj
+                    for matchstr in self._order
+                    if self._patterns[matchstr].match(eventtype)
+                    for obj in self.listeners[matchstr]
+                    )
+            return resolved
+
+class RequestTimedOut(defer.TimeoutError):
+    """The deferred from issue_request() errbacks with this if the request
+    doesn't complete within its timeout"""
+    pass
+
+class _InFlight(object):
+    """A provider's deferred for a coalesced request, shared among the
+    callers waiting on it. Each caller gets its own deferred from
+    add_waiter(), which can be cancelled without affecting the others.
+
+    """
+    def __init__(self, provider_d, on_done):
+        self.waiters = []
+        self.provider_d = provider_d
+        self.on_done = on_done
+        provider_d.addBoth(self._fire)
+
+    def add_waiter(self):
+        d = defer.Deferred(self._cancel_waiter)
+        self.waiters.append(d)
+        return d
+
+    def _cancel_waiter(self, d):
+        # The deferred errbacks with CancelledError once this returns
+        self.waiters.remove(d)
+        if not self.waiters:
+            self.provider_d.cancel()
+
+    def _fire(self, result):
+        self.on_done()
+        waiters, self.waiters = self.waiters, []
+        for d in waiters:
+            d.callback(result)
+        # Any failure has been passed on to the waiters, who are responsible
+        # for it now
+
+class _CacheInvalidator(object):
+    """Listens for the events that invalidate a request's cache on behalf of
+    the transport, and clears the cache when one comes in
+
+    """
+    def __init__(self, plugin_name, cache):
+        # Shows up in the stats under this name
+        self.plugin_name = plugin_name + " cache"
+        self.cache = cache
+
+    def received_event(self, event):
+        self.cache.clear()
+
 class Transport(object):
     """A generalized transport layer to send messages from one plugin to another.
     
@@ -57,102 +225,552 @@ class Transport(object):
     """
 
     def __init__(self):
-        # maps event names to sets of objects
-        self._middleware_listeners = defaultdict(set)
-        self._event_listeners = defaultdict(set)
+        self._middleware_listeners = _Subscriptions()
+        self._event_listeners = _Subscriptions()
+        self._best_effort_listeners = _Subscriptions()
         self._request_listeners = {}
+        # Maps request names to the (timeout, coalesce, cache) options their
+        # provider gave. cache is a TTLCache or None.
+        self._request_options = {}
+        # Maps (name, args, kwargs) keys to the _InFlight object for
+        # coalesced requests that are in progress
+        self._inflight = {}
+        # Maps request names to the _CacheInvalidator listening on behalf of
+        # their cache
+        self._cache_invalidators = {}
+        # The most results kept per request name
+        self.request_cache_size = 256
+
+        # Reverse index: maps plugin objects to a set of (kind, name) tuples
+        # for every hook they've installed, where kind is one of "middleware",
+        # "event", "best_effort" or "request". This lets unhook_plugin() touch only the
+        # plugin's own hooks.
+        self._plugin_hooks = defaultdict(set)
+
+        # Latency and error counts for every hook called
+        self.stats = Stats()
+
+        # The reactor to schedule calls on. Tests may replace this with a
+        # twisted.internet.task.Clock
+        self.clock = reactor
+
+        # Queued dispatch mode; see configure(). Off by default.
+        self.queued = False
+        self.queue_limit = 1000
+        self.batch_size = 50
+        self.overflow = "pause"
+        self._queue = deque()
+        self._drain_call = None
+        self.dropped_events = 0
+
+        # Producers (normally the IRC connection) to pause while the queue is
+        # over its limit
+        self._producers = set()
+        self._paused = False
+
+        # Reactor lag monitoring; see configure(). Off by default.
+        self.lag_threshold = None
+        self.lag_interval = 0.5
+        self.lag = 0
+        self.shedding = False
+        self.shed_events = 0
+        self._lag_monitor = None
+        self._lag_last = None
+
+    def configure(self, config):
+        """Applies the transport options from the given dict. Recognized keys:
+
+        queued: if true, send_event() queues events and they are dispatched
+            from the reactor in batches, instead of immediately.
+        batch_size: the most events dispatched per reactor iteration.
+        queue_limit: how many events may be waiting before the overflow
+            policy kicks in.
+        overflow: one of "pause" (pause the registered producers until the
+            queue drains to half its limit; nothing is dropped),
+            "drop_oldest" or "drop_newest".
+        lag_threshold: if set, the reactor lag in seconds over which best
+            effort listeners are skipped.
+        lag_interval: how often in seconds to measure the reactor lag.
+
+        """
+        self.queued = bool(config.get("queued", self.queued))
+        self.batch_size = int(config.get("batch_size", self.batch_size))
+        self.queue_limit = int(config.get("queue_limit", self.queue_limit))
+        overflow = config.get("overflow", self.overflow)
+        if overflow not in ("pause", "drop_oldest", "drop_newest"):
+            raise ValueError("Unknown overflow policy %r" % (overflow,))
+        self.overflow = overflow
+
+        if not self.queued:
+            # Don't strand anything that was already queued
+            self._drain_all()
+
+        self.lag_interval = float(config.get("lag_interval", self.lag_interval))
+        self.lag_threshold = config.get("lag_threshold", self.lag_threshold)
+        self._stop_lag_monitor()
+        if self.lag_threshold is not None:
+            self._lag_monitor = task.LoopingCall(self._measure_lag)
+            self._lag_monitor.clock = self.clock
+            self._lag_last = self.clock.seconds()
+            self._lag_monitor.start(self.lag_interval, now=False)
+
+    def _stop_lag_monitor(self):
+        if self._lag_monitor is not None:
+            self._lag_monitor.stop()
+            self._lag_monitor = None
+        self.lag = 0
+        self._set_shedding(False)
+
+    def _measure_lag(self):
+        """Called every lag_interval seconds. Any time beyond that since the
+        last call is time the reactor spent busy with something else.
+
+        """
+        now = self.clock.seconds()
+        self.lag = max(0, now - self._lag_last - self.lag_interval)
+        self._lag_last = now
+        self._set_shedding(self.lag > self.lag_threshold)
+
+    def _set_shedding(self, shedding):
+        if shedding and not self.shedding:
+            log.msg("Reactor is lagging by %.2fs. Skipping best effort listeners" % self.lag)
+        elif self.shedding and not shedding:
+            log.msg("Reactor lag recovered. %d best effort events skipped so far" % self.shed_events)
+        self.shedding = shedding
+
+    def queue_length(self):
+        """Returns how many events are waiting to be dispatched"""
+        return len(self._queue)
+
+    def register_producer(self, producer):
+        """Registers an IPushProducer, such as a TCP transport, to be paused
+        while the event queue is full and the overflow policy is "pause"
+
+        """
+        self._producers.add(producer)
+        if self._paused:
+            producer.pauseProducing()
+
+    def unregister_producer(self, producer):
+        self._producers.discard(producer)
 
     def send_event(self, event):
-        # Note: iterating over the listener dictionaries and sets are done with
-        # copies, not an iterator, because of the posibility of the dictionary
-        # being modified somewhere down the stack in an event handler
+        if not self.queued:
+            self._dispatch(event)
+            return
+
+        queue = self._queue
+        if len(queue) >= self.queue_limit:
+            if self.overflow == "drop_newest":
+                self.dropped_events += 1
+                return
+            elif self.overflow == "drop_oldest":
+                queue.popleft()
+                self.dropped_events += 1
+            elif not self._paused:
+                self._pause_producers()
+        queue.append(event)
+
+        if self._drain_call is None:
+            self._drain_call = self.clock.callLater(0, self._drain)
+
+    def _drain(self):
+        """Dispatches one batch of queued events, and reschedules itself if
+        there are any left
+
+        """
+        self._drain_call = None
+        queue = self._queue
+        # Events sent by handlers during this batch are appended to the end
+        # of the queue and wait for a later batch
+        for _ in xrange(min(self.batch_size, len(queue))):
+            self._dispatch(queue.popleft())
+
+        if self._paused and len(queue) <= self.queue_limit // 2:
+            self._resume_producers()
+
+        if queue and self._drain_call is None:
+            self._drain_call = self.clock.callLater(0, self._drain)
+
+    def _drain_all(self):
+        if self._drain_call is not None:
+            self._drain_call.cancel()
+            self._drain_call = None
+        queue = self._queue
+        while queue:
+            self._dispatch(queue.popleft())
+        if self._paused:
+            self._resume_producers()
+
+    def _pause_producers(self):
+        log.msg("Event queue is full (%d events). Pausing input" % len(self._queue))
+        self._paused = True
+        for producer in self._producers:
+            producer.pauseProducing()
+
+    def _resume_producers(self):
+        log.msg("Event queue drained. Resuming input")
+        self._paused = False
+        for producer in self._producers:
+            producer.resumeProducing()
+
+    def _dispatch(self, event):
+        # Note: the resolved tuples of listeners are snapshots, so it's safe
+        # for an event handler somewhere down the stack to install or remove
+        # hooks while we iterate over them
 
         # First call all middleware
-        for callback_name, callback_obj_set in self._middleware_listeners.items():
-            callback_parts = [re.escape(x) for x in callback_name.split("*")]
-            callback_match = "[^. ]+".join(callback_parts) + "$"
-            if re.match(callback_match, event.eventtype):
-                for callback_obj in set(callback_obj_set):
-                    try:
-                        event = callback_obj.received_middleware_event(event)
-                    except Exception:
-                        # We don't want one plugin's errors to prevent other
-                        # plugins from being called
-                        import traceback
-                        log.msg(traceback.format_exc())
-                    if not event:
-                        return
+        eventtype = event.eventtype
+        record = self.stats.record
+        for callback_obj in self._middleware_listeners.resolve(eventtype):
+            start = timer()
+            try:
+                event = callback_obj.received_middleware_event(event)
+            except Exception:
+                # We don't want one plugin's errors to prevent other
+                # plugins from being called
+                import traceback
+                log.msg(traceback.format_exc())
+                record(callback_obj.plugin_name, "middleware", eventtype,
+                        timer() - start, True)
+            else:
+                record(callback_obj.plugin_name, "middleware", eventtype,
+                        timer() - start)
+            if not event:
+                return
 
         # Now call the event handlers
-        for callback_name, callback_obj_set in self._event_listeners.items():
-            callback_match = callback_name.replace("*", "[^.]+") + "$"
-            if re.match(callback_match, event.eventtype):
-                # create a new set since the set may mutate while we iterate over it
-                for callback_obj in set(callback_obj_set):
-                    try:
-                        # Do a check to see if it's still in the original set. If
-                        # it *has* been removed (by an earlier callback, for
-                        # example), then don't call it
-                        if callback_obj in callback_obj_set:
-                            callback_obj.received_event(event)
-                    except Exception:
-                        # We don't want one plugin's errors to prevent other
-                        # plugins from being called.
-                        import traceback
-                        log.msg(traceback.format_exc())
+        listeners = self._event_listeners
+        self._notify(listeners, listeners.resolve(event.eventtype), event)
+
+        best_effort = self._best_effort_listeners.resolve(event.eventtype)
+        if not best_effort:
+            return
+        if self.shedding:
+            self.shed_events += len(best_effort)
+            return
+        self._notify(self._best_effort_listeners, best_effort, event)
+
+    def _notify(self, listeners, resolved, event):
+        """Calls received_event() on each of the resolved listeners, which
+        were just resolved from the given _Subscriptions
+
+        """
+        generation = listeners.generation
+        eventtype = event.eventtype
+        record = self.stats.record
+        for callback_obj in resolved:
+            # Do a check to see if it's still a listener. If it *has* been
+            # removed (by an earlier callback, for example), then don't call
+            # it. This only needs checking if something changed.
+            if (listeners.generation != generation and
+                    callback_obj not in listeners.resolve(eventtype)):
+                continue
+            start = timer()
+            try:
+                callback_obj.received_event(event)
+            except Exception:
+                # We don't want one plugin's errors to prevent other
+                # plugins from being called.
+                import traceback
+                log.msg(traceback.format_exc())
+                record(callback_obj.plugin_name, "event", eventtype,
+                        timer() - start, True)
+            else:
+                record(callback_obj.plugin_name, "event", eventtype,
+                        timer() - start)
 
     def install_middleware(self, matchstr, obj_to_notify):
-        self._middleware_listeners[matchstr].add(obj_to_notify)
+        self._middleware_listeners.add(matchstr, obj_to_notify)
+        self._plugin_hooks[obj_to_notify].add(("middleware", matchstr))
 
-    def listen_for_event(self, matchstr, obj_to_notify):
-        self._event_listeners[matchstr].add(obj_to_notify)
+    def listen_for_event(self, matchstr, obj_to_notify, priority=PRIORITY_NORMAL):
+        """Registers obj_to_notify to receive events matching matchstr.
+        priority is PRIORITY_NORMAL or PRIORITY_BEST_EFFORT. Best effort
+        listeners are called after the normal ones, and not at all while the
+        reactor is lagging.
+
+        """
+        if priority == PRIORITY_NORMAL:
+            self._event_listeners.add(matchstr, obj_to_notify)
+            self._plugin_hooks[obj_to_notify].add(("event", matchstr))
+        elif priority == PRIORITY_BEST_EFFORT:
+            self._best_effort_listeners.add(matchstr, obj_to_notify)
+            self._plugin_hooks[obj_to_notify].add(("best_effort", matchstr))
+        else:
+            raise ValueError("Unknown priority class %r" % (priority,))
 
 
     ### Request Interface
 
     def issue_request(self, name, *args, **kwargs):
         """Plugins: call this to send a request to some other plugin. Returns a deferred"""
+        return self._issue_request(None, name, args, kwargs)
+
+    def issue_request_within(self, timeout, name, *args, **kwargs):
+        """Like issue_request(), but if the request hasn't completed within
+        timeout seconds, it is cancelled and the returned deferred errbacks
+        with RequestTimedOut. If the provider declared its own timeout for
+        this request, the shorter of the two applies.
+
+        """
+        return self._issue_request(timeout, name, args, kwargs)
+
+    def _issue_request(self, timeout, name, args, kwargs):
         try:
             obj = self._request_listeners[name]
         except KeyError:
            return defer.fail(NotImplementedError("Request name %r is not implemented"%(name,)))
 
+        default_timeout, coalesce, cache = self._request_options.get(name,
+                (None, False, None))
+        if default_timeout is not None and (timeout is None or default_timeout < timeout):
+            timeout = default_timeout
+
+        key = None
+        if coalesce or cache is not None:
+            key = (name, args, tuple(sorted(kwargs.iteritems())))
+            try:
+                hash(key)
+            except TypeError:
+                # Can't tell if two calls with unhashable arguments are the
+                # same, so don't coalesce or cache this one
+                key = None
+
+        if key is not None and cache is not None:
+            try:
+                return defer.succeed(cache[key])
+            except KeyError:
+                pass
+            generation = cache.generation
+
+        if key is None or not coalesce:
+            d = self._call_provider(obj, name, args, kwargs)
+        else:
+            try:
+                inflight = self._inflight[key]
+            except KeyError:
+                provider_d = self._call_provider(obj, name, args, kwargs)
+                if provider_d.called:
+                    # No need to share a result that's already here
+                    inflight = None
+                    d = provider_d
+                else:
+                    inflight = self._inflight[key] = _InFlight(provider_d,
+                            lambda: self._inflight.pop(key, None))
+            if inflight is not None:
+                d = inflight.add_waiter()
+
+        if key is not None and cache is not None:
+            d.addCallback(self._cache_result, cache, key, generation)
+
+        if timeout is not None and not d.called:
+            self._add_timeout(d, timeout, name)
+        return d
+
+    def _cache_result(self, result, cache, key, generation):
+        # Don't store a result if the cache was invalidated while the request
+        # was in progress; it may already be stale
+        if cache.generation == generation:
+            cache[key] = result
+        return result
+
+    def _call_provider(self, obj, name, args, kwargs):
+        start = timer()
         try:
             toret = obj.incoming_request(name, *args, **kwargs)
         except Exception, e:
+            self.stats.record(obj.plugin_name, "request", name,
+                    timer() - start, True)
             return defer.fail(e)
 
         # Programming convenience: request implementations can return a
         # deferred or a value, and this automatically wraps them in a deferred.
         if not isinstance(toret, defer.Deferred):
+            self.stats.record(obj.plugin_name, "request", name,
+                    timer() - start)
             return defer.succeed(toret)
 
+        # Requests are timed until their deferred fires
+        toret.addBoth(self._record_request, obj.plugin_name, name, start)
         return toret
 
-    def provides_request(self, name, obj_to_notify):
+    def _record_request(self, result, plugin_name, name, start):
+        self.stats.record(plugin_name, "request", name, timer() - start,
+                isinstance(result, Failure))
+        return result
+
+    def _add_timeout(self, d, timeout, name):
+        """Cancels d if it hasn't fired within timeout seconds, and turns the
+        resulting CancelledError into a RequestTimedOut
+
+        """
+        timed_out = []
+        def expire():
+            timed_out.append(True)
+            d.cancel()
+        call = self.clock.callLater(timeout, expire)
+        def done(result):
+            if call.active():
+                call.cancel()
+            elif (timed_out and isinstance(result, Failure) and
+                    result.check(defer.CancelledError)):
+                return Failure(RequestTimedOut(
+                    "Request %r timed out after %s seconds" % (name, timeout)))
+            return result
+        d.addBoth(done)
+
+    def provides_request(self, name, obj_to_notify, timeout=None,
+            coalesce=False, cache_ttl=None, invalidate_on=()):
         """Plugins: call this in your start() method to receive requests for this reqeust name
 
+        If timeout is given, requests by this name that haven't completed in
+        that many seconds are cancelled, and the caller gets a
+        RequestTimedOut failure.
+
+        If coalesce is true, a request made while an identical one (same
+        name and arguments) is still in progress doesn't call into the
+        provider again, but gets the result of the one in progress. The
+        provider's deferred is only cancelled once every caller waiting on it
+        has cancelled. Callers of coalesced requests must not modify the
+        result they get, since it may be shared.
+
+        If cache_ttl is given, successful results are remembered for that many
+        seconds, and identical requests are answered from the cache without
+        calling the provider. The whole cache is cleared whenever an event
+        matching one of the globs in invalidate_on is sent. As with coalesced
+        requests, callers must not modify cached results.
+
         """
         if name in self._request_listeners:
             log.msg("WARNING! two plugins provide the request {0}: {1} and {2}".format(
                 name, obj_to_notify.plugin_name, self._request_listeners[name].plugin_name))
+        self._drop_request_cache(name)
         self._request_listeners[name] = obj_to_notify
 
+        cache = None
+        if cache_ttl is not None:
+            cache = TTLCache(cache_ttl, maxsize=self.request_cache_size,
+                    clock=self.clock)
+            if invalidate_on:
+                invalidator = _CacheInvalidator(obj_to_notify.plugin_name, cache)
+                for matchstr in invalidate_on:
+                    self.listen_for_event(matchstr, invalidator)
+                self._cache_invalidators[name] = invalidator
+        self._request_options[name] = (timeout, coalesce, cache)
+        self._plugin_hooks[obj_to_notify].add(("request", name))
+
+    def request_caches(self):
+        """Returns a dict mapping request names to the TTLCache holding their
+        results, for requests whose provider asked for caching
+
+        """
+        return dict((name, options[2])
+                for name, options in self._request_options.iteritems()
+                if options[2] is not None)
+
+    def _drop_request_cache(self, name):
+        invalidator = self._cache_invalidators.pop(name, None)
+        if invalidator is not None:
+            self.unhook_plugin(invalidator)
+
 
     ### Called on plugin unloading
 
     def unhook_plugin(self, plugin):
-        for obj_set in chain(self._middleware_listeners.itervalues(),
-                self._event_listeners.itervalues()):
-            obj_set.discard(plugin)
-        for reqname, obj in self._request_listeners.items():
-            if obj is plugin:
-                del self._request_listeners[reqname]
+        for kind, name in self._plugin_hooks.pop(plugin, ()):
+            if kind == "middleware":
+                self._middleware_listeners.remove(name, plugin)
+            elif kind == "event":
+                self._event_listeners.remove(name, plugin)
+            elif kind == "best_effort":
+                self._best_effort_listeners.remove(name, plugin)
+            elif kind == "request":
+                # Another plugin may have since taken over this request name
+                if self._request_listeners.get(name) is plugin:
+                    del self._request_listeners[name]
+                    del self._request_options[name]
+                    self._drop_request_cache(name)
 
 
 class Event(object):
-    """Pretty much just a container for data"""
+    """Pretty much just a container for data
+
+    Attributes are kept in the instance dictionary, so any attribute may be
+    set on these. This is the class to use for ad-hoc events. Event types that
+    are emitted at a high rate should have a compact class declared with
+    declare_event(), and be created with new_event().
+
+    """
     def __init__(self, eventtype, **kwargs):
         self.__dict__.update(kwargs)
         self.eventtype = eventtype
 
+    def attributes(self):
+        """Returns a new dict of this event's attributes, not including the
+        eventtype
+
+        """
+        attrs = dict(self.__dict__)
+        del attrs['eventtype']
+        return attrs
+
+class SlottedEvent(object):
+    """Base class for the compact event classes made by declare_event().
+
+    Instances have no attribute dictionary. Only the attributes named when the
+    class was declared may be set on them, and the eventtype is a class
+    attribute. Otherwise they behave like Event objects.
+
+    """
+    __slots__ = ()
+    eventtype = None
+
+    def __init__(self, **kwargs):
+        for name, value in kwargs.iteritems():
+            setattr(self, name, value)
+
+    def attributes(self):
+        """Returns a new dict of this event's attributes that have been set,
+        not including the eventtype
+
+        """
+        attrs = {}
+        for name in self.__slots__:
+            try:
+                attrs[name] = getattr(self, name)
+            except AttributeError:
+                pass
+        return attrs
+
+    def __repr__(self):
+        return "<{0} {1!r}>".format(type(self).__name__, self.eventtype)
+
+# Maps event types to the classes declared for them with declare_event()
+_event_classes = {}
+
+def declare_event(eventtype, *attributes):
+    """Declares a compact class for events of the given type. attributes are
+    the names of every attribute an event of this type may carry, including
+    any that middleware may add to it. Returns the new class.
+
+    """
+    name = "".join(x.capitalize() for x in eventtype.replace(".", "_").split("_")) + "Event"
+    cls = type(name, (SlottedEvent,), {
+        "__slots__": tuple(attributes),
+        "eventtype": eventtype,
+        })
+    _event_classes[eventtype] = cls
+    return cls
+
+def new_event(eventtype, **kwargs):
+    """Creates an event of the given type and attributes, using the class
+    declared for that type with declare_event() if there is one, and a generic
+    Event object otherwise.
+
+    """
+    try:
+        cls = _event_classes[eventtype]
+    except KeyError:
+        return Event(eventtype, **kwargs)
+    return cls(**kwargs)